@@ -0,0 +1,111 @@
+import argparse
+import os
+import random
+import shutil
+import sqlite3
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta
+from pathlib import Path
+
+# server のモジュールを直接読み込むためにパスを追加
+ROOT = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(ROOT / 'server'))
+
+WORK_DIR = tempfile.mkdtemp(prefix='bench_analytics_')
+os.environ.setdefault('SQLITE_DB_PATH', os.path.join(WORK_DIR, 'logs.db'))
+
+from log_analytics import DURATION_SQL, LogAnalytics   # noqa: E402
+from sqlite_logger import SQLiteLogger                 # noqa: E402
+
+# 操作ごとの処理時間（秒）の中央値。実際の変換に近い偏りを持たせる
+OPERATION_SECONDS = {1: 20.0, 2: 30.0, 3: 2.0, 4: 5.0, 5: 8.0, 6: 45.0, 7: 60.0}
+
+
+# 期間内に均等に散らばったログを rows 件生成する（1 回のトランザクションで書き込む）
+def generate_logs(db_path, rows, days, now):
+    SQLiteLogger(db_path)
+    started = now - timedelta(days=days)
+    step    = timedelta(days=days) / rows
+    rng     = random.Random(0)
+
+    def records():
+        for i in range(rows):
+            operation  = rng.choice(list(OPERATION_SECONDS))
+            start      = started + step * i
+            duration   = rng.lognormvariate(0, 0.8) * OPERATION_SECONDS[operation]
+            size       = rng.randint(1, 500) * 1024 * 1024
+            yield (
+                start.isoformat(), (start + timedelta(seconds=duration)).isoformat(),
+                f'10.0.{rng.randint(0, 255)}.{rng.randint(0, 255)}', operation, 'input.mp4', size, '.mp4',
+                size, size // 3, duration * 0.9, 'error' if rng.random() < 0.01 else 'ok',
+            )
+
+    with sqlite3.connect(db_path) as conn:
+        conn.executemany(
+            """
+            INSERT INTO logs (start_time, end_time, client_ip, operation, file_name, file_size, media_type,
+                              bytes_in, bytes_out, transcode_seconds, status)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+            """,
+            records(),
+        )
+
+
+# 索引も集計表も使わずに「今週最も遅い操作」を求める（全行を読み、操作ごとに処理時間を並べ替える）
+def full_scan_summary(db_path, since):
+    durations = {}
+    with sqlite3.connect(db_path) as conn:
+        for operation, duration in conn.execute(
+            f"SELECT operation, {DURATION_SQL} FROM logs NOT INDEXED WHERE start_time >= ?",
+            (since,),
+        ):
+            durations.setdefault(operation, []).append(duration)
+    return sorted(
+        ((operation, sorted(values)[int(len(values) * 0.95)]) for operation, values in durations.items()),
+        key=lambda item: item[1], reverse=True,
+    )
+
+
+def timed(label, func, *args):
+    started = time.perf_counter()
+    result  = func(*args)
+    print(f'{label:<28}: {(time.perf_counter() - started) * 1000:10.1f} ms')
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description='ログの集計表による問い合わせの速さを計測')
+    parser.add_argument('--rows', type=int, default=2_000_000)
+    parser.add_argument('--days', type=int, default=30)
+    args = parser.parse_args()
+
+    db_path = os.path.join(WORK_DIR, 'analytics.db')
+    now     = datetime.utcnow()
+    since   = (now - timedelta(days=7)).isoformat()
+
+    timed(f'generate {args.rows:,} rows', generate_logs, db_path, args.rows, args.days, now)
+    slowest = timed('full scan (this week)', full_scan_summary, db_path, since)
+
+    analytics = timed('create indexes', LogAnalytics, db_path)
+    timed('initial rollup', analytics.refresh, now)
+
+    # 直近のログが増えた後の差分の更新
+    generate_more = 1000
+    with sqlite3.connect(db_path) as conn:
+        conn.executemany(
+            "INSERT INTO logs (start_time, end_time, operation, status) VALUES (?, ?, 1, 'ok')",
+            [((now - timedelta(seconds=i)).isoformat(), now.isoformat()) for i in range(generate_more)],
+        )
+    timed('incremental refresh', analytics.refresh, now)
+    summary = timed('summary (this week)', analytics.summary, since)
+
+    print('slowest by full scan :', [operation for operation, _ in slowest])
+    print('slowest by rollup    :', [row['operation'] for row in summary])
+
+    shutil.rmtree(WORK_DIR, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    main()
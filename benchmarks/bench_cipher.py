@@ -0,0 +1,66 @@
+import argparse
+import os
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+# server のモジュールを直接読み込むためにパスを追加
+ROOT = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(ROOT / 'server'))
+
+os.environ.setdefault('SQLITE_DB_PATH', os.path.join(tempfile.mkdtemp(prefix='bench_cipher_'), 'logs.db'))
+
+from server import AESCipherCFB, AESCipherCTR   # noqa: E402
+
+
+# 旧方式: フレームごとに暗号オブジェクトを作り直し、長さと暗号文を連結する
+def run_legacy(total_size, frame_size, key, iv):
+    sender, receiver = AESCipherCFB(key, iv), AESCipherCFB(key, iv)
+    payload = os.urandom(frame_size)
+
+    remaining = total_size
+    while remaining > 0:
+        encrypted = sender.encrypt(payload)
+        frame     = len(encrypted).to_bytes(4, 'big') + encrypted
+        receiver.decrypt(frame[4:])
+        remaining -= frame_size
+
+
+# 新方式: 方向ごとに 1 つの CTR ストリームを使い、再利用バッファへ直接書き込む
+def run_streaming(total_size, frame_size, key, iv):
+    sender, receiver = AESCipherCTR(key, iv, is_server=False), AESCipherCTR(key, iv, is_server=True)
+    payload = os.urandom(frame_size)
+
+    send_buffer = bytearray(frame_size + 4)
+    recv_buffer = bytearray(frame_size)
+    frame       = memoryview(send_buffer)
+
+    remaining = total_size
+    while remaining > 0:
+        frame[:4] = frame_size.to_bytes(4, 'big')
+        sender.encrypt(payload, output=frame[4:])
+        receiver.decrypt(frame[4:], output=recv_buffer)
+        remaining -= frame_size
+
+
+def measure(label, runner, total_size, frame_size):
+    key, iv = os.urandom(16), os.urandom(16)
+    started = time.perf_counter()
+    runner(total_size, frame_size, key, iv)
+    elapsed = time.perf_counter() - started
+    print(f'{label:<28} frame={frame_size:>8} B  {total_size / elapsed / 1e6:8.1f} MB/s  ({elapsed:.2f} s)')
+
+
+def main():
+    parser = argparse.ArgumentParser(description='暗号化＋復号のスループット（MB/s）を計測')
+    parser.add_argument('--size',       type=int, default=1024 ** 3, help='転送量（バイト）')
+    parser.add_argument('--frame-size', type=int, default=1400)
+    args = parser.parse_args()
+
+    measure('CFB, new cipher per frame', run_legacy,    args.size, args.frame_size)
+    measure('CTR, one stream/direction', run_streaming, args.size, args.frame_size)
+
+
+if __name__ == '__main__':
+    main()
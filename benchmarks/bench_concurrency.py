@@ -0,0 +1,94 @@
+import argparse
+import os
+import shutil
+import statistics
+import sys
+import tempfile
+import threading
+import time
+from pathlib import Path
+
+# server / client のモジュールを直接読み込むためにパスを追加
+ROOT = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(ROOT / 'server'))
+sys.path.insert(0, str(ROOT / 'client'))
+
+WORK_DIR = tempfile.mkdtemp(prefix='bench_concurrency_')
+os.environ.setdefault('SQLITE_DB_PATH', os.path.join(WORK_DIR, 'logs.db'))
+
+from server import MediaProcessor, TCPServer   # noqa: E402
+from client import TCPClient                   # noqa: E402
+
+
+class SleepingProcessor(MediaProcessor):
+
+    # ffmpeg の代わりに一定時間待機してから入力をそのまま出力とする
+    def __init__(self, dpath, transcode_seconds):
+        super().__init__(dpath)
+        self.transcode_seconds = transcode_seconds
+
+    def run_stream(self, stream, input_file_path, output_file_path):
+        time.sleep(self.transcode_seconds)
+        shutil.move(input_file_path, output_file_path)
+        return output_file_path
+
+
+def run_client(port, file_path, results, index):
+    client = TCPClient('127.0.0.1', port, os.path.join(WORK_DIR, f'receive_{index}'))
+    started = time.perf_counter()
+    try:
+        client.upload_and_process(file_path, 1)
+        results[index] = time.perf_counter() - started
+    except Exception as error:
+        results[index] = error
+
+
+def main():
+    parser = argparse.ArgumentParser(description='同時接続時のスループットと待ち時間を計測')
+    parser.add_argument('--clients',   type=int,   default=50)
+    parser.add_argument('--workers',   type=int,   default=os.cpu_count())
+    parser.add_argument('--pending',   type=int,   default=None)
+    parser.add_argument('--file-size', type=int,   default=1024 * 1024)
+    parser.add_argument('--transcode', type=float, default=0.2, help='擬似 ffmpeg 処理時間（秒）')
+    parser.add_argument('--port',      type=int,   default=9101)
+    args = parser.parse_args()
+
+    file_path = os.path.join(WORK_DIR, 'input.mp4')
+    Path(file_path).write_bytes(os.urandom(args.file_size))
+
+    processor = SleepingProcessor(os.path.join(WORK_DIR, 'processed'), args.transcode)
+    server = TCPServer('127.0.0.1', args.port, processor, args.workers, args.pending)
+    server_thread = threading.Thread(target=server.start_server, daemon=True)
+    server_thread.start()
+
+    results = [None] * args.clients
+    threads = [
+        threading.Thread(target=run_client, args=(args.port, file_path, results, i))
+        for i in range(args.clients)
+    ]
+
+    started = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - started
+
+    server.shutdown()
+    server_thread.join()
+
+    latencies = sorted(r for r in results if isinstance(r, float))
+    failures  = len(results) - len(latencies)
+    p99       = latencies[max(0, int(len(latencies) * 0.99) - 1)] if latencies else float('nan')
+
+    print(f'workers={args.workers} clients={args.clients} failures={failures}')
+    print(f'requests/sec : {len(latencies) / elapsed:.2f}')
+    if latencies:
+        print(f'p50 latency  : {statistics.median(latencies) * 1000:.1f} ms')
+        print(f'p99 latency  : {p99 * 1000:.1f} ms')
+
+    shutil.rmtree(WORK_DIR, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,87 @@
+import argparse
+import os
+import shutil
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+import ffmpeg
+
+# server のモジュールを直接読み込むためにパスを追加
+ROOT = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(ROOT / 'server'))
+
+WORK_DIR = tempfile.mkdtemp(prefix='bench_gif_')
+os.environ.setdefault('SQLITE_DB_PATH', os.path.join(WORK_DIR, 'logs.db'))
+
+from server import MediaProcessor   # noqa: E402
+
+
+# 入力が指定されなければ、テストパターンの映像と音声から動画を生成する
+def generate_input(duration, size):
+    input_path = os.path.join(WORK_DIR, 'source.mp4')
+    video = ffmpeg.input(f'testsrc2=duration={duration}:size={size}:rate=30', f='lavfi')
+    audio = ffmpeg.input(f'sine=frequency=440:duration={duration}', f='lavfi')
+    ffmpeg.output(video, audio, input_path, vcodec='libx264', acodec='aac', g=60).overwrite_output().run(quiet=True)
+    return input_path
+
+
+# パレットを使わず、fps と scale だけで GIF を作る従来のコマンド
+def legacy_gif(input_path, start_time, duration, fps, width):
+    output_path = os.path.join(WORK_DIR, 'legacy.gif')
+    source = ffmpeg.input(input_path, ss=start_time, t=duration)
+    ffmpeg.output(
+        source, output_path, vf=f'fps={fps},scale={width}:-1:flags=lanczos', loop=0
+    ).overwrite_output().run(quiet=True)
+    return output_path
+
+
+# 1 回分の GIF 作成にかかった時間（秒）と出力サイズ（バイト）を返す
+def measure(label, run):
+    started = time.perf_counter()
+    output  = run()
+    elapsed = time.perf_counter() - started
+    size    = os.path.getsize(output)
+    print(f'{label:<22} {elapsed:8.2f} s  {size / 1024:10.1f} KiB')
+    os.remove(output)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='パレットを使う GIF 作成と従来の GIF 作成の所要時間・出力サイズを比較')
+    parser.add_argument('--input',      help='切り出す動画（未指定ならテストパターンを生成）')
+    parser.add_argument('--length',     type=int, default=600, help='生成する動画の長さ（秒）')
+    parser.add_argument('--size',       default='1920x1080', help='生成する動画の解像度')
+    parser.add_argument('--start-time', type=float, default=480, help='切り出しの開始位置（秒）')
+    parser.add_argument('--duration',   type=float, default=5, help='切り出す長さ（秒）')
+    parser.add_argument('--fps',        type=int, default=10)
+    parser.add_argument('--width',      type=int, default=320)
+    args = parser.parse_args()
+
+    input_path = args.input or generate_input(args.length, args.size)
+    processor  = MediaProcessor(os.path.join(WORK_DIR, 'processed'))
+    json_file  = {
+        'operation'  : 5,
+        'file_name'  : Path(input_path).name,
+        'start_time' : args.start_time,
+        'duration'   : args.duration,
+        'fps'        : args.fps,
+        'width'      : args.width,
+    }
+
+    # 変換のたびに入力ファイルが削除されるため、作業用にコピーしてから渡す
+    def run(request):
+        work_input = os.path.join(processor.dpath, Path(input_path).name)
+        shutil.copyfile(input_path, work_input)
+        return processor.run_operation(request, work_input)
+
+    measure('legacy gif',            lambda: legacy_gif(input_path, args.start_time, args.duration, args.fps, args.width))
+    measure('palette gif (cold)',    lambda: run(json_file))
+    measure('palette gif (cached)',  lambda: run(json_file))
+    measure('animated webp',         lambda: run({**json_file, 'animation_format': 'webp'}))
+
+    shutil.rmtree(WORK_DIR, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,79 @@
+import argparse
+import os
+import socket
+import statistics
+import sys
+import tempfile
+import threading
+import time
+from pathlib import Path
+
+# server / client のモジュールを直接読み込むためにパスを追加
+ROOT = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(ROOT / 'server'))
+sys.path.insert(0, str(ROOT / 'client'))
+
+WORK_DIR = tempfile.mkdtemp(prefix='bench_key_exchange_')
+os.environ.setdefault('SQLITE_DB_PATH', os.path.join(WORK_DIR, 'logs.db'))
+
+from server import RSAKeyPool, TCPServer   # noqa: E402
+from client import TCPClient               # noqa: E402
+
+
+# socketpair 上でサーバ側とクライアント側の鍵交換を 1 回行い、所要時間を返す
+def handshake(server, client):
+    server_sock, client_sock = socket.socketpair()
+    started = time.perf_counter()
+
+    server_thread = threading.Thread(target=server.perform_key_exchange, args=(server_sock,))
+    server_thread.start()
+
+    pubkey_length = int.from_bytes(client.recv_exact(client_sock, 2), 'big')
+    client.encryption.load_server_public_key(client.recv_exact(client_sock, pubkey_length))
+    encrypted_key = client.encryption.encrypt_symmetric_key(client.encryption.generate_symmetric_key())
+    client_sock.sendall(len(encrypted_key).to_bytes(2, 'big') + encrypted_key)
+
+    server_thread.join()
+    elapsed = time.perf_counter() - started
+
+    server_sock.close()
+    client_sock.close()
+    return elapsed
+
+
+def measure(label, pool_size, count, warmup):
+    key_pool = RSAKeyPool(pool_size)
+    server   = TCPServer.__new__(TCPServer)   # ソケットを開かずに鍵交換だけを使う
+    server.key_pool = key_pool
+    client   = TCPClient('127.0.0.1', 0, os.path.join(WORK_DIR, 'receive'))
+
+    # プールが指定数まで補充されるのを待つ
+    deadline = time.time() + warmup
+    while pool_size and key_pool.stats()['available'] < pool_size and time.time() < deadline:
+        time.sleep(0.1)
+
+    started   = time.perf_counter()
+    latencies = sorted(handshake(server, client) for _ in range(count))
+    elapsed   = time.perf_counter() - started
+    key_pool.close()
+
+    stats = key_pool.stats()
+    print(f'[{label}] pool_size={pool_size} hits={stats["hits"]} misses={stats["misses"]}')
+    print(f'  handshakes/sec : {count / elapsed:.2f}')
+    print(f'  p50 latency    : {statistics.median(latencies) * 1000:.1f} ms')
+    print(f'  max latency    : {latencies[-1] * 1000:.1f} ms')
+
+
+def main():
+    parser = argparse.ArgumentParser(description='鍵交換の接続確立時間と handshakes/sec を計測')
+    parser.add_argument('--count',     type=int,   default=16)
+    parser.add_argument('--pool-size', type=int,   default=16)
+    parser.add_argument('--warmup',    type=float, default=120.0, help='プール補充を待つ最大秒数')
+    args = parser.parse_args()
+
+    measure('before (no pool)', 0, args.count, 0)
+    measure('after (key pool)', args.pool_size, args.count, args.warmup)
+
+
+if __name__ == '__main__':
+    main()
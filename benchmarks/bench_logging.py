@@ -0,0 +1,112 @@
+import argparse
+import os
+import shutil
+import sqlite3
+import statistics
+import sys
+import tempfile
+import threading
+import time
+from datetime import datetime
+from pathlib import Path
+
+# server のモジュールを直接読み込むためにパスを追加
+ROOT = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(ROOT / 'server'))
+
+WORK_DIR = tempfile.mkdtemp(prefix='bench_logging_')
+os.environ.setdefault('SQLITE_DB_PATH', os.path.join(WORK_DIR, 'logs.db'))
+
+from sqlite_logger import SQLiteLogger   # noqa: E402
+
+
+# 1 回のログごとに接続を開いてコミットする従来の書き込み方
+class PerCallLogger:
+
+    def __init__(self, db_path):
+        self.db_path = db_path
+        SQLiteLogger(db_path)   # テーブルの作成だけに使う
+
+    def log_start(self, start_time, client_ip, operation, file_name, file_size, media_type):
+        with sqlite3.connect(self.db_path, timeout=30) as conn:
+            cur = conn.execute(
+                """
+                INSERT INTO logs
+                  (start_time, end_time, client_ip, operation, file_name,
+                   file_size, media_type)
+                VALUES (?, NULL, ?, ?, ?, ?, ?)
+                """,
+                (start_time, client_ip, operation, file_name, file_size, media_type),
+            )
+            conn.commit()
+            return cur.lastrowid
+
+    def log_end(self, row_id, end_time):
+        with sqlite3.connect(self.db_path, timeout=30) as conn:
+            conn.execute("UPDATE logs SET end_time = ? WHERE id = ?", (end_time, row_id))
+            conn.commit()
+
+    def flush(self):
+        pass
+
+
+# 接続処理のスレッドを模して、リクエストごとに開始と終了のログを書く
+def run_requests(logger, requests, latencies, index):
+    spent = []
+    for i in range(requests):
+        started = time.perf_counter()
+        log_id  = logger.log_start(datetime.utcnow().isoformat(), '127.0.0.1', 1, f'input_{index}_{i}.mp4', 1024, 'mp4')
+        logger.log_end(log_id, datetime.utcnow().isoformat())
+        spent.append(time.perf_counter() - started)
+    latencies[index] = spent
+
+
+# 全スレッドのログがデータベースに書き終わるまでの、1 秒あたりのログ件数と呼び出し側の待ち時間を計測
+def measure(name, logger, threads, requests):
+    latencies = [None] * threads
+    workers   = [
+        threading.Thread(target=run_requests, args=(logger, requests, latencies, i))
+        for i in range(threads)
+    ]
+
+    started = time.perf_counter()
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    logger.flush()
+    elapsed = time.perf_counter() - started
+
+    spent  = sorted(s for per_thread in latencies for s in per_thread)
+    events = threads * requests * 2   # 開始と終了で 2 件
+    p99    = spent[max(0, int(len(spent) * 0.99) - 1)]
+    print(f'[{name}]')
+    print(f'  log events/sec : {events / elapsed:,.0f}')
+    print(f'  p50 call time  : {statistics.median(spent) * 1_000_000:.1f} us')
+    print(f'  p99 call time  : {p99 * 1_000_000:.1f} us')
+    return events / elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description='ログ書き込みのスループット（ログ件数/秒）を計測')
+    parser.add_argument('--threads',        type=int,   default=16,  help='同時にログを書く接続処理の数')
+    parser.add_argument('--requests',       type=int,   default=200, help='1 スレッドあたりのリクエスト数')
+    parser.add_argument('--batch-size',     type=int,   default=256)
+    parser.add_argument('--flush-interval', type=float, default=0.5)
+    args = parser.parse_args()
+
+    print(f'threads={args.threads} requests/thread={args.requests}')
+    baseline = measure(
+        'per-call connection', PerCallLogger(os.path.join(WORK_DIR, 'per_call.db')), args.threads, args.requests
+    )
+
+    batched = SQLiteLogger(os.path.join(WORK_DIR, 'batched.db'), args.batch_size, args.flush_interval)
+    result  = measure('batched writer', batched, args.threads, args.requests)
+    batched.close()
+    print(f'speedup : {result / baseline:.1f}x  (dropped={batched.dropped})')
+
+    shutil.rmtree(WORK_DIR, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    main()
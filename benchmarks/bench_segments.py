@@ -0,0 +1,67 @@
+import argparse
+import os
+import shutil
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+import ffmpeg
+
+# server のモジュールを直接読み込むためにパスを追加
+ROOT = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(ROOT / 'server'))
+
+WORK_DIR = tempfile.mkdtemp(prefix='bench_segments_')
+os.environ.setdefault('SQLITE_DB_PATH', os.path.join(WORK_DIR, 'logs.db'))
+
+from server import MediaProcessor   # noqa: E402
+
+
+# 入力が指定されなければ、テストパターンの映像と音声から長い動画を生成する
+def generate_input(duration, size):
+    input_path = os.path.join(WORK_DIR, 'source.mp4')
+    video = ffmpeg.input(f'testsrc2=duration={duration}:size={size}:rate=30', f='lavfi')
+    audio = ffmpeg.input(f'sine=frequency=440:duration={duration}', f='lavfi')
+    ffmpeg.output(video, audio, input_path, vcodec='libx264', acodec='aac', g=60).overwrite_output().run(quiet=True)
+    return input_path
+
+
+# 1 回分の変換にかかった時間（秒）を返す。workers=1 は分割しない従来の経路
+def measure(input_path, operation, workers):
+    processor  = MediaProcessor(os.path.join(WORK_DIR, f'processed_{workers}'), segment_workers=workers)
+    work_input = os.path.join(processor.dpath, f'run_{Path(input_path).name}')
+    shutil.copyfile(input_path, work_input)
+
+    json_file = {'operation': operation, 'file_name': Path(work_input).name, 'resolution': '1280:720'}
+    started   = time.perf_counter()
+    output    = processor.run_operation(json_file, work_input)
+    elapsed   = time.perf_counter() - started
+
+    os.remove(output)
+    return elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description='長い動画の分割並列変換と単一プロセス変換の所要時間を比較')
+    parser.add_argument('--input',     help='変換する動画（未指定ならテストパターンを生成）')
+    parser.add_argument('--duration',  type=int, default=300, help='生成する動画の長さ（秒）')
+    parser.add_argument('--size',      default='1920x1080', help='生成する動画の解像度')
+    parser.add_argument('--operation', type=int, default=1, choices=(1, 2), help='1=圧縮, 2=解像度変更')
+    parser.add_argument('--workers',   type=int, nargs='+', default=[1, 2, 4, 8])
+    args = parser.parse_args()
+
+    input_path = args.input or generate_input(args.duration, args.size)
+
+    baseline = None
+    for workers in args.workers:
+        elapsed  = measure(input_path, args.operation, workers)
+        baseline = baseline or elapsed
+        label    = 'single process' if workers == 1 else f'{workers} segments'
+        print(f'{label:<16} {elapsed:8.2f} s  speedup x{baseline / elapsed:5.2f}')
+
+    shutil.rmtree(WORK_DIR, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,6 +1,10 @@
+import hashlib
+import select
 import socket
 import os
 import json
+import time
+import uuid
 from pathlib import Path
 
 from Crypto.PublicKey import RSA
@@ -8,6 +12,31 @@ from Crypto.Cipher    import AES, PKCS1_OAEP
 from Crypto.Random    import get_random_bytes
 
 
+# 鍵交換時にサーバへ伝える暗号モード
+CIPHER_MODE_CFB = 0   # フレームごとに同じ IV から暗号化し直す旧方式
+CIPHER_MODE_CTR = 1   # 方向ごとに 1 つの CTR ストリームをセッション全体で使う方式
+
+# 大きなフレームで送受信する際の既定サイズ
+LARGE_FRAME_SIZE = 1024 * 1024
+
+# 1 フレームで送受信できる平文の最大サイズ（サーバはこれを超えるフレームを拒否する）
+MAX_FRAME_SIZE = 4 * 1024 * 1024
+
+# ストリーミング応答でファイルサイズ欄に入る値（全体の長さが未確定であることを示す）
+STREAMING_FILE_SIZE = (1 << 40) - 1
+
+# キューに積んだジョブの状態確認・結果取得を行う操作のコード
+OPERATION_FETCH_JOB = 8
+
+# 鍵交換時の長さ 2 バイトの最上位ビット。立てて送るとチケットによるセッション再開の要求になる
+RESUME_FLAG = 0x8000
+
+# 鍵交換で暗号モードの後ろに付けるフラグ。立てるとセッション再開用のチケットを要求する
+KEY_FLAG_TICKET = 0x01
+
+# セッション再開時にクライアント・サーバが送る nonce の長さ
+RESUME_NONCE_SIZE = 16
+
 
 class AESCipherCFB:
     
@@ -16,39 +45,64 @@ class AESCipherCFB:
         self.key = key
         self.iv  = iv
         
-    # AES CFBモードでデータを暗号化して返す
-    def encrypt(self, data):
-        return AES.new(self.key, AES.MODE_CFB, iv=self.iv, segment_size=128).encrypt(data)
+    # AES CFBモードでデータを暗号化して返す（output 指定時はそのバッファに書き込む）
+    def encrypt(self, data, output=None):
+        return AES.new(self.key, AES.MODE_CFB, iv=self.iv, segment_size=128).encrypt(data, output=output)
+
+    # AES CFBモードでデータを復号して返す（output 指定時はそのバッファに書き込む）
+    def decrypt(self, data, output=None):
+        return AES.new(self.key, AES.MODE_CFB, iv=self.iv, segment_size=128).decrypt(data, output=output)
+
 
-    # AES CFBモードでデータを復号して返す
-    def decrypt(self, data):
-        return AES.new(self.key, AES.MODE_CFB, iv=self.iv, segment_size=128).decrypt(data)
+class AESCipherCTR:
+
+    # 送信用・受信用に 1 つずつ CTR 暗号器を作り、セッション全体でカウンタを進め続ける
+    # 方向ごとに nonce の末尾 1 バイトを変え、同じ鍵でも鍵ストリームが重ならないようにする
+    def __init__(self, key, iv, is_server=False):
+        client_nonce = iv[:7] + b'\x00'   # クライアント → サーバ
+        server_nonce = iv[:7] + b'\x01'   # サーバ → クライアント
+
+        send_nonce, recv_nonce = (server_nonce, client_nonce) if is_server else (client_nonce, server_nonce)
+        self.encryptor = AES.new(key, AES.MODE_CTR, nonce=send_nonce)
+        self.decryptor = AES.new(key, AES.MODE_CTR, nonce=recv_nonce)
+
+    # 送信方向の鍵ストリームでデータを暗号化（output 指定時はそのバッファに書き込む）
+    def encrypt(self, data, output=None):
+        return self.encryptor.encrypt(data, output=output)
+
+    # 受信方向の鍵ストリームでデータを復号（output 指定時はそのバッファに書き込む）
+    def decrypt(self, data, output=None):
+        return self.decryptor.decrypt(data, output=output)
 
 
 class Encryption:
     
-    def __init__(self):
+    def __init__(self, cipher_mode=CIPHER_MODE_CTR):
         self.server_public_key = None
         self.aes_key = None
         self.iv = None
+        self.cipher_mode = cipher_mode
 
     # 通信相手から受け取った公開鍵をインポート
     def load_server_public_key(self, data):
         self.server_public_key = RSA.import_key(data)
 
-    # ランダムなAES鍵とIV（各16バイト）を生成
-    def generate_symmetric_key(self):
+    # ランダムなAES鍵とIV（各16バイト）を生成し、末尾に暗号モードとフラグ（各1バイト）を付ける
+    def generate_symmetric_key(self, flags=0):
         self.aes_key = get_random_bytes(16)
         self.iv      = get_random_bytes(16)
-        return self.aes_key + self.iv  
+        return self.aes_key + self.iv + bytes([self.cipher_mode, flags])
 
     # 相手の公開鍵で対称鍵＋IVをRSA暗号化して返す
     def encrypt_symmetric_key(self, sym):
         return PKCS1_OAEP.new(self.server_public_key).encrypt(sym)
 
     # 対称鍵でソケット通信を暗号化するSecureSocketを生成
-    def wrap_socket(self, sock):        
-        cipher = AESCipherCFB(self.aes_key, self.iv)
+    def wrap_socket(self, sock):
+        if self.cipher_mode == CIPHER_MODE_CTR:
+            cipher = AESCipherCTR(self.aes_key, self.iv)
+        else:
+            cipher = AESCipherCFB(self.aes_key, self.iv)
         return SecureSocket(sock, cipher)
 
 
@@ -58,6 +112,8 @@ class SecureSocket:
     def __init__(self, sock, cipher):
         self.sock   = sock
         self.cipher = cipher
+        # 送信フレーム（長さ 4 バイト + 暗号文）を組み立てる再利用バッファ
+        self.send_buffer = bytearray()
 
     # 指定されたバイト数を受信するまで繰り返す
     def recv_exact(self, n):
@@ -71,45 +127,211 @@ class SecureSocket:
 
     # 平文を暗号化し、長さ（4バイト）付きで送信
     def sendall(self, plaintext):
-        ciphertext = self.cipher.encrypt(plaintext)
-        self.sock.sendall(len(ciphertext).to_bytes(4, 'big') + ciphertext)
+        size = len(plaintext)
+        if len(self.send_buffer) < size + 4:
+            self.send_buffer = bytearray(size + 4)
+
+        # 連結によるコピーを避け、再利用バッファへ直接暗号文を書き込む
+        frame = memoryview(self.send_buffer)[:size + 4]
+        frame[:4] = size.to_bytes(4, 'big')
+        self.cipher.encrypt(plaintext, output=frame[4:])
+        self.sock.sendall(frame)
+
+    # バッファ上の平文をその場で暗号化し、長さと暗号文を連結せずに送信（内容は暗号文で上書きされる）
+    def sendall_inplace(self, view):
+        self.cipher.encrypt(view, output=view)
+        buffers = [len(view).to_bytes(4, 'big'), view]
+
+        if not hasattr(self.sock, 'sendmsg'):
+            for buffer in buffers:
+                self.sock.sendall(buffer)
+            return
+
+        # sendmsg で長さと暗号文をまとめて送り、一部だけ送れた場合は残りを送り直す
+        while buffers:
+            sent = self.sock.sendmsg(buffers)
+            while sent:
+                if sent >= len(buffers[0]):
+                    sent -= len(buffers[0])
+                    buffers.pop(0)
+                else:
+                    buffers[0] = memoryview(buffers[0])[sent:]
+                    sent = 0
 
     # 暗号化されたデータを受信して復号して返す
     def recv(self):
         length = self.recv_exact(4)
+        if len(length) < 4:
+            raise ConnectionError("サーバとの接続が切断されました")
         ciphertext = self.recv_exact(int.from_bytes(length, 'big'))
         return self.cipher.decrypt(ciphertext)
 
+    # 1 フレームを buffer に直接受信し、その場で復号して平文部分の memoryview を返す
+    def recv_into(self, buffer):
+        length_bytes = self.recv_exact(4)
+        if len(length_bytes) < 4:
+            raise ConnectionError("サーバとの接続が切断されました")
+        length = int.from_bytes(length_bytes, 'big')
+        if length > len(buffer):
+            raise ValueError(f"Frame too large: {length} bytes")
+        view = memoryview(buffer)[:length]
+
+        received = 0
+        while received < length:
+            n = self.sock.recv_into(view[received:])
+            if n == 0:
+                return view[:0]
+            received += n
+
+        self.cipher.decrypt(view, output=view)
+        return view
+
     def close(self):
         self.sock.close()
 
 
 class TCPClient:
 
-    def __init__(self, server_address, server_port, dpath='receive'):
+    def __init__(self, server_address, server_port, dpath='receive', frame_size=LARGE_FRAME_SIZE,
+                 stream_response=False, dedup=False, retries=0, retry_interval=1.0, keep_alive=False,
+                 progress_callback=None):
         self.server_address = server_address
         self.server_port = server_port
         self.encryption = Encryption()
         self.chunk_size = 1400
+        # 送受信に使うフレームサイズ（サーバへも同じサイズでの送信を要求する）
+        # アップロードはサーバの返答を待たずにこのサイズで送るため、プロトコルの上限に収める
+        self.frame_size = min(frame_size or self.chunk_size, MAX_FRAME_SIZE)
+        # 変換完了を待たず、出力が生成された順に受け取るか
+        self.stream_response = stream_response
+        # 内容ハッシュを先に送り、サーバが同じファイルを保持していればアップロードを省くか
+        self.dedup = dedup
+        # 接続が切れた場合に再試行する回数と、初回の待ち時間（秒、再試行ごとに倍にする）
+        # 再試行時は、送信済み・受信済みの部分を飛ばして続きから送受信する
+        self.retries = retries
+        self.retry_interval = retry_interval
+        # 受信途中のファイル（中断した場合に続きから受信するため）
+        self.partial_download = None
+        # 同じ接続で複数のリクエストを続けて送るか（再接続時はチケットで RSA 鍵交換を省く）
+        self.keep_alive = keep_alive
+        self.sock = None
+        # セッション再開用のチケット（チケット ID, 秘密, 有効期限）
+        self.session_ticket = None
+        # 直前の応答でサーバが返したエンコード速度・出力サイズ（変換しなかった場合は None）
+        self.encode_stats = None
+        # サーバから進捗が届くたびに呼び出す関数（段階・割合・残り時間などの辞書を渡す）
+        # 指定するとサーバへ進捗を要求する。ストリーミング応答では進捗は届かない
+        self.progress_callback = progress_callback
+        # アップロード中に届いた、進捗以外の応答（送信を打ち切った後に読む）
+        self.pending_reply = None
         self.dpath = dpath
         os.makedirs(self.dpath, exist_ok=True)
         
     def upload_and_process(self, file_path, operation, operation_details={}):
-        # 鍵交換と暗号化ソケットの確立
-        self.perform_key_exchange()
-
-        # ファイル名とメディアタイプを取得
-        path = Path(file_path)
-        file_name, media_type = path.name, path.suffix.encode('utf-8')
-
         # body の Json部 を作成
         json_data = {
-            'file_name': file_name,
+            'file_name': Path(file_path).name,
+            'operation': operation,
+            'frame_size': self.frame_size,
+            'stream_response': self.stream_response,
+            **operation_details
+        }
+        if not self.retries:
+            return self.exchange(file_path, json_data, self.dedup)
+
+        # 再試行しても同じアップロードとして扱われるよう、アップロード ID を付与
+        # アップロードを終えた後に切れた場合は受信途中のファイルが残らないため、再試行では内容ハッシュも送り、
+        # サーバが保持している入力・変換結果を使わせる
+        json_data['upload_id'] = uuid.uuid4().hex
+        for attempt in range(self.retries + 1):
+            try:
+                return self.exchange(file_path, json_data, self.dedup or attempt > 0)
+            except OSError:
+                if attempt == self.retries:
+                    raise
+                time.sleep(self.retry_interval * 2 ** attempt)
+
+                # 受信途中のファイルがあれば、その続きから受け取る
+                if self.partial_download and os.path.exists(self.partial_download):
+                    json_data['download_offset'] = os.path.getsize(self.partial_download)
+
+    # リクエストを送って応答を受け取る。失敗した接続は次のリクエストに使わず閉じる
+    def exchange(self, file_path, json_data, dedup):
+        try:
+            self.upload(file_path, json_data, dedup)
+            return self.receive_file()
+        except Exception:
+            self.close()
+            raise
+
+    # ファイルをジョブとして登録し、変換の完了を待たずにジョブ ID を返す
+    def submit_job(self, file_path, operation, operation_details={}):
+        json_data = {
+            'file_name': Path(file_path).name,
             'operation': operation,
+            'frame_size': self.frame_size,
+            'async_job': True,
             **operation_details
         }
+        try:
+            self.upload(file_path, json_data, dedup=False)
+            info, _ = self.receive_packet()
+            if info['error']:
+                raise Exception(f"サーバーエラー: {info['error_message']}")
+        except Exception:
+            self.close()
+            raise
+
+        self.finish_request()
+        return info['job_id']
+
+    # ジョブの結果を取得して保存先を返す（未完了なら None、失敗していれば例外）
+    # offset を指定すると、受信途中の結果ファイルの続きから受け取る
+    def fetch_job(self, job_id, offset=0):
+        json_data = {
+            'file_name': '',
+            'operation': OPERATION_FETCH_JOB,
+            'frame_size': self.frame_size,
+            'job_id': job_id,
+            'download_offset': offset,
+            'keep_alive': self.keep_alive,
+        }
+        try:
+            self.connect()
+            self.sock.sendall(self.build_packet(json.dumps(json_data).encode('utf-8'), b'', 0))
+            return self.receive_file()
+        except Exception:
+            self.close()
+            raise
+
+    # ジョブが完了するまで一定間隔で問い合わせ、結果の保存先を返す
+    def wait_for_job(self, job_id, interval=1.0):
+        while (result := self.fetch_job(job_id)) is None:
+            time.sleep(interval)
+        return result
+
+    # 鍵交換を行い、リクエストとファイル本体を送信する
+    def upload(self, file_path, json_data, dedup=False):
+        # 鍵交換と暗号化ソケットの確立（セッション中は確立済みの接続を使う）
+        self.connect()
+
+        # メディアタイプを取得
+        media_type = Path(file_path).suffix.encode('utf-8')
+
+        if self.keep_alive:
+            json_data['keep_alive'] = True
+        if self.progress_callback is not None and not self.stream_response:
+            json_data['progress'] = True
+        if dedup:
+            json_data['content_hash'] = self.hash_file(file_path, self.frame_size)
+            # 保持済みの内容を使う前に、サーバが指定する範囲からファイルを持っている証明を求められる
+            json_data['possession_proof'] = True
         json_bytes = json.dumps(json_data).encode('utf-8')
 
+        # 読み込み用バッファを使い回し、その場で暗号化して送る
+        buffer = bytearray(self.frame_size)
+        view   = memoryview(buffer)
+
         # ファイルを開いてサイズ取得・送信処理を実行
         with open(file_path, 'rb') as file:
             file.seek(0, os.SEEK_END)
@@ -119,10 +341,132 @@ class TCPClient:
             packet = self.build_packet(json_bytes, media_type, file_size)
             self.sock.sendall(packet)
 
-            while chunk := file.read(self.chunk_size):
-                self.sock.sendall(chunk)
+            # サーバが入力または変換結果を保持していれば、ファイル本体は送らない
+            if dedup and self.receive_offer(file):
+                return
+            file.seek(0)
+
+            # 再開可能なアップロードでは、サーバが受信済みのバイト数を返すため、その続きから送る
+            if 'upload_id' in json_data:
+                file.seek(self.receive_upload_offset())
+
+            while n := file.readinto(buffer):
+                self.sock.sendall_inplace(view[:n])
+                # ストリーミング応答は受信中に届き始めるため対象外
+                if self.stream_response or not self.server_replied():
+                    continue
+                # 受信の進捗であれば通知して送信を続ける
+                reply = self.parse_packet(self.sock.recv())
+                if self.report_progress(reply[0]):
+                    continue
+                # サーバが本体を受け取り終える前に応答した場合（要求が拒否された場合）は、送信をやめて応答を読む
+                self.pending_reply = reply
+                break
+
+    # 受信待ちの応答が届いているか（待たずに確認する）
+    def server_replied(self):
+        readable, _, _ = select.select([self.sock.sock], [], [], 0)
+        return bool(readable)
+
+    # 応答のパケットを受け取る。進捗のパケットは progress_callback に渡し、その次のパケットを返す
+    def receive_packet(self):
+        if self.pending_reply is not None:
+            reply, self.pending_reply = self.pending_reply, None
+            return reply
+
+        while True:
+            info, file_size = self.parse_packet(self.sock.recv())
+            if not self.report_progress(info):
+                return info, file_size
+
+    # 進捗のパケットであれば progress_callback に渡して True を返す
+    def report_progress(self, info):
+        if 'progress' not in info:
+            return False
+        if self.progress_callback is not None:
+            self.progress_callback(info['progress'])
+        return True
+
+    # 内容ハッシュに対するサーバの返答を受け取り、アップロードを省けるかを返す
+    # サーバが内容を保持している場合は、指定された範囲から作った証明を送ってから返答を受け取る
+    def receive_offer(self, file):
+        info, _ = self.receive_packet()
+        if info['error']:
+            raise Exception(f"サーバーエラー: {info['error_message']}")
+
+        if info.get('challenge'):
+            proof = self.possession_proof(file, info['challenge'])
+            self.sock.sendall(self.build_packet(json.dumps({'proof': proof}).encode('utf-8'), b'', 0))
+            info, _ = self.receive_packet()
+            if info['error']:
+                raise Exception(f"サーバーエラー: {info['error_message']}")
+        return info.get('have_result') or info.get('have_input')
+
+    # nonce と、指定された範囲のバイト列を順に連結したものの SHA-256（サーバも同じ計算で照合する）
+    @staticmethod
+    def possession_proof(file, challenge):
+        hasher = hashlib.sha256(bytes.fromhex(challenge['nonce']))
+        for offset, length in challenge['ranges']:
+            file.seek(offset)
+            hasher.update(file.read(length))
+        return hasher.hexdigest()
+
+    # 再開可能なアップロードに対してサーバが受信済みのバイト数を受け取る
+    def receive_upload_offset(self):
+        info, _ = self.receive_packet()
+        if info['error']:
+            raise Exception(f"サーバーエラー: {info['error_message']}")
+        return info['offset']
+
+    # アップロード前にファイル内容の SHA-256 を計算
+    @staticmethod
+    def hash_file(file_path, chunk_size):
+        hasher = hashlib.sha256()
+        with open(file_path, 'rb') as file:
+            while chunk := file.read(chunk_size):
+                hasher.update(chunk)
+        return hasher.hexdigest()
+
+    # セッション中で接続が生きていれば使い回し、そうでなければ接続して鍵交換を行う
+    def connect(self):
+        if self.sock is not None:
+            if self.keep_alive and self.connection_alive():
+                return
+            self.close()
+        self.perform_key_exchange()
+
+    # サーバが接続を閉じていないかを、受信待ちのデータを覗いて確認する
+    def connection_alive(self):
+        sock = self.sock.sock
+        try:
+            sock.setblocking(False)
+            sock.recv(1, socket.MSG_PEEK)
+        except BlockingIOError:
+            # 受信待ちのデータがなく、接続も閉じられていない
+            return True
+        except OSError:
+            return False
+        finally:
+            sock.setblocking(True)
+        # 切断済み、または読み残しのデータがあり次の応答と区別できない
+        return False
+
+    # 応答を受け取り終えた接続を閉じる（セッション中は次のリクエストのために残す）
+    def finish_request(self):
+        if not self.keep_alive:
+            self.close()
+
+    def close(self):
+        self.pending_reply = None
+        if self.sock is not None:
+            self.sock.close()
+            self.sock = None
+
+    def __enter__(self):
+        return self
 
-        return self.receive_file()
+    def __exit__(self, *exc_info):
+        self.close()
 
     def perform_key_exchange(self):
         # TCP ソケットを作成して接続
@@ -132,16 +476,57 @@ class TCPClient:
         # サーバの公開鍵を受信
         pubkey_length = int.from_bytes(self.recv_exact(tcp_socket, 2), 'big')
         server_pubkey = self.recv_exact(tcp_socket, pubkey_length)
+
+        # チケットを持っていれば、RSA による鍵交換を省いてセッションを再開する
+        if self.session_ticket is not None and self.resume_session(tcp_socket):
+            return
+
         self.encryption.load_server_public_key(server_pubkey)
         
-        # 対称鍵（AES + IV）を生成し、サーバ公開鍵で暗号化して送信
-        sym_key = self.encryption.generate_symmetric_key()
+        # 対称鍵（AES + IV）を生成し、サーバ公開鍵で暗号化して送信（セッションではチケットも要求）
+        flags = KEY_FLAG_TICKET if self.keep_alive else 0
+        sym_key = self.encryption.generate_symmetric_key(flags)
         encrypted_key = self.encryption.encrypt_symmetric_key(sym_key)
         tcp_socket.sendall(len(encrypted_key).to_bytes(2, 'big') + encrypted_key)
 
         # 暗号化されたソケットでラップ
         self.sock = self.encryption.wrap_socket(tcp_socket)
 
+        if flags & KEY_FLAG_TICKET:
+            self.receive_ticket()
+
+    # 鍵交換の直後に届くチケットを保存（サーバ側でチケットが無効なら何もしない）
+    def receive_ticket(self):
+        info, _ = self.parse_packet(self.sock.recv())
+        if not info.get('ticket'):
+            return
+        # チケットの秘密は送られないため、確立した鍵からサーバと同じ計算で導出する
+        secret = hashlib.sha256(b'ticket' + self.encryption.aes_key + self.encryption.iv).digest()
+        self.session_ticket = (bytes.fromhex(info['ticket']), secret, time.monotonic() + info['ticket_lifetime'])
+
+    # チケットと nonce を送ってセッションを再開する。拒否された場合は False を返し、同じ接続で通常の鍵交換を行う
+    def resume_session(self, tcp_socket):
+        ticket_id, secret, expires = self.session_ticket
+        if time.monotonic() >= expires:
+            self.session_ticket = None
+            return False
+
+        client_nonce = get_random_bytes(RESUME_NONCE_SIZE)
+        hello = ticket_id + client_nonce + bytes([self.encryption.cipher_mode])
+        tcp_socket.sendall((RESUME_FLAG | len(hello)).to_bytes(2, 'big') + hello)
+
+        if self.recv_exact(tcp_socket, 1) != b'\x01':
+            # サーバの再起動などでチケットが無効になっている
+            self.session_ticket = None
+            return False
+        server_nonce = self.recv_exact(tcp_socket, RESUME_NONCE_SIZE)
+
+        # チケットの秘密と双方の nonce から、このセッションの鍵と IV を導出
+        digest = hashlib.sha256(b'resume' + secret + client_nonce + server_nonce).digest()
+        self.encryption.aes_key, self.encryption.iv = digest[:16], digest[16:32]
+        self.sock = self.encryption.wrap_socket(tcp_socket)
+        return True
+
     # 指定されたバイト数を受信するまで繰り返す
     def recv_exact(self, sock, n):
         buf = bytearray()
@@ -165,42 +550,91 @@ class TCPClient:
         
         return header + json_bytes + media_type_bytes
     
+    # 応答を受信して保存し、保存先を返す（複数ファイルの応答では保存先の一覧を返す）
     def receive_file(self):
-        packet   = self.sock.recv()      # 復号済み平文をまとめて取得
+        info, file_size = self.receive_packet()   # 進捗のパケットを読み飛ばした後の応答
+        if info['error']:
+            raise Exception(f"サーバーエラー: {info['error_message']}")
+
+        if 'status' in info:
+            # ジョブが未完了のため、状態だけが返ってきた（実行中であれば最後に記録された進捗も届く）
+            if info.get('job_progress') and self.progress_callback is not None:
+                self.progress_callback(info['job_progress'])
+            result = None
+        elif 'file_count' in info:
+            result = [self.receive_next_file() for _ in range(info['file_count'])]
+        else:
+            result = self.save_response_file(info, file_size)
+        self.finish_request()
+        return result
+
+    # 複数ファイルの応答から、次のファイルを受信して保存
+    def receive_next_file(self):
+        info, file_size = self.receive_packet()
+        if info['error']:
+            raise Exception(f"サーバーエラー: {info['error_message']}")
+        return self.save_response_file(info, file_size)
+
+    # ヘッダーの情報に従ってファイル本体を受信・保存
+    def save_response_file(self, info, file_size):
+        file_name  = info['file_name']
+        self.encode_stats = info.get('encode_stats')
+        # 旧サーバはフレームサイズを返さないため、従来のチャンクサイズとみなす
+        frame_size = info.get('frame_size') or self.chunk_size
+
+        # ファイルを受信して保存（長さ未確定の場合は終端フレームまで受信）
+        if file_size == STREAMING_FILE_SIZE:
+            out_path = self.save_streamed_file(file_name, self.sock, frame_size)
+        else:
+            out_path = self.save_received_file(file_name, self.sock, file_size, frame_size, info.get('offset', 0))
+        return out_path
+
+    # 受信したパケットから JSON 部とファイルサイズを取り出す
+    @staticmethod
+    def parse_packet(packet):
         header = packet[:8]              # 先頭 8 バイト = ヘッダー
         body   = packet[8:]              # 残り = JSON + メディアタイプ
-        
+
         # ヘッダーから各フィールドを抽出
         json_size       = int.from_bytes(header[0:2], 'big')
-        media_type_size = int.from_bytes(header[2:3], 'big')
         file_size       = int.from_bytes(header[3:8], 'big')
 
-        # ボディから JSON 部とメディアタイプ部に分割
-        json_part  = body[:json_size]
-        media_part = body[json_size:]
-
-        # JSON デコード
-        info = json.loads(json_part.decode('utf-8'))
-        if info['error']:
-            raise Exception(f"サーバーエラー: {info['error_message']}")
-
-        file_name = info['file_name']
-
-        # ファイルを受信して保存
-        out_path = self.save_received_file(file_name, self.sock, file_size)
-        self.sock.close()
-        return out_path
+        # ボディの JSON 部をデコード
+        info = json.loads(body[:json_size].decode('utf-8'))
+        return info, file_size
     
-    def save_received_file(self, file_name, connection, file_size):
+    # offset が指定された場合は、受信済みの部分に続きを追記する
+    def save_received_file(self, file_name, connection, file_size, frame_size=None, offset=0):
         output_path = os.path.join(self.dpath, file_name)
+        # 受信用バッファを使い回し、フレームごとの bytes 生成を避ける
+        buffer = bytearray(frame_size or self.chunk_size)
 
-        with open(output_path, 'wb') as file:
+        # 途中で切断された場合に続きから受信できるよう、受信中のファイルを覚えておく
+        self.partial_download = output_path
+        with open(output_path, 'ab' if offset else 'wb') as file:
+            file.truncate(offset)
             remaining = file_size
             while remaining > 0:
-                chunk = connection.recv()
+                chunk = connection.recv_into(buffer)
                 if not chunk:
-                    break
+                    raise ConnectionError("ファイルの受信中に接続が切断されました")
                 file.write(chunk)
                 remaining -= len(chunk)
 
+        self.partial_download = None
+        return output_path
+
+    # 長さ 0 の終端フレームが届くまで受信し、その後の結果パケットで成否を確認する
+    def save_streamed_file(self, file_name, connection, frame_size=None):
+        output_path = os.path.join(self.dpath, file_name)
+        buffer = bytearray(frame_size or self.chunk_size)
+
+        with open(output_path, 'wb') as file:
+            while chunk := connection.recv_into(buffer):
+                file.write(chunk)
+
+        info, _ = self.parse_packet(connection.recv())
+        if info['error']:
+            raise Exception(f"サーバーエラー: {info['error_message']}")
+
         return output_path
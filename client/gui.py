@@ -8,6 +8,12 @@ import streamlit as st
 
 from client import TCPClient
 
+# 音声変換の出力形式ごとの MIME タイプ
+AUDIO_MIME_TYPES = {".mp3": "audio/mpeg", ".m4a": "audio/mp4", ".opus": "audio/ogg", ".flac": "audio/flac"}
+
+# サーバから進捗がこの秒数届かなければ、処理が止まっている可能性を表示する
+STALL_WARNING_SECONDS = 15
+
 
 class MediaRenderer:
     
@@ -33,8 +39,8 @@ class MediaRenderer:
 
     
     def show_converted(self, result_path, conversion_type_code):
-        # 圧縮・解像度変更・アスペクト比変更
-        if conversion_type_code in (1, 2, 3):
+        # 圧縮・解像度変更・アスペクト比変更・まとめて変換
+        if conversion_type_code in (1, 2, 3, 6):
             st.video(result_path)
         # 音声変換
         elif conversion_type_code == 4:
@@ -47,15 +53,15 @@ class MediaRenderer:
 
     # 変換後メディアをダウンロードできるボタンを表示
     def download_converted(self, result_path, conversion_type_code):
-        if conversion_type_code in (1, 2, 3): 
+        if conversion_type_code in (1, 2, 3, 6): 
             label = "変換後の動画をダウンロード"
             mime = "video/mp4"
         elif conversion_type_code == 4:  
             label = "変換後の音声をダウンロード"
-            mime = "audio/mpeg"
+            mime = AUDIO_MIME_TYPES.get(Path(result_path).suffix.lower(), "audio/mpeg")
         else: 
             label = "変換後のGIFをダウンロード"
-            mime = "image/gif"
+            mime = "image/webp" if Path(result_path).suffix.lower() == ".webp" else "image/gif"
     
         st.download_button(
             label=label,
@@ -69,10 +75,20 @@ class VideoConverter:
     
     def __init__(self, client):
         self.client = client
+        # サーバから届いた最新の進捗と、届いた時刻（変換処理のスレッドから更新される）
+        self.progress    = None
+        self.progress_at = None
+        self.client.progress_callback = self.receive_progress
+
+    def receive_progress(self, progress):
+        self.progress    = progress
+        self.progress_at = time.monotonic()
 
     def convert(self, uploaded_file_path, conversion_type_code, conversion_params, show_progress):
         # 進捗を0%で初期化（開始時）
-        show_progress(0)
+        self.progress    = None
+        self.progress_at = time.monotonic()
+        show_progress(0, "送信準備中...")
 
         with ThreadPoolExecutor() as executor:
             # アップロードおよび変換処理を別スレッドで開始
@@ -84,20 +100,43 @@ class VideoConverter:
             )
 
             percent = 0
-            # 処理が完了するまで定期的に進捗を報告（最大95%まで）
+            # 処理が完了するまで、サーバから届いた進捗を定期的に表示
             while not future.done():
                 time.sleep(0.2)  # 200ミリ秒ごとに進捗確認
-                percent = min(percent + 2, 95)  # 過剰に進まないよう上限を95%に制限
-                show_progress(percent)
+                percent, message = self.describe_progress(percent)
+                show_progress(percent, message)
 
             # 処理完了後、変換結果のファイルパスを取得
             converted_file_path = future.result()
 
         # 進捗を100%に更新（完了時）
-        show_progress(100)
+        show_progress(100, "変換完了")
 
         return converted_file_path
 
+    # 最新の進捗から、プログレスバーの割合と表示する文言を作る（割合が不明な間は前回の割合のまま）
+    def describe_progress(self, percent):
+        progress = self.progress
+        waiting  = time.monotonic() - self.progress_at
+        if progress is None:
+            message = "サーバの応答待ち..."
+        elif progress['stage'] == 'upload':
+            percent = int(progress['percent'])
+            message = f"アップロード中... {percent}%{self.format_eta(progress.get('eta'))}"
+        else:
+            if progress.get('percent') is not None:
+                percent = int(progress['percent'])
+            fps     = f"（{progress['fps']} fps）" if progress.get('fps') else ""
+            message = f"変換中... {percent}%{fps}{self.format_eta(progress.get('eta'))}"
+
+        if waiting >= STALL_WARNING_SECONDS:
+            message += f" ／ サーバから {int(waiting)} 秒応答がありません"
+        return percent, message
+
+    @staticmethod
+    def format_eta(eta):
+        return f" 残り約 {int(eta) + 1} 秒" if eta is not None else ""
+
 
 class StreamlitApp:
 
@@ -164,9 +203,9 @@ class StreamlitApp:
             status_text = st.empty()
 
             # 進捗表示の更新処理をローカル関数として定義
-            def show_progress(progress_percent):
+            def show_progress(progress_percent, message):
                 progress_bar.progress(progress_percent)
-                status_text.text(f"変換進行中... {progress_percent}%")
+                status_text.text(message)
 
             try:
                 # 実際の変換処理を非同期で実行し、変換後ファイルのパスを取得
@@ -182,13 +221,26 @@ class StreamlitApp:
                 return
 
             st.success("✅ 処理完了！")
+            # サーバで変換した場合は、エンコード速度と出力サイズを表示
+            self.show_encode_stats(self.converter.client.encode_stats)
             # 元のメディアと変換後メディアを並べて表示
             self.renderer.show_before_after(uploaded_file_path, converted_file_path, conversion_type_code)
             
+    def show_encode_stats(self, stats):
+        if not stats:
+            return
+        fps = f"{stats['fps']} fps" if stats.get('fps') else "-"
+        # 再エンコードせずにストリームのコピーで済ませた場合はその旨を表示
+        method = "再エンコードなし" if stats.get('method') == 'stream_copy' else "再エンコード"
+        st.caption(
+            f"プロファイル: {stats['profile']} ／ 処理: {method} ／ エンコード速度: {fps} ／ "
+            f"出力サイズ: {stats['output_size'] / 1024 / 1024:.1f} MB ／ 変換時間: {stats['elapsed']} 秒"
+        )
+
     def select_operation(self):
         option = st.selectbox(
             "変換オプションを選択",
-            ["圧縮", "解像度変更", "アスペクト比変更", "音声変換", "GIF作成"]
+            ["圧縮", "解像度変更", "アスペクト比変更", "まとめて変換", "音声変換", "GIF作成"]
         )
 
         if option == "圧縮":
@@ -209,15 +261,40 @@ class StreamlitApp:
                 "aspect_ratio": st.selectbox("アスペクト比", ["16/9", "4/3", "1/1"])
             }
 
+        elif option == "まとめて変換":
+            # 選んだ操作を 1 回のアップロード・1 回の変換でまとめて行う
+            code = 6
+            steps = st.multiselect(
+                "適用する変換（選んだ順に適用）",
+                ["圧縮", "解像度変更", "アスペクト比変更"],
+                default=["圧縮", "解像度変更"]
+            )
+            step_codes = {"圧縮": 1, "解像度変更": 2, "アスペクト比変更": 3}
+            details = {"operations": [step_codes[step] for step in steps]}
+
+            if "圧縮" in steps:
+                details["bitrate"] = st.selectbox("ビットレート", ["500k", "1M", "2M"])
+            if "解像度変更" in steps:
+                details["resolution"] = st.selectbox("解像度", ["1920:1080", "1280:720", "720:480"])
+            if "アスペクト比変更" in steps:
+                details["aspect_ratio"] = st.selectbox("アスペクト比", ["16/9", "4/3", "1/1"])
+
         elif option == "音声変換":
             code = 4
-            details = {}
+            # 元の音声と同じ形式を選ぶと、再エンコードせずにそのまま取り出せる（MP4 の AAC なら m4a）
+            details = {
+                "audio_format": st.selectbox("出力形式", ["mp3", "m4a", "opus", "flac"])
+            }
 
         else:  # GIF作成
             code = 5
             details = {
                 "start_time": st.text_input("開始時間 (秒)", ""),
-                "duration": st.text_input("継続時間 (秒)", "")
+                "duration": st.text_input("継続時間 (秒)", ""),
+                "width": st.selectbox("幅", [320, 480, 640]),
+                "fps": st.selectbox("フレームレート", [10, 15, 24]),
+                # WebP はフルカラーのまま、GIF より小さく保存できる
+                "animation_format": st.selectbox("形式", ["gif", "webp"])
             }
 
         return code, details
@@ -231,8 +308,8 @@ if __name__ == "__main__":
     server_port = 9001
     receive_dir = "receive"
 
-    # TCP クライアントを作成
-    tcp_client = TCPClient(server_address, server_port, receive_dir)
+    # TCP クライアントを作成（同じファイルの再アップロードは省く）
+    tcp_client = TCPClient(server_address, server_port, receive_dir, dedup=True)
 
     # 各コンポーネントを初期化（変換ロジック・メディア表示）
     converter = VideoConverter(tcp_client)
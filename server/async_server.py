@@ -0,0 +1,1071 @@
+import asyncio
+import hashlib
+import json
+import os
+import signal
+import time
+import traceback
+from datetime import datetime
+from pathlib import Path
+
+
+from job_queue import JOB_DONE, JOB_FAILED, JOB_QUEUED
+from metrics import MetricsRegistry, RequestMetrics
+from progress import FFMPEG_PROGRESS_ARGS, ProgressReporter
+from rate_limiter import RateLimitExceeded
+from server import (
+    LINGER_TIMEOUT, MAX_FRAME_SIZE, OPERATION_FANOUT, OPERATION_FETCH_JOB, OPERATION_HEALTH, STREAMING_FILE_SIZE,
+    RSAKeyPool, TCPServer, create_session_cipher, ffmpeg_error
+)
+from session_tickets import KEY_FLAG_TICKET, RESUME_FLAG, RESUME_NONCE_SIZE, derive_resumed_key
+
+
+
+class AsyncSecureSocket:
+
+    # StreamReader / StreamWriter と暗号化用の対称暗号オブジェクトを保存
+    def __init__(self, reader, writer, cipher):
+        self.reader = reader
+        self.writer = writer
+        self.cipher = cipher
+        # 送受信した平文のバイト数（リクエストごとの転送量の計測に使う）
+        self.bytes_sent     = 0
+        self.bytes_received = 0
+
+    # 指定されたバイト数を受信するまで待機（切断時は受信済みの分だけ返す）
+    async def recv_exact(self, n):
+        try:
+            return await self.reader.readexactly(n)
+        except asyncio.IncompleteReadError as error:
+            return error.partial
+
+    # 平文を暗号化し、長さ（4バイト）付きで送信（bytearray の memoryview もそのまま渡せる）
+    async def sendall(self, plaintext):
+        self.send_nowait(plaintext)
+        await self.writer.drain()
+
+    # 平文を暗号化して送信バッファに積む（drain を待たないため、同期的な呼び出し元からも使える）
+    # 長さと暗号文は連結せずに渡す。トランスポートは送り切れなかったデータを参照したまま保持することがあるため、
+    # 暗号文は呼び出し元が使い回すバッファには書き込まない
+    def send_nowait(self, plaintext):
+        encrypted = self.cipher.encrypt(plaintext)
+        self.writer.writelines((len(encrypted).to_bytes(4, 'big'), encrypted))
+        self.bytes_sent += len(encrypted)
+
+    async def recv(self):
+        # 最初の4バイトで受信データの長さを取得（上限を超えるフレームは拒否）
+        length = int.from_bytes(await self.recv_exact(4), 'big')
+        if length > MAX_FRAME_SIZE:
+            raise ValueError(f"Frame too large: {length} bytes")
+        # 指定バイト数のデータを受信し、復号して返す
+        encrypted_data = await self.recv_exact(length)
+        self.bytes_received += len(encrypted_data)
+        return self.cipher.decrypt(encrypted_data)
+
+
+class AsyncMediaProcessor:
+
+    # ffmpeg コマンドの組み立ては同期版の MediaProcessor に任せる
+    def __init__(self, processor):
+        self.processor = processor
+        self.dpath     = processor.dpath
+
+    # クライアントからファイルを受信し、保存
+    # offset が指定された場合は、受信済みの部分に続きを追記する
+    # progress が渡された場合は、受信済みのバイト数を通知する
+    async def save_file(self, connection, file_path, file_size, head=b'', hasher=None, offset=0, progress=None):
+        hasher = hasher or hashlib.sha256()
+        total  = file_size
+        if offset:
+            # 前回までに受信済みの部分は、ハッシュだけ計算し直す
+            await asyncio.to_thread(self.hash_existing, file_path, hasher)
+        file_size -= offset
+
+        # ファイルへの書き込みはイベントループを塞がないよう別スレッドで行い、
+        # 前のフレームを書き込んでいる間に次のフレームを受信する
+        f     = await asyncio.to_thread(open, file_path, 'ab' if offset else 'wb+')
+        write = None
+        try:
+            # 判定のために先読みしたフレームがあれば先に書き込む
+            write = asyncio.ensure_future(asyncio.to_thread(f.write, head))
+            file_size -= len(head)
+            hasher.update(head)
+
+            while file_size > 0:
+                chunk = await connection.recv()
+                if not chunk:
+                    break
+                await write
+                write = asyncio.ensure_future(asyncio.to_thread(f.write, chunk))
+                file_size -= len(chunk)
+                hasher.update(chunk)
+                if progress is not None:
+                    progress.upload(total - file_size, total)
+            await write
+        finally:
+            if write is not None:
+                await asyncio.gather(write, return_exceptions=True)
+            await asyncio.to_thread(f.close)
+
+    @staticmethod
+    def hash_existing(file_path, hasher):
+        with open(file_path, 'rb') as f:
+            while chunk := f.read(MAX_FRAME_SIZE):
+                hasher.update(chunk)
+
+    # アップロードを受信しながら ffmpeg の標準入力へ流し込み、受信と変換を並行させる
+    # progress が渡された場合は、受信しながら ffmpeg の進捗も並行して読み取る
+    async def pipe_file(self, connection, json_file, file_size, head=b'', hasher=None, progress=None):
+        stream, output_file_path = self.operation_stream(json_file, 'pipe:')
+        args    = stream.compile()
+        reader  = None
+        started = time.perf_counter()
+        if progress is not None:
+            args[1:1] = FFMPEG_PROGRESS_ARGS
+            process = await asyncio.create_subprocess_exec(
+                *args, stdin=asyncio.subprocess.PIPE, stdout=asyncio.subprocess.PIPE
+            )
+            reader  = asyncio.ensure_future(self.follow_progress(process.stdout, progress))
+        else:
+            process = await asyncio.create_subprocess_exec(*args, stdin=asyncio.subprocess.PIPE)
+
+        await self.feed_process(connection, process, file_size, head, hasher, progress)
+
+        returncode = await process.wait()
+        if reader is not None:
+            await reader
+        if returncode != 0:
+            raise ffmpeg_error(returncode)
+        await asyncio.to_thread(self.processor.record_encode_stats, output_file_path, time.perf_counter() - started)
+        return output_file_path
+
+    # 受信したフレームを ffmpeg の標準入力へ書き込み、最後に入力を閉じる
+    @staticmethod
+    async def feed_process(connection, process, file_size, head=b'', hasher=None, progress=None):
+        hasher = hasher or hashlib.sha256()
+        total  = file_size
+        try:
+            process.stdin.write(head)
+            file_size -= len(head)
+            hasher.update(head)
+
+            while file_size > 0:
+                chunk = await connection.recv()
+                if not chunk:
+                    break
+                process.stdin.write(chunk)
+                await process.stdin.drain()
+                file_size -= len(chunk)
+                hasher.update(chunk)
+                if progress is not None:
+                    progress.upload(total - file_size, total)
+        except (BrokenPipeError, ConnectionResetError):
+            # ffmpeg が入力を読み終える前に終了した（成否は終了コードで判定する）
+            pass
+        finally:
+            process.stdin.close()
+
+    # 出力先を標準出力に差し替えた ffmpeg を起動する（出力形式が未対応なら None）
+    async def start_streaming(self, stream, output_file_path, pipe_stdin=False):
+        args = self.processor.streaming_args(stream, output_file_path)
+        if args is None:
+            return None
+        return await asyncio.create_subprocess_exec(
+            *args, stdin=asyncio.subprocess.PIPE if pipe_stdin else None, stdout=asyncio.subprocess.PIPE
+        )
+
+    # 操作が標準入力からの変換に対応しているか／標準入力で渡せるコンテナか
+    def supports_pipe(self, operation):
+        return self.processor.supports_pipe(operation)
+
+    def is_pipeable(self, media_type, head):
+        return self.processor.is_pipeable(media_type, head)
+
+    # 操作コードに対応する ffmpeg コマンドと出力先を返す
+    def operation_stream(self, json_file, input_file_path):
+        return self.processor.operation_stream(json_file, input_file_path)
+
+    # ファンアウト要求を出力ごとの操作要求に分ける
+    def fan_out_requests(self, json_file):
+        return self.processor.fan_out_requests(json_file)
+
+    # 複数出力の作成は同期版に任せ、イベントループを塞がないよう別スレッドで実行する
+    async def fan_out(self, renditions, input_file_path, content_hash=None, progress=None):
+        return await asyncio.to_thread(self.processor.fan_out, renditions, input_file_path, content_hash, progress)
+
+    # 要求のパラメータの検証（ffmpeg のコマンドを組み立てるだけのため、そのまま呼ぶ）
+    def validate_request(self, json_file):
+        self.processor.validate_request(json_file)
+
+    # 先頭フレームの解析は ffprobe を起動するため、別スレッドで行う
+    async def check_head(self, json_file, media_type, head):
+        await asyncio.to_thread(self.processor.check_head, json_file, media_type, head)
+
+    # 操作を実行して出力先を返す。長い動画の分割変換・2 パス符号化・パレットを使い回す GIF 作成は
+    # 同期版に任せ、別スレッドで実行する
+    # 要求の検証と変換経路の判断に使う入力の解析も、イベントループを塞がないよう別スレッドで行う
+    # progress が渡された場合は、ffmpeg の進捗を出力する長さに対する割合で通知する
+    async def run_operation(self, json_file, input_file_path, progress=None):
+        started  = time.perf_counter()
+        stream, output_file_path = self.operation_stream(json_file, input_file_path)
+        probe    = await asyncio.to_thread(self.processor.inspect_input, json_file, input_file_path)
+        copy     = self.processor.copy_stream(json_file, input_file_path, output_file_path, probe)
+        duration = self.processor.output_duration(json_file, probe)
+
+        if copy is not None:
+            await self.run_stream(copy, input_file_path, output_file_path, progress, duration)
+        elif self.processor.uses_palette_file(json_file):
+            await asyncio.to_thread(
+                self.processor.run_gif, json_file, input_file_path, output_file_path, progress, duration
+            )
+        elif self.processor.uses_two_pass(json_file, output_file_path):
+            await asyncio.to_thread(
+                self.processor.run_two_pass, json_file, input_file_path, output_file_path, progress, duration
+            )
+        elif self.processor.uses_segments(json_file, probe):
+            await asyncio.to_thread(
+                self.processor.run_segmented, json_file, input_file_path, output_file_path, probe, progress
+            )
+        else:
+            await self.run_stream(stream, input_file_path, output_file_path, progress, duration)
+
+        method = 'stream_copy' if copy is not None else 'transcode'
+        await asyncio.to_thread(
+            self.processor.record_encode_stats, output_file_path, time.perf_counter() - started, method
+        )
+        return output_file_path
+
+    # 記録したエンコード速度・出力サイズを取り出す
+    def pop_encode_stats(self, output_file_path):
+        return self.processor.pop_encode_stats(output_file_path)
+
+    # ffmpeg を子プロセスとして非同期に実行し、入力ファイルを削除して出力先を返す
+    # progress が渡された場合は -progress の出力を読みながら、duration に対する進捗を通知する
+    async def run_stream(self, stream, input_file_path, output_file_path, progress=None, duration=None):
+        args = stream.compile()
+        if progress is None:
+            process = await asyncio.create_subprocess_exec(*args)
+        else:
+            if duration is not None:
+                progress.expect(0, duration)
+            args[1:1] = FFMPEG_PROGRESS_ARGS
+            process = await asyncio.create_subprocess_exec(*args, stdout=asyncio.subprocess.PIPE)
+            await self.follow_progress(process.stdout, progress)
+
+        returncode = await process.wait()
+        if returncode != 0:
+            raise ffmpeg_error(returncode)
+        await asyncio.to_thread(os.remove, input_file_path)
+        return output_file_path
+
+    # ffmpeg の -progress の出力を終わりまで読み、1 行ずつ進捗に渡す
+    @staticmethod
+    async def follow_progress(stdout, progress, task=0):
+        async for line in stdout:
+            progress.feed(task, line)
+
+
+class AsyncTCPServer:
+
+    def __init__(self, server_address, server_port, processor, max_transcodes=None, key_pool=None,
+                 pipe_uploads=False, result_cache=None, input_store=None, job_queue=None, remote_workers=None,
+                 session_tickets=None, session_idle_timeout=30.0, metrics_registry=None, rate_limiter=None):
+        self.server_address = server_address
+        self.server_port    = server_port
+
+        self.processor      = AsyncMediaProcessor(processor)
+        self.chunk_size     = 1400
+        self.key_pool       = key_pool or RSAKeyPool()
+        self.pipe_uploads   = pipe_uploads
+        self.result_cache   = result_cache
+        self.input_store    = input_store
+        self.job_queue      = job_queue
+        self.remote_workers = remote_workers
+        # 受信中の再開可能なアップロード（同じ ID への同時書き込みを防ぐ）
+        self.uploads        = set()
+        self.session_tickets      = session_tickets
+        self.session_idle_timeout = session_idle_timeout
+        # リクエストの段階ごとの処理時間・転送量の集計（メトリクスのエンドポイントで公開する）
+        self.metrics_registry     = metrics_registry or MetricsRegistry()
+        # クライアントごとのリクエスト数・転送量・同時に行う変換の数の制限（None で無効）
+        self.rate_limiter         = rate_limiter
+
+        # 接続数は制限せず、CPU を使う ffmpeg の同時実行数だけを制限する
+        self.max_transcodes = max_transcodes or os.cpu_count() or 1
+        self.transcodes     = asyncio.Semaphore(self.max_transcodes)
+        self.clients        = set()
+        self.stop_event     = None
+        self.loop           = None
+
+    async def start_server(self):
+        self.loop       = asyncio.get_running_loop()
+        self.stop_event = asyncio.Event()
+
+        server = await asyncio.start_server(
+            self.accept_client, self.server_address, self.server_port, reuse_address=True
+        )
+
+        async with server:
+            await self.stop_event.wait()
+
+        # 新規受付を止めた後、処理中の接続が完了するまで待つ
+        if self.clients:
+            await asyncio.gather(*self.clients, return_exceptions=True)
+        self.key_pool.close()
+
+    # 新規接続の受付を停止する（別スレッドやシグナルハンドラからも呼び出し可能）
+    def shutdown(self):
+        if self.loop is not None:
+            self.loop.call_soon_threadsafe(self.stop_event.set)
+
+    # 接続ごとのタスクを記録し、終了時に待てるようにする
+    async def accept_client(self, reader, writer):
+        task = asyncio.current_task()
+        self.clients.add(task)
+        try:
+            await self.handle_client(reader, writer)
+        except Exception:
+            traceback.print_exc()
+        finally:
+            self.clients.discard(task)
+
+    # 1 接続を処理する。keep_alive が指定されている間は、同じ暗号化チャネルで次のリクエストを続けて処理する
+    async def handle_client(self, reader, writer):
+        secure_conn = None
+        client_ip   = writer.get_extra_info('peername')[0]
+
+        try:
+            # 鍵交換を実行（RSA公開鍵交換 → AES鍵受信、またはチケットによるセッション再開）
+            request_metrics = RequestMetrics()
+            with request_metrics.stage('key_exchange'):
+                secure_conn = await self.perform_key_exchange(reader, writer)
+
+            # 鍵交換の時間は、接続の最初のリクエストに記録する
+            packet = await secure_conn.recv()
+            while await self.handle_request(secure_conn, packet, client_ip, request_metrics):
+                packet = await self.wait_next_request(secure_conn)
+                if packet is None:
+                    break
+                request_metrics = RequestMetrics()
+
+        except Exception as e:
+            # エラー時も可能であれば暗号化チャネルで応答（応答後はセッションを終える）
+            await self.send_error_response(secure_conn, writer, str(e), getattr(e, 'details', None))
+            await self.linger_close(reader, writer)
+            raise
+
+        finally:
+            writer.close()
+
+    # 受信したリクエストを 1 つ処理し、同じ接続で次のリクエストを受け付けるかを返す
+    # 段階ごとの処理時間・転送量・ffmpeg の終了コードは request_metrics に集め、終了時にログと集計へ記録する
+    async def handle_request(self, secure_conn, packet, client_ip, request_metrics=None):
+        start_time = datetime.utcnow().isoformat()
+        log_vals   = {
+            'operation'   : None,
+            'file_name'   : None,
+            'file_size'   : None,
+            'media_type'  : None,
+        }
+        log_id     = None
+        admitted   = None
+        work_files = None
+        request_metrics = request_metrics or RequestMetrics()
+        request_metrics.begin(secure_conn, len(packet))
+
+        try:
+            # リクエスト（ヘッダー＋ボディ）を解析
+            request   = TCPServer.parse_packet(packet)
+            json_file = request['json_file']
+            request['metrics'] = request_metrics
+
+            # coordinator からの死活監視には、ログを残さず負荷だけを返す
+            if json_file['operation'] == OPERATION_HEALTH:
+                await self.send_health(secure_conn, len(self.clients) - 1, self.max_transcodes)
+                return False
+
+            # 1 つのクライアントが帯域や ffmpeg を占有しないよう、制限を超えたリクエストは本体を受信する前に拒否する
+            admitted = self.admit_request(client_ip, request)
+
+            # ログ用の詳細情報を格納
+            log_vals.update({
+                'operation'  : json_file['operation'],
+                'file_name'  : json_file['file_name'],
+                'file_size'  : request['file_size'],
+                'media_type' : request['media_type'],
+            })
+
+            # 同時接続でファイル名が衝突しないよう、リクエストごとに一意な作業名を付与
+            request_token, work_json = TCPServer.assign_work_name(json_file)
+
+            input_file_path  = os.path.join(self.processor.dpath, work_json['file_name'])
+            frame_size       = TCPServer.negotiate_frame_size(json_file, self.chunk_size)
+
+            if json_file['operation'] == OPERATION_FETCH_JOB:
+                # キューに積んだジョブの状態を返し、完了していれば結果を送る（中断したダウンロードは続きから）
+                # 状態の問い合わせはジョブ 1 つにつき毎秒届くため、結果か失敗を返したときだけログに残す
+                polling = False
+                try:
+                    with request_metrics.stage('send'):
+                        polling = await self.send_job_result(secure_conn, json_file.get('job_id'), frame_size,
+                                                             json_file.get('download_offset', 0))
+                finally:
+                    if not polling:
+                        log_id = TCPServer.write_log_start(start_time, client_ip, log_vals)
+                return json_file.get('keep_alive', False)
+
+            # ログ開始を記録（受信と変換が並行する場合があるため、受信前に記録する）
+            # ログは書き込みスレッドのキューに積むだけのため、イベントループを止めない
+            log_id = TCPServer.write_log_start(start_time, client_ip, log_vals)
+
+            # 不正なパラメータは、ファイル本体を受信する前に拒否する
+            self.processor.validate_request(work_json)
+            # 応答を送り終えたら（失敗した場合も）削除する作業用ファイル
+            work_files = TCPServer.work_files(self.processor.processor, work_json, input_file_path)
+
+            # クライアントが要求していれば、受信と変換の進捗を応答の前に送る
+            progress = self.progress_reporter(secure_conn, json_file)
+
+            if json_file.get('async_job'):
+                # 受信だけを行ってジョブをキューに積み、変換を待たずにジョブ ID を返す
+                await self.receive_and_enqueue(
+                    secure_conn, work_json, request, input_file_path, request_token, progress
+                )
+                return json_file.get('keep_alive', False)
+
+            # 内容ハッシュが届いた場合は、保持済みの入力・変換結果を探してアップロードの要否を返答
+            output_file_path = None
+            if json_file.get('content_hash'):
+                output_file_path = await self.offer_known_content(secure_conn, work_json, request, input_file_path)
+
+            if json_file['operation'] == OPERATION_FANOUT:
+                # 1 回のアップロードから複数の出力を作り、同じ接続でまとめて返す
+                output_file_paths = await self.receive_and_fan_out(
+                    secure_conn, work_json, request, input_file_path, progress
+                )
+                with request_metrics.stage('send'):
+                    await self.send_file_set(secure_conn, output_file_paths, request_token, frame_size)
+                return json_file.get('keep_alive', False)
+
+            if output_file_path is None and json_file.get('stream_response'):
+                # 変換しながら、出力を生成された順にクライアントへ送る
+                await self.receive_and_stream(secure_conn, work_json, request, input_file_path, request_token,
+                                              frame_size)
+                return json_file.get('keep_alive', False)
+
+            if output_file_path is None:
+                # ファイルを受信して指定された操作を実行（圧縮・変換など）
+                output_file_path = await self.receive_and_process(
+                    secure_conn, work_json, request, input_file_path, progress
+                )
+
+            # 処理結果ファイルをクライアントに送信（作業名は取り除いて返す。中断したダウンロードは続きから）
+            response_name = TCPServer.strip_work_name(output_file_path, request_token)
+            with request_metrics.stage('send'):
+                await self.send_file(secure_conn, output_file_path, response_name, frame_size,
+                                     json_file.get('download_offset', 0))
+
+            return json_file.get('keep_alive', False)
+
+        except Exception as e:
+            request_metrics.fail(e)
+            if isinstance(e, RateLimitExceeded):
+                self.metrics_registry.observe_rejection(e.limit)
+            raise
+
+        finally:
+            # キューに積んだジョブの入力は、ワーカーが変換を終えるまで残す
+            if work_files is not None and not request.get('job_submitted'):
+                await asyncio.to_thread(TCPServer.remove_files, work_files)
+            # 送らずに終わった（失敗した）出力のエンコード速度の記録は、応答に使われないまま残るため捨てる
+            for path in work_files or ():
+                self.processor.pop_encode_stats(path)
+            end_time = datetime.utcnow().isoformat()
+            request_metrics.end(secure_conn)
+            self.release_request(client_ip, admitted, request_metrics)
+            TCPServer.write_log_end(log_id, end_time, request_metrics)
+            if log_id is not None:
+                self.metrics_registry.observe(log_vals['operation'], request_metrics)
+
+    # クライアントごとの制限を確認し、超えていれば RateLimitExceeded を送出する（TCPServer.admit_request と同じ）
+    def admit_request(self, client_ip, request):
+        # ジョブの状態の問い合わせは、アップロードも変換もしないため数えない（ジョブ 1 つにつき毎秒届く）
+        if self.rate_limiter is None or request['json_file']['operation'] == OPERATION_FETCH_JOB:
+            return None
+        transcode = TCPServer.uses_transcode_slot(request['json_file'])
+        self.rate_limiter.admit(client_ip, request['file_size'], transcode)
+        return request['file_size'], transcode
+
+    # 変換の枠を返し、前借りした転送量のうち受信しなかった分を返す
+    def release_request(self, client_ip, admitted, request_metrics):
+        if admitted is None:
+            return
+        file_size, transcode = admitted
+        self.rate_limiter.release(client_ip, transcode, file_size - request_metrics.bytes_in)
+
+    # keep_alive のセッションで次のリクエストを受信する（切断・待ち時間切れ・停止要求なら None）
+    async def wait_next_request(self, connection):
+        receive = asyncio.ensure_future(connection.recv())
+        stop    = asyncio.ensure_future(self.stop_event.wait())
+
+        done, _ = await asyncio.wait(
+            {receive, stop}, timeout=self.session_idle_timeout, return_when=asyncio.FIRST_COMPLETED
+        )
+        stop.cancel()
+        if receive not in done:
+            receive.cancel()
+            return None
+        return receive.result() or None
+
+    async def perform_key_exchange(self, reader, writer):
+        loop = asyncio.get_running_loop()
+
+        # プールが空だと鍵生成で CPU を占有するため、イベントループの外で取得
+        key_manager = await loop.run_in_executor(None, self.key_pool.acquire)
+
+        # 自身の公開鍵をクライアントに送信（長さ 2 バイト + 本体）
+        public_key_bytes = key_manager.public_key_bytes()
+        writer.write(len(public_key_bytes).to_bytes(2, 'big') + public_key_bytes)
+        await writer.drain()
+
+        # クライアントから暗号化された AES 鍵＋IV を受信
+        encrypted_key_size = int.from_bytes(await reader.readexactly(2), 'big')
+
+        # 最上位ビットが立っていればチケットによる再開要求。受理できなければ続けて通常の鍵交換を受ける
+        if encrypted_key_size & RESUME_FLAG:
+            hello         = await reader.readexactly(encrypted_key_size & ~RESUME_FLAG)
+            secure_socket = await self.resume_session(reader, writer, hello)
+            if secure_socket is not None:
+                self.key_pool.release(key_manager)
+                return secure_socket
+            encrypted_key_size = int.from_bytes(await reader.readexactly(2), 'big')
+
+        encrypted_key_iv   = await reader.readexactly(encrypted_key_size)
+
+        # 秘密鍵で復号して AES 鍵・IV・暗号モード・フラグを取得
+        aes_key, aes_iv, cipher_mode, flags = await loop.run_in_executor(
+            None, key_manager.decrypt_symmetric_key, encrypted_key_iv
+        )
+
+        # AES 暗号オブジェクトを作成し、暗号化ストリームでラップ
+        cipher        = create_session_cipher(aes_key, aes_iv, cipher_mode)
+        secure_socket = AsyncSecureSocket(reader, writer, cipher)
+
+        # 要求があれば、次回の接続で鍵交換を省くためのチケットを送る
+        if flags & KEY_FLAG_TICKET:
+            json_data = TCPServer.ticket_response(self.session_tickets, aes_key, aes_iv)
+            await secure_socket.sendall(TCPServer.build_packet(json.dumps(json_data).encode('utf-8'), b'', 0))
+
+        return secure_socket
+
+    # チケットによる再開要求を検証し、再開したセッションを返す（拒否した場合は None）
+    async def resume_session(self, reader, writer, hello):
+        resumed = TCPServer.lookup_ticket(self.session_tickets, hello)
+        if resumed is None:
+            writer.write(b'\x00')
+            await writer.drain()
+            return None
+
+        secret, client_nonce, cipher_mode = resumed
+        server_nonce    = os.urandom(RESUME_NONCE_SIZE)
+        writer.write(b'\x01' + server_nonce)
+        await writer.drain()
+
+        aes_key, aes_iv = derive_resumed_key(secret, client_nonce, server_nonce)
+        return AsyncSecureSocket(reader, writer, create_session_cipher(aes_key, aes_iv, cipher_mode))
+
+    # クライアントが送った内容ハッシュから、保持済みの変換結果・入力ファイルを探して返答する
+    # 保持済みの内容は、ファイルを持っていることを証明できたクライアントにだけ使わせる（TCPServer と同じ）
+    async def offer_known_content(self, connection, json_file, request, input_file_path):
+        content_hash     = json_file['content_hash']
+        cached_file_path = None
+        have_input       = False
+
+        if (json_file.get('possession_proof') and self.input_store is not None
+                and await asyncio.to_thread(self.input_store.fetch, content_hash, input_file_path)):
+            have_input = await self.verify_possession(connection, input_file_path, request['file_size'])
+            # 復元した入力は保持中のファイルへのリンクのため、アップロードで上書きされる前に外す
+            if not have_input:
+                await asyncio.to_thread(os.remove, input_file_path)
+
+        # ファンアウトは出力ごとにキャッシュを引くため、ここでは入力の有無だけを返す
+        if have_input and json_file['operation'] != OPERATION_FANOUT:
+            cached_file_path = await self.fetch_cached_result(content_hash, request, json_file, input_file_path)
+        request['input_restored'] = have_input and cached_file_path is None
+        # アップロードを省く場合、再試行前に受信していた途中のファイルはもう使わない
+        if have_input and json_file.get('upload_id'):
+            partial_path = TCPServer.partial_upload_path(self.processor.dpath, json_file['upload_id'], request['media_type'])
+            await asyncio.to_thread(TCPServer.remove_files, [partial_path])
+
+        reply = {
+            'error'         : False,
+            'error_message' : None,
+            'have_result'   : cached_file_path is not None,
+            'have_input'    : have_input,
+        }
+        await connection.sendall(TCPServer.build_packet(json.dumps(reply).encode('utf-8'), b'', 0))
+        return cached_file_path
+
+    # 保持している入力のどの範囲を読ませるかを送り、クライアントが返した証明と照合する
+    async def verify_possession(self, connection, input_file_path, file_size):
+        challenge = TCPServer.possession_challenge(file_size)
+        json_data = {'error': False, 'error_message': None, 'challenge': challenge}
+        await connection.sendall(TCPServer.build_packet(json.dumps(json_data).encode('utf-8'), b'', 0))
+
+        proof = TCPServer.parse_packet(await connection.recv())['json_file'].get('proof')
+        return await asyncio.to_thread(TCPServer.check_possession, input_file_path, file_size, challenge, proof)
+
+    # 入力を受信し、(先読みしたフレーム, 内容ハッシュ) を返す
+    # ffmpeg に直接流し込める場合は先頭フレームだけを返し、ハッシュは流し込みの完了後に確定する
+    async def receive_input(self, connection, json_file, request, input_file_path, hasher, allow_pipe=True,
+                            progress=None):
+        file_size  = request['file_size']
+        media_type = request['media_type']
+
+        # 重複アップロードとして保持済みの入力を復元した場合は受信しない
+        if request.get('input_restored'):
+            return None, json_file['content_hash']
+
+        pipeable = self.pipe_uploads and allow_pipe and self.processor.supports_pipe(json_file['operation'])
+        with request['metrics'].stage('receive'):
+            if json_file.get('upload_id'):
+                # 再開可能なアップロードは、前回までに受信した位置から続きを受信する
+                await self.receive_resumable(connection, json_file, request, input_file_path, hasher, progress)
+            elif file_size > 0:
+                # 先頭フレームを先読みしてコンテナのヘッダーから要求を検証し、不正なら残りを受信せずに拒否する
+                head = await connection.recv()
+                await self.processor.check_head(json_file, media_type, head)
+                # 標準入力で渡せるコンテナであれば、保存せずに ffmpeg へ流し込む（残りの受信は変換の段階に含める）
+                if pipeable and self.processor.is_pipeable(media_type, head):
+                    return head, None
+                await self.processor.save_file(
+                    connection, input_file_path, file_size, head, hasher, progress=progress
+                )
+            else:
+                await self.processor.save_file(connection, input_file_path, file_size, hasher=hasher)
+
+        content_hash = hasher.hexdigest()
+        if json_file.get('content_hash') not in (None, content_hash):
+            await asyncio.to_thread(os.remove, input_file_path)
+            raise ValueError("Uploaded content does not match content_hash")
+        # 変換側で入力の解析結果を索引から引けるよう、確定した内容ハッシュを記録
+        json_file['content_hash'] = content_hash
+
+        # 次回以降のアップロードを省けるよう、変換前の入力を保持しておく
+        if self.input_store is not None:
+            await asyncio.to_thread(self.input_store.store, content_hash, input_file_path)
+
+        return None, content_hash
+
+    # 受信途中のファイルをアップロード ID ごとに保存し、受信済みのバイト数を返答してから続きを受信する
+    async def receive_resumable(self, connection, json_file, request, input_file_path, hasher, progress=None):
+        upload_id    = json_file['upload_id']
+        partial_path = TCPServer.partial_upload_path(self.processor.dpath, upload_id, request['media_type'])
+        file_size    = request['file_size']
+
+        if upload_id in self.uploads:
+            raise ValueError(f"Upload {upload_id} is already in progress")
+        self.uploads.add(upload_id)
+
+        try:
+            offset = os.path.getsize(partial_path) if os.path.exists(partial_path) else 0
+            if offset > file_size:
+                offset = 0
+
+            reply = {'error': False, 'error_message': None, 'offset': offset}
+            await connection.sendall(TCPServer.build_packet(json.dumps(reply).encode('utf-8'), b'', 0))
+
+            # 最初から受信する場合は、先頭フレームで要求を検証してから残りを受信する
+            head = b''
+            if offset == 0 and file_size > 0:
+                head = await connection.recv()
+                await self.processor.check_head(json_file, request['media_type'], head)
+
+            await self.processor.save_file(connection, partial_path, file_size, head, hasher, offset, progress)
+            if os.path.getsize(partial_path) < file_size:
+                raise ConnectionError(f"Upload {upload_id} interrupted")
+            os.replace(partial_path, input_file_path)
+        finally:
+            self.uploads.discard(upload_id)
+
+    # ファイルを受信して変換する。可能な場合はファイルに保存せず ffmpeg に直接流し込む
+    async def receive_and_process(self, connection, json_file, request, input_file_path, progress=None):
+        hasher = hashlib.sha256()
+        head, content_hash = await self.receive_input(
+            connection, json_file, request, input_file_path, hasher, progress=progress
+        )
+
+        # 変換の段階には、ffmpeg の同時実行数の上限による待ち時間も含む
+        if head is not None:
+            with request['metrics'].transcode():
+                async with self.transcodes:
+                    output_file_path = await self.processor.pipe_file(
+                        connection, json_file, request['file_size'], head, hasher, progress
+                    )
+            await self.store_result(hasher.hexdigest(), request, json_file, output_file_path)
+            return output_file_path
+
+        # 同じ入力・同じパラメータの変換結果があれば ffmpeg を実行しない
+        cached_file_path = await self.fetch_cached_result(content_hash, request, json_file, input_file_path)
+        if cached_file_path is not None:
+            return cached_file_path
+
+        with request['metrics'].transcode():
+            output_file_path = await self.operation_dispatcher(json_file, input_file_path, progress)
+        await self.store_result(content_hash, request, json_file, output_file_path)
+        return output_file_path
+
+    # ファイルを受信して変換しながら、ffmpeg の出力をそのままクライアントへ送る（TCPServer.receive_and_stream と同じ）
+    # 変換と送信が並行するため、出力を送り終えるまでを変換の段階として計測する
+    async def receive_and_stream(self, connection, json_file, request, input_file_path, request_token, frame_size):
+        hasher    = hashlib.sha256()
+        metrics   = request['metrics']
+        processor = self.processor.processor
+        head, content_hash = await self.receive_input(connection, json_file, request, input_file_path, hasher)
+        source = 'pipe:' if head is not None else input_file_path
+
+        # キャッシュにあれば変換せず、完成済みのファイルを通常の応答で送る
+        output_file_path = None
+        if head is None:
+            output_file_path = await self.fetch_cached_result(content_hash, request, json_file, input_file_path)
+
+        if output_file_path is None:
+            stream, output_file_path = self.processor.operation_stream(json_file, source)
+            # パレットをファイルとして扱う GIF は、パレットを作り終えるまで出力が始まらないためストリーミングしない
+            palette_file = head is None and processor.uses_palette_file(json_file)
+            if head is None:
+                probe  = await asyncio.to_thread(processor.inspect_input, json_file, input_file_path)
+                stream = processor.copy_stream(json_file, input_file_path, output_file_path, probe) or stream
+
+            # ffmpeg の同時実行数を制限して CPU の過負荷を防ぐ
+            with metrics.transcode():
+                async with self.transcodes:
+                    process = None if palette_file else await self.processor.start_streaming(
+                        stream, output_file_path, pipe_stdin=head is not None
+                    )
+                    if process is not None:
+                        await self.stream_process(connection, request, process, input_file_path, head, hasher,
+                                                  output_file_path, request_token, frame_size)
+                        await self.store_result(content_hash or hasher.hexdigest(), request, json_file,
+                                                output_file_path)
+                        return output_file_path
+
+                    # 標準出力に書き出せない形式の場合は、変換完了後に通常の応答で送る
+                    if head is not None:
+                        output_file_path = await self.processor.pipe_file(
+                            connection, json_file, request['file_size'], head, hasher
+                        )
+                    else:
+                        output_file_path = await self.processor.run_operation(json_file, input_file_path)
+            await self.store_result(content_hash or hasher.hexdigest(), request, json_file, output_file_path)
+
+        response_name = TCPServer.strip_work_name(output_file_path, request_token)
+        with metrics.stage('send'):
+            await self.send_file(connection, output_file_path, response_name, frame_size,
+                                 json_file.get('download_offset', 0))
+        return output_file_path
+
+    # 起動した ffmpeg の出力を送り、入力を標準入力で渡す場合は受信と流し込みを並行して行う
+    async def stream_process(self, connection, request, process, input_file_path, head, hasher, output_file_path,
+                             request_token, frame_size):
+        feeder = None
+        if head is not None:
+            feeder = asyncio.ensure_future(
+                self.processor.feed_process(connection, process, request['file_size'], head, hasher)
+            )
+
+        try:
+            response_name = TCPServer.strip_work_name(output_file_path, request_token)
+            await self.send_streaming_file(connection, process, output_file_path, response_name, frame_size)
+        except BaseException:
+            # 送信に失敗した場合は、残りの受信を待たずに流し込みを止める
+            if feeder is not None:
+                feeder.cancel()
+            raise
+        finally:
+            if feeder is not None:
+                await asyncio.gather(feeder, return_exceptions=True)
+            elif os.path.exists(input_file_path):
+                await asyncio.to_thread(os.remove, input_file_path)
+
+    # ファイルを受信し、要求された複数の出力を作成して出力先の一覧を返す
+    async def receive_and_fan_out(self, connection, json_file, request, input_file_path, progress=None):
+        hasher = hashlib.sha256()
+        _, content_hash = await self.receive_input(
+            connection, json_file, request, input_file_path, hasher, progress=progress
+        )
+        renditions = self.processor.fan_out_requests(json_file)
+
+        output_file_paths = [
+            await self.fetch_cached_result(content_hash, request, rendition, None) for rendition in renditions
+        ]
+        pending = [index for index, path in enumerate(output_file_paths) if path is None]
+
+        if not pending:
+            await asyncio.to_thread(os.remove, input_file_path)
+            return output_file_paths
+
+        # ffmpeg の同時実行数を制限して CPU の過負荷を防ぐ
+        with request['metrics'].transcode():
+            async with self.transcodes:
+                created = await self.processor.fan_out(
+                    [renditions[index] for index in pending], input_file_path, content_hash, progress
+                )
+        for index, output_file_path in zip(pending, created):
+            output_file_paths[index] = output_file_path
+            await self.store_result(content_hash, request, renditions[index], output_file_path)
+        return output_file_paths
+
+    # ファイルを受信してジョブとしてキューに積み、ジョブ ID（作業用トークン）を返す
+    async def receive_and_enqueue(self, connection, json_file, request, input_file_path, request_token,
+                                  progress=None):
+        if self.job_queue is None:
+            raise ValueError("Job queue is disabled")
+
+        await self.receive_input(
+            connection, json_file, request, input_file_path, hashlib.sha256(), allow_pipe=False, progress=progress
+        )
+        await asyncio.to_thread(self.job_queue.submit, request_token, json_file, input_file_path)
+        request['job_submitted'] = True
+        await self.send_job_status(connection, request_token, JOB_QUEUED)
+
+    # ジョブの状態を返し、完了していれば出力ファイルを送る（まだ終わっておらず、状態だけを返した場合は True）
+    async def send_job_result(self, connection, job_id, frame_size, offset=0):
+        job = None
+        if self.job_queue is not None and job_id:
+            job = await asyncio.to_thread(self.job_queue.get, job_id)
+        if job is None:
+            raise ValueError(f"Unknown job: {job_id}")
+
+        if job['status'] == JOB_FAILED:
+            await self.send_error_response(connection, None, job['error_message'])
+
+        elif job['status'] != JOB_DONE:
+            await self.send_job_status(connection, job_id, job['status'], job['progress'])
+            return True
+
+        elif job['json_file']['operation'] == OPERATION_FANOUT:
+            await self.send_file_set(connection, job['output_paths'], job_id, frame_size)
+
+        else:
+            output_file_path = job['output_paths'][0]
+            response_name    = TCPServer.strip_work_name(output_file_path, job_id)
+            await self.send_file(connection, output_file_path, response_name, frame_size, offset)
+        return False
+
+    # 死活監視への応答として、処理中の接続数と同時処理数を送る
+    async def send_health(self, connection, load, capacity):
+        json_data = {
+            'error'         : False,
+            'error_message' : None,
+            'load'          : load,
+            'capacity'      : capacity,
+        }
+        await connection.sendall(TCPServer.build_packet(json.dumps(json_data).encode('utf-8'), b'', 0))
+
+    # ジョブ ID と状態だけを送る（ファイル本体は含まない）
+    # 実行中のジョブは、ワーカーが最後に記録した変換の進捗も返す
+    async def send_job_status(self, connection, job_id, status, progress=None):
+        json_data = {
+            'error'         : False,
+            'error_message' : None,
+            'job_id'        : job_id,
+            'status'        : status,
+        }
+        if progress is not None:
+            json_data['job_progress'] = progress
+        await connection.sendall(TCPServer.build_packet(json.dumps(json_data).encode('utf-8'), b'', 0))
+
+    # キャッシュにある変換結果を本来の出力先に用意して返す（ヒットしなければ None）
+    # リンクできない場合のコピーや追い出しのファイル操作でイベントループを塞がないよう、別スレッドで行う
+    async def fetch_cached_result(self, content_hash, request, json_file, input_file_path):
+        if self.result_cache is None:
+            return None
+
+        cache_key = self.result_cache.make_key(content_hash, request['media_type'], json_file)
+        _, output_file_path = self.processor.operation_stream(json_file, input_file_path or 'pipe:')
+        if not await asyncio.to_thread(self.result_cache.fetch, cache_key, output_file_path):
+            return None
+
+        if input_file_path is not None:
+            await asyncio.to_thread(TCPServer.remove_files, [input_file_path])
+        return output_file_path
+
+    # 変換結果を入力のハッシュと変換パラメータをキーにキャッシュへ登録（別スレッドで行う）
+    async def store_result(self, content_hash, request, json_file, output_file_path):
+        if self.result_cache is None:
+            return
+
+        cache_key = self.result_cache.make_key(content_hash, request['media_type'], json_file)
+        await asyncio.to_thread(self.result_cache.store, cache_key, output_file_path)
+
+    async def operation_dispatcher(self, json_file, input_file_path, progress=None):
+        # 分散ワーカーが設定されていれば、ローカルの CPU は使わずワーカーへ転送する（変換の進捗は中継しない）
+        if self.remote_workers is not None:
+            return await asyncio.to_thread(self.remote_workers.run, json_file, input_file_path)
+
+        # ffmpeg の同時実行数を制限して CPU の過負荷を防ぐ
+        async with self.transcodes:
+            return await self.processor.run_operation(json_file, input_file_path, progress)
+
+    # 進捗を要求したリクエストに対し、進捗のパケットを送る ProgressReporter を返す（要求がなければ None）
+    # ストリーミング応答は出力のフレームと混ざるため、進捗を送らない
+    def progress_reporter(self, connection, json_file):
+        if not json_file.get('progress') or json_file.get('stream_response'):
+            return None
+        return ProgressReporter(lambda progress: self.send_progress(connection, progress))
+
+    # 進捗のパケットを送る。暗号化の順序が応答と入れ替わらないよう、
+    # 変換を行う別スレッドからの送信はイベントループに任せる
+    def send_progress(self, connection, progress):
+        packet = TCPServer.progress_packet(progress)
+        try:
+            asyncio.get_running_loop()
+        except RuntimeError:
+            self.loop.call_soon_threadsafe(connection.send_nowait, packet)
+        else:
+            connection.send_nowait(packet)
+
+    # offset が指定された場合は、その位置から末尾までを送る（中断したダウンロードの再開用）
+    async def send_file(self, connection, output_file_path, file_name=None, frame_size=None, offset=0):
+        # パス処理とメタ情報の準備
+        path = Path(output_file_path)
+        file_name, media_type = file_name or path.name, path.suffix.encode('utf-8')
+        frame_size = frame_size or self.chunk_size
+
+        # ファイル読み込みと送信（読み込み用バッファを使い回す）
+        buffer = bytearray(frame_size)
+        view   = memoryview(buffer)
+
+        # ファイルの読み込みはイベントループを塞がないよう別スレッドで行う
+        file = await asyncio.to_thread(open, output_file_path, 'rb')
+        try:
+            file_size = await asyncio.to_thread(file.seek, 0, os.SEEK_END)
+            offset    = min(max(offset, 0), file_size)
+            await asyncio.to_thread(file.seek, offset)
+
+            # レスポンス用の情報を辞書として作成（ファイルサイズ欄は送信する残りのバイト数）
+            json_data = {
+                'file_name': file_name,
+                'error': False,
+                'error_message': None,
+                'frame_size': frame_size,
+                'offset': offset
+            }
+            # この応答のために変換した場合は、エンコード速度と出力サイズも返す
+            encode_stats = self.processor.pop_encode_stats(output_file_path)
+            if encode_stats is not None:
+                json_data['encode_stats'] = encode_stats
+            json_bytes = json.dumps(json_data).encode('utf-8')
+
+            packet = TCPServer.build_packet(json_bytes, media_type, file_size - offset)
+            await connection.sendall(packet)
+
+            while n := await asyncio.to_thread(file.readinto, buffer):
+                await connection.sendall(view[:n])
+        finally:
+            await asyncio.to_thread(file.close)
+
+    # ffmpeg の標準出力を読みながら、出力ファイルに保存しつつクライアントへ送信（TCPServer.send_streaming_file と同じ）
+    # 長さ未確定のヘッダー → データフレーム → 長さ 0 の終端フレーム → 結果パケット の順に送る
+    async def send_streaming_file(self, connection, process, output_file_path, file_name, frame_size):
+        media_type = Path(output_file_path).suffix.encode('utf-8')
+
+        json_data = {
+            'file_name': file_name,
+            'error': False,
+            'error_message': None,
+            'frame_size': frame_size,
+            'streaming': True
+        }
+        json_bytes = json.dumps(json_data).encode('utf-8')
+        await connection.sendall(TCPServer.build_packet(json_bytes, media_type, STREAMING_FILE_SIZE))
+
+        file = await asyncio.to_thread(open, output_file_path, 'wb')
+        try:
+            # 届いた分だけ読み取り、ファイルへの書き込みは別スレッドで行う（送信は暗号文を別に作るため並行できる）
+            while chunk := await process.stdout.read(frame_size):
+                await asyncio.gather(asyncio.to_thread(file.write, chunk), connection.sendall(chunk))
+        except BaseException:
+            # 送信に失敗した場合は、読まれなくなった出力で ffmpeg が止まらないよう終了させる
+            if process.returncode is None:
+                process.kill()
+            raise
+        finally:
+            # 途中で失敗しても、クライアントが後続のパケットを結果として読めるよう終端を送る
+            await asyncio.to_thread(file.close)
+            returncode = await process.wait()
+            await connection.sendall(b'')
+
+        if returncode != 0:
+            raise ffmpeg_error(returncode)
+
+        # 正常終了を知らせる結果パケット（失敗時は send_error_response が結果パケットになる）
+        trailer = json.dumps({'error': False, 'error_message': None}).encode('utf-8')
+        await connection.sendall(TCPServer.build_packet(trailer, b'', 0))
+
+    # 複数のファイルを 1 つの応答として送る（ファイル数を示すパケット → 各ファイルを順に送信）
+    async def send_file_set(self, connection, output_file_paths, request_token, frame_size):
+        json_data = {
+            'error'         : False,
+            'error_message' : None,
+            'file_count'    : len(output_file_paths),
+            'frame_size'    : frame_size,
+        }
+        await connection.sendall(TCPServer.build_packet(json.dumps(json_data).encode('utf-8'), b'', 0))
+
+        for output_file_path in output_file_paths:
+            response_name = TCPServer.strip_work_name(output_file_path, request_token)
+            await self.send_file(connection, output_file_path, response_name, frame_size)
+
+    # details が渡された場合は、エラーの種類や再試行までの秒数などをエラー情報に加える
+    async def send_error_response(self, connection, writer, error_message, details=None):
+        # クライアントへ送信するエラー情報を JSON にしてパケットを生成
+        error_response = {
+            'error'         : True,
+            'error_message' : error_message,
+            **(details or {}),
+        }
+        json_bytes = json.dumps(error_response).encode('utf-8')
+        packet     = TCPServer.build_packet(json_bytes, b'', 0)
+
+        # 鍵交換前であれば平文のまま送信する
+        if connection is not None:
+            await connection.sendall(packet)
+        else:
+            writer.write(packet)
+            await writer.drain()
+
+    # 送信側だけを閉じ、クライアントが送信をやめて切断するまで（最大 LINGER_TIMEOUT 秒）受信を読み捨てる
+    # 受信していない本体が残ったまま閉じると、クライアントに RST が届いてエラー応答を読めないことがある
+    @staticmethod
+    async def linger_close(reader, writer):
+        async def discard():
+            while await reader.read(MAX_FRAME_SIZE):
+                pass
+
+        try:
+            if writer.can_write_eof():
+                writer.write_eof()
+            await asyncio.wait_for(discard(), LINGER_TIMEOUT)
+        except (OSError, asyncio.TimeoutError):
+            pass
+
+
+
+def run_async_server(server_address, server_port, processor, max_transcodes=None, key_pool=None,
+                     pipe_uploads=False, result_cache=None, input_store=None, job_queue=None, remote_workers=None,
+                     session_tickets=None, session_idle_timeout=30.0, metrics_registry=None, rate_limiter=None):
+    async def main():
+        server = AsyncTCPServer(
+            server_address, server_port, processor, max_transcodes, key_pool, pipe_uploads, result_cache,
+            input_store, job_queue, remote_workers, session_tickets, session_idle_timeout, metrics_registry,
+            rate_limiter
+        )
+        loop   = asyncio.get_running_loop()
+        # SIGTERM / SIGINT で新規受付を止め、処理中の接続を待って終了
+        for signum in (signal.SIGTERM, signal.SIGINT):
+            loop.add_signal_handler(signum, server.shutdown)
+        await server.start_server()
+
+    asyncio.run(main())
@@ -0,0 +1,224 @@
+import json
+import os
+import socket
+import threading
+
+from Crypto.Cipher import PKCS1_OAEP
+from Crypto.PublicKey import RSA
+from Crypto.Random import get_random_bytes
+
+from server import (
+    CIPHER_MODE_CTR, MAX_FRAME_SIZE, OPERATION_HEALTH, AESCipherCTR, SecureSocket, TCPServer
+)
+
+
+# ワーカーへファイルを送る際のフレームサイズ
+FORWARD_FRAME_SIZE = 1024 * 1024
+
+# ワーカーの変換結果を待つ時間の既定値（秒）。応答が無いまま待ち続けて転送が止まらないようにする
+DEFAULT_JOB_TIMEOUT = 3600.0
+
+# ワーカーへ転送しないリクエスト項目（coordinator 側で処理済みのもの）
+LOCAL_KEYS = {
+    'stream_response', 'content_hash', 'async_job', 'upload_id', 'download_offset', 'keep_alive', 'progress',
+    'possession_proof',
+}
+
+
+# ワーカーが変換に失敗したことを示す（同じ入力では再試行しても失敗するため再試行しない）
+class RemoteWorkerError(Exception):
+    pass
+
+
+# 変換を転送する先のワーカー（同じプロトコルを話す別の TCPServer）
+class WorkerNode:
+
+    def __init__(self, address: str, port: int):
+        self.address       = address
+        self.port          = port
+        self.healthy       = False
+        self.in_flight     = 0   # この coordinator から転送中の変換の数
+        self.reported_load = 0   # 死活監視で報告された処理中の接続数
+        self.capacity      = 1   # 死活監視で報告された同時処理数
+
+    # 負荷の指標。転送中の数と報告された処理中の数の大きい方を、同時処理数で割る
+    def load(self) -> float:
+        return max(self.in_flight, self.reported_load) / self.capacity
+
+    def __repr__(self) -> str:
+        return f'{self.address}:{self.port}'
+
+
+# 複数のワーカーへ変換を振り分ける。定期的に死活監視を行い、最も負荷の低い正常なワーカーへ転送する
+# 接続断・タイムアウトで失敗した場合は別のワーカーで再試行し、全滅時はローカルで変換する
+class RemoteWorkers:
+
+    def __init__(self, nodes: list, processor, health_interval: float = 5.0, retries: int = 2,
+                 timeout: float = 10.0, job_timeout: float = DEFAULT_JOB_TIMEOUT, local_fallback: bool = True):
+        self.nodes           = nodes
+        self.processor       = processor
+        self.health_interval = health_interval
+        self.retries         = retries
+        self.timeout         = timeout       # 接続・鍵交換・死活監視の待ち時間（秒）
+        self.job_timeout     = job_timeout   # 変換結果を待つ時間（秒）
+        self.local_fallback  = local_fallback
+
+        self.lock            = threading.Lock()
+        self.stop_event      = threading.Event()
+        self.thread          = threading.Thread(target=self._health_loop, daemon=True)
+
+    # "host:port,host:port" 形式の文字列からワーカーの一覧を作成
+    @staticmethod
+    def parse_nodes(spec: str) -> list:
+        nodes = []
+        for entry in filter(None, (part.strip() for part in spec.split(','))):
+            address, _, port = entry.rpartition(':')
+            nodes.append(WorkerNode(address, int(port)))
+        return nodes
+
+    # 最初の死活監視を済ませてから、定期監視を開始
+    def start(self) -> None:
+        self.check_health()
+        self.thread.start()
+
+    def close(self) -> None:
+        self.stop_event.set()
+        if self.thread.is_alive():
+            self.thread.join()
+
+    # 全ワーカーに死活監視のリクエストを送り、状態と負荷を更新
+    def check_health(self) -> None:
+        for node in self.nodes:
+            try:
+                info = self.request_health(node)
+            except (OSError, ValueError):
+                self.mark_unhealthy(node)
+                continue
+
+            with self.lock:
+                node.healthy       = True
+                node.reported_load = info.get('load', 0)
+                node.capacity      = max(1, info.get('capacity', 1))
+
+    # 変換をワーカーへ転送し、結果を本来の出力先に保存して返す（入力ファイルは削除）
+    def run(self, json_file: dict, input_file_path: str) -> str:
+        _, output_file_path = self.processor.operation_stream(json_file, input_file_path)
+
+        tried = []
+        for _ in range(self.retries + 1):
+            node = self.acquire(tried)
+            if node is None:
+                break
+            tried.append(node)
+
+            try:
+                self.forward(node, json_file, input_file_path, output_file_path)
+            except (socket.timeout, OSError, ValueError):
+                # 接続断・タイムアウト・不正な応答はワーカー側の障害とみなし、別のワーカーで再試行
+                self.mark_unhealthy(node)
+                continue
+            finally:
+                self.release(node)
+
+            os.remove(input_file_path)
+            return output_file_path
+
+        if self.local_fallback:
+            return self.processor.run_operation(json_file, input_file_path)
+        raise ConnectionError(f"No worker could process the request (tried {tried})")
+
+    # 正常なワーカーのうち、最も負荷の低いものを選んで転送中の数を増やす
+    def acquire(self, exclude: list) -> WorkerNode | None:
+        with self.lock:
+            candidates = [node for node in self.nodes if node.healthy and node not in exclude]
+            if not candidates:
+                return None
+            node = min(candidates, key=WorkerNode.load)
+            node.in_flight += 1
+            return node
+
+    def release(self, node: WorkerNode) -> None:
+        with self.lock:
+            node.in_flight -= 1
+
+    # 次の死活監視で応答するまで、ワーカーを転送先から外す
+    def mark_unhealthy(self, node: WorkerNode) -> None:
+        with self.lock:
+            node.healthy = False
+
+    # 入力ファイルをワーカーへ送り、変換結果を output_file_path に受信
+    def forward(self, node: WorkerNode, json_file: dict, input_file_path: str, output_file_path: str) -> None:
+        connection = self.connect(node)
+        try:
+            connection.sock.settimeout(self.job_timeout)
+
+            request_json = {k: v for k, v in json_file.items() if k not in LOCAL_KEYS}
+            request_json['frame_size'] = FORWARD_FRAME_SIZE
+            json_bytes = json.dumps(request_json).encode('utf-8')
+            media_type = os.path.splitext(input_file_path)[1].encode('utf-8')
+
+            # 読み込み用バッファを使い回し、その場で暗号化して送る
+            buffer = bytearray(MAX_FRAME_SIZE)
+            view   = memoryview(buffer)
+
+            with open(input_file_path, 'rb') as file:
+                file_size = os.fstat(file.fileno()).st_size
+                connection.sendall(TCPServer.build_packet(json_bytes, media_type, file_size))
+                while n := file.readinto(view[:FORWARD_FRAME_SIZE]):
+                    connection.sendall_inplace(view[:n])
+
+            response = TCPServer.parse_packet(connection.recv())
+            info     = response['json_file']
+            if info['error']:
+                raise RemoteWorkerError(f"{node}: {info['error_message']}")
+            # ワーカーが計測したエンコード速度・出力サイズを、応答を返す際に使えるよう記録
+            if info.get('encode_stats'):
+                self.processor.encode_stats[output_file_path] = info['encode_stats']
+
+            # 受信したフレームをそのままファイルへ書き込む
+            remaining = response['file_size']
+            with open(output_file_path, 'wb') as file:
+                while remaining > 0:
+                    chunk = connection.recv_into(buffer)
+                    if not chunk:
+                        raise ConnectionError(f"{node} closed the connection during transfer")
+                    file.write(chunk)
+                    remaining -= len(chunk)
+        finally:
+            connection.sock.close()
+
+    # ワーカーの処理中の接続数と同時処理数を問い合わせる
+    def request_health(self, node: WorkerNode) -> dict:
+        connection = self.connect(node)
+        try:
+            json_bytes = json.dumps({'file_name': '', 'operation': OPERATION_HEALTH}).encode('utf-8')
+            connection.sendall(TCPServer.build_packet(json_bytes, b'', 0))
+            info = TCPServer.parse_packet(connection.recv())['json_file']
+        finally:
+            connection.sock.close()
+
+        if info['error']:
+            raise ValueError(info['error_message'])
+        return info
+
+    # ワーカーへ接続し、クライアントと同じ手順で鍵交換して暗号化ソケットを返す
+    def connect(self, node: WorkerNode) -> SecureSocket:
+        sock = socket.create_connection((node.address, node.port), timeout=self.timeout)
+        try:
+            # ワーカーの公開鍵を受信（長さ 2 バイト + 本体）
+            key_size   = int.from_bytes(TCPServer.recvn(sock, 2), 'big')
+            public_key = RSA.import_key(TCPServer.recvn(sock, key_size))
+
+            # AES 鍵・IV・暗号モードをワーカーの公開鍵で暗号化して送信
+            aes_key, aes_iv = get_random_bytes(16), get_random_bytes(16)
+            encrypted = PKCS1_OAEP.new(public_key).encrypt(aes_key + aes_iv + bytes([CIPHER_MODE_CTR]))
+            sock.sendall(len(encrypted).to_bytes(2, 'big') + encrypted)
+        except Exception:
+            sock.close()
+            raise
+
+        return SecureSocket(sock, AESCipherCTR(aes_key, aes_iv, is_server=False))
+
+    def _health_loop(self) -> None:
+        while not self.stop_event.wait(self.health_interval):
+            self.check_health()
@@ -0,0 +1,119 @@
+import selectors
+import socket
+import threading
+import time
+from collections import OrderedDict
+
+
+# 次のリクエストを待つ keep_alive のセッション数の既定の上限（超えたら最も長く待っているものを閉じる）
+MAX_IDLE_SESSIONS = 256
+
+
+# keep_alive のセッションを、次のリクエストが届くまでスレッドを使わずに 1 つのスレッドでまとめて待つ
+# リクエストが届いたセッションは on_ready に渡し、待ち時間を過ぎたもの・切断されたものは閉じる
+class IdleSessions:
+
+    def __init__(self, on_ready, idle_timeout: float = 30.0, max_sessions: int = MAX_IDLE_SESSIONS):
+        self.on_ready     = on_ready
+        self.idle_timeout = idle_timeout
+        self.max_sessions = max_sessions
+
+        self.selector     = selectors.DefaultSelector()
+        self.sessions     = OrderedDict()   # ソケット → (セッション, 待ち時間の期限)。待ち始めた順
+        self.lock         = threading.Lock()
+        self.stop_event   = threading.Event()
+        # 待機中の select を起こして、追加したセッションを監視に加えるためのソケット対
+        self.wakeup_r, self.wakeup_w = socket.socketpair()
+        self.wakeup_r.setblocking(False)
+        self.selector.register(self.wakeup_r, selectors.EVENT_READ)
+        self.thread       = threading.Thread(target=self._watch_loop, daemon=True)
+
+    def start(self) -> None:
+        self.thread.start()
+
+    # 応答を送り終えたセッションを預ける。上限に達していれば、最も長く待っているセッションを閉じる
+    def park(self, sock: socket.socket, session) -> None:
+        evicted = None
+        with self.lock:
+            if self.stop_event.is_set():
+                evicted = sock
+            else:
+                if len(self.sessions) >= self.max_sessions:
+                    evicted, _ = self.sessions.popitem(last=False)
+                    self.selector.unregister(evicted)
+                self.sessions[sock] = (session, time.monotonic() + self.idle_timeout)
+                self.selector.register(sock, selectors.EVENT_READ)
+        if evicted is not None:
+            evicted.close()
+        self._wake()
+
+    # 待機中のセッション数
+    def __len__(self) -> int:
+        with self.lock:
+            return len(self.sessions)
+
+    # 監視を止め、待機中のセッションをすべて閉じる
+    def close(self) -> None:
+        self.stop_event.set()
+        self._wake()
+        if self.thread.is_alive():
+            self.thread.join()
+        with self.lock:
+            sessions, self.sessions = list(self.sessions), OrderedDict()
+        for sock in sessions:
+            sock.close()
+        self.selector.close()
+        self.wakeup_r.close()
+        self.wakeup_w.close()
+
+    def _wake(self) -> None:
+        try:
+            self.wakeup_w.send(b'\0')
+        except (BlockingIOError, OSError):
+            pass
+
+    def _watch_loop(self) -> None:
+        while not self.stop_event.is_set():
+            with self.lock:
+                deadline = next(iter(self.sessions.values()))[1] if self.sessions else None
+            timeout = None if deadline is None else max(deadline - time.monotonic(), 0)
+            events  = self.selector.select(timeout)
+
+            ready, closed = [], []
+            with self.lock:
+                for key, _ in events:
+                    if key.fileobj is self.wakeup_r:
+                        self._drain_wakeup()
+                        continue
+                    session, _ = self.sessions.pop(key.fileobj)
+                    self.selector.unregister(key.fileobj)
+                    # 切断（読める内容が無い）なら閉じ、リクエストが届いていれば処理に回す
+                    (ready if self._has_data(key.fileobj) else closed).append((key.fileobj, session))
+
+                # 待ち時間を過ぎたセッションは待ち始めた順に並んでいるため、先頭から閉じる
+                now = time.monotonic()
+                while self.sessions and next(iter(self.sessions.values()))[1] <= now:
+                    sock, _ = self.sessions.popitem(last=False)
+                    self.selector.unregister(sock)
+                    closed.append((sock, None))
+
+            for sock, _ in closed:
+                sock.close()
+            for sock, session in ready:
+                self.on_ready(sock, session)
+
+    def _drain_wakeup(self) -> None:
+        try:
+            while self.wakeup_r.recv(4096):
+                pass
+        except BlockingIOError:
+            pass
+
+    @staticmethod
+    def _has_data(sock: socket.socket) -> bool:
+        try:
+            return sock.recv(1, socket.MSG_PEEK | socket.MSG_DONTWAIT) != b''
+        except BlockingIOError:
+            return True
+        except OSError:
+            return False
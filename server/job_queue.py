@@ -0,0 +1,236 @@
+import json
+import multiprocessing
+import os
+import signal
+import sqlite3
+import time
+from datetime import datetime, timedelta
+from pathlib import Path
+
+from progress import ProgressReporter
+
+
+# ジョブの状態
+JOB_QUEUED  = 'queued'
+JOB_RUNNING = 'running'
+JOB_DONE    = 'done'
+JOB_FAILED  = 'failed'
+
+# 実行中のジョブの進捗をデータベースへ書き込む最短の間隔（秒）
+JOB_PROGRESS_INTERVAL = 1.0
+
+# 待機中のワーカーが、保持期間を過ぎた終了済みのジョブを削除する間隔（秒）
+JOB_PRUNE_INTERVAL = 60.0
+
+
+# 変換ジョブを SQLite に永続化するキュー（サーバとワーカープロセスが同じファイルを共有する）
+class JobQueue:
+
+    def __init__(self, db_path: str = "/data/jobs.db"):
+        # パス配下のディレクトリが無ければ作成
+        Path(os.path.dirname(db_path) or '.').mkdir(parents=True, exist_ok=True)
+        self.db_path = db_path
+        self._init_db()
+
+    # 受信済みの入力ファイルとリクエスト内容をジョブとして登録
+    def submit(self, job_id: str, json_file: dict, input_path: str) -> None:
+        with self._connect() as conn:
+            conn.execute(
+                """
+                INSERT INTO jobs (id, status, request_json, input_path, created_at)
+                VALUES (?, ?, ?, ?, ?)
+                """,
+                (job_id, JOB_QUEUED, json.dumps(json_file), input_path, datetime.utcnow().isoformat()),
+            )
+
+    # 最も古い待機中のジョブを実行中にして取り出す（無ければ None）
+    # 1 文の UPDATE で取り出すため、複数のワーカーが同じジョブを取ることはない
+    def claim(self) -> dict | None:
+        with self._connect() as conn:
+            row = conn.execute(
+                """
+                UPDATE jobs SET status = ?, started_at = ?
+                WHERE id = (
+                    SELECT id FROM jobs WHERE status = ? ORDER BY created_at, rowid LIMIT 1
+                )
+                RETURNING id, request_json, input_path
+                """,
+                (JOB_RUNNING, datetime.utcnow().isoformat(), JOB_QUEUED),
+            ).fetchone()
+
+        if row is None:
+            return None
+        return {'id': row[0], 'json_file': json.loads(row[1]), 'input_path': row[2]}
+
+    # ジョブの完了と出力ファイルを記録
+    def complete(self, job_id: str, output_paths: list) -> None:
+        self._finish(job_id, JOB_DONE, json.dumps(output_paths), None)
+
+    # 実行中のジョブの変換の進捗を、記録した時刻とともに保存する（止まったジョブを見分けられるようにする）
+    def set_progress(self, job_id: str, progress: dict) -> None:
+        progress = {**progress, 'updated_at': datetime.utcnow().isoformat()}
+        with self._connect() as conn:
+            conn.execute(
+                "UPDATE jobs SET progress = ? WHERE id = ? AND status = ?",
+                (json.dumps(progress), job_id, JOB_RUNNING),
+            )
+
+    # ジョブの失敗とエラーメッセージを記録
+    def fail(self, job_id: str, error_message: str) -> None:
+        self._finish(job_id, JOB_FAILED, None, error_message)
+
+    # ジョブの状態を返す（存在しなければ None）
+    def get(self, job_id: str) -> dict | None:
+        with self._connect() as conn:
+            row = conn.execute(
+                "SELECT status, request_json, output_paths, error_message, progress FROM jobs WHERE id = ?",
+                (job_id,),
+            ).fetchone()
+
+        if row is None:
+            return None
+        return {
+            'id'            : job_id,
+            'status'        : row[0],
+            'json_file'     : json.loads(row[1]),
+            'output_paths'  : json.loads(row[2]) if row[2] else [],
+            'error_message' : row[3],
+            'progress'      : json.loads(row[4]) if row[4] else None,
+        }
+
+    # 前回の終了時に実行中だったジョブを待機中に戻す（ワーカー起動前に呼ぶ）
+    def requeue_running(self) -> int:
+        with self._connect() as conn:
+            cur = conn.execute(
+                "UPDATE jobs SET status = ?, started_at = NULL, progress = NULL WHERE status = ?",
+                (JOB_QUEUED, JOB_RUNNING),
+            )
+            return cur.rowcount
+
+    # 終了してから retention 秒を過ぎたジョブを削除し、その出力ファイルの一覧を返す
+    # 1 文の DELETE で削除するため、複数のワーカーが同時に呼んでも同じ出力を 2 度返すことはない
+    def prune(self, retention: float) -> list:
+        cutoff = (datetime.utcnow() - timedelta(seconds=retention)).isoformat()
+        with self._connect() as conn:
+            rows = conn.execute(
+                "DELETE FROM jobs WHERE status IN (?, ?) AND finished_at < ? RETURNING output_paths",
+                (JOB_DONE, JOB_FAILED, cutoff),
+            ).fetchall()
+        return [path for (output_paths,) in rows if output_paths for path in json.loads(output_paths)]
+
+    def _finish(self, job_id: str, status: str, output_paths: str | None, error_message: str | None) -> None:
+        with self._connect() as conn:
+            conn.execute(
+                """
+                UPDATE jobs SET status = ?, output_paths = ?, error_message = ?, finished_at = ?
+                WHERE id = ?
+                """,
+                (status, output_paths, error_message, datetime.utcnow().isoformat(), job_id),
+            )
+
+    # 複数プロセスから書き込むため、ロック待ちを許して接続する
+    def _connect(self) -> sqlite3.Connection:
+        return sqlite3.connect(self.db_path, timeout=30)
+
+    # 初回呼び出し時にテーブルを作成（読み書きが並行できるよう WAL モードにする）
+    def _init_db(self) -> None:
+        with self._connect() as conn:
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute(
+                """
+                CREATE TABLE IF NOT EXISTS jobs (
+                    id            TEXT PRIMARY KEY,
+                    status        TEXT NOT NULL,
+                    request_json  TEXT NOT NULL,
+                    input_path    TEXT NOT NULL,
+                    output_paths  TEXT,
+                    error_message TEXT,
+                    created_at    TEXT NOT NULL,
+                    started_at    TEXT,
+                    finished_at   TEXT,
+                    progress      TEXT
+                )
+                """
+            )
+            # 進捗の列を追加する前に作られたデータベースには、列を追加する
+            # 同時に起動した他のプロセスと重ねて追加しないよう、書き込みロックを取ってから確かめる
+            conn.execute("BEGIN IMMEDIATE")
+            columns = {row[1] for row in conn.execute("PRAGMA table_info(jobs)")}
+            if 'progress' not in columns:
+                conn.execute("ALTER TABLE jobs ADD COLUMN progress TEXT")
+            conn.execute("CREATE INDEX IF NOT EXISTS jobs_status ON jobs (status, created_at)")
+
+
+# キューからジョブを取り出して変換する、CPU コア数に合わせたワーカープロセスの集まり
+# ffmpeg の同時実行数はワーカー数で頭打ちになり、接続が切れても変換は続く
+class WorkerPool:
+
+    # retention を指定すると、終了から retention 秒を過ぎたジョブとその出力を削除する（None で保持し続ける）
+    def __init__(self, job_queue: JobQueue, processor, workers: int | None = None, poll_interval: float = 0.2,
+                 retention: float | None = None):
+        self.job_queue = job_queue
+        self.workers   = workers or os.cpu_count() or 1
+
+        # スレッドを持つサーバから fork しないよう、spawn でワーカーを起動する
+        context         = multiprocessing.get_context('spawn')
+        self.stop_event = context.Event()
+        self.processes  = [
+            context.Process(
+                target=_worker_main,
+                args=(job_queue.db_path, processor, self.stop_event, poll_interval, retention),
+                daemon=True,
+            )
+            for _ in range(self.workers)
+        ]
+
+    # 中断されたジョブを戻してからワーカーを起動
+    def start(self) -> None:
+        self.job_queue.requeue_running()
+        for process in self.processes:
+            process.start()
+
+    # 実行中のジョブが終わるのを待ってワーカーを停止
+    def close(self, timeout: float | None = None) -> None:
+        self.stop_event.set()
+        for process in self.processes:
+            process.join(timeout)
+
+
+# ワーカープロセスの本体。待機中のジョブを 1 つずつ取り出して実行する
+def _worker_main(db_path, processor, stop_event, poll_interval, retention=None):
+    # Ctrl+C はサーバ側で受け、実行中のジョブは最後まで処理する
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+    job_queue = JobQueue(db_path)
+    pruned_at = None
+    while not stop_event.is_set():
+        job = job_queue.claim()
+        if job is None:
+            # 待機中の時間を使って、保持期間を過ぎたジョブとその出力を削除する
+            if retention is not None and (pruned_at is None or time.monotonic() - pruned_at >= JOB_PRUNE_INTERVAL):
+                _remove_files(job_queue.prune(retention))
+                pruned_at = time.monotonic()
+            stop_event.wait(poll_interval)
+            continue
+
+        # 変換の進捗は間隔を空けてジョブの状態に書き込み、状態の問い合わせで返す
+        progress = ProgressReporter(
+            lambda info, job_id=job['id']: job_queue.set_progress(job_id, info), JOB_PROGRESS_INTERVAL
+        )
+        try:
+            output_paths = processor.run_job(job['json_file'], job['input_path'], progress)
+        except Exception as e:
+            # 成功時は変換が入力を削除するため、失敗時だけ入力と書きかけの出力をここで削除する
+            processor.discard_job(job['json_file'], job['input_path'])
+            job_queue.fail(job['id'], str(e) or type(e).__name__)
+        else:
+            job_queue.complete(job['id'], output_paths)
+
+
+# 削除済みのファイルは無視して、まとめて削除する
+def _remove_files(paths):
+    for path in paths:
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
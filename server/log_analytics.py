@@ -0,0 +1,345 @@
+import argparse
+import bisect
+import json
+import os
+import re
+import sqlite3
+from datetime import datetime, timedelta
+
+
+# 処理時間（秒）のヒストグラムの区切り。10 ミリ秒から 1.2 倍ずつ、約 8 時間まで
+# 1 時間ごとの集計を合算して任意の期間の p50 / p95 を求めるため、区切りは固定にする
+DURATION_BUCKETS = tuple(0.01 * 1.2 ** i for i in range(82))
+
+# 記録が遅れて届くログを取りこぼさないよう、集計し直す範囲に含める直近の時間
+ROLLUP_LATE_ARRIVAL = timedelta(minutes=5)
+# 終了していないリクエストがある時間帯は、終了を待って集計し直す（これより古いものは中断されたとみなす）
+ROLLUP_PENDING_LIMIT = timedelta(hours=24)
+
+# 処理時間は開始・終了時刻（ISO 形式の UTC）から求める
+DURATION_SQL = "(julianday(end_time) - julianday(start_time)) * 86400.0"
+
+
+# ログのテーブルに索引を作り、1 時間ごと・操作ごとの集計表を差分で更新して、期間の問い合わせに答える
+# 集計表には件数・転送量・処理時間の合計と、その時間帯の正確な p50 / p95、合算用のヒストグラムを保存する
+class LogAnalytics:
+
+    def __init__(self, db_path: str = "/data/logs.db"):
+        self.db_path = db_path
+        self._init_db()
+
+    # 前回の集計以降に記録・終了したログを集計表に反映し、集計し直した時間帯の数を返す
+    # 集計し直すのは「集計待ち」の時間帯以降だけのため、ログの総数によらず短時間で終わる
+    def refresh(self, now: datetime | None = None) -> int:
+        now = now or datetime.utcnow()
+        with self._connect() as conn:
+            dirty_from = self._get_state(conn, 'dirty_from')
+            if dirty_from is None:
+                dirty_from = conn.execute("SELECT MIN(start_time) FROM logs").fetchone()[0]
+                if dirty_from is None:
+                    return 0
+                dirty_from = self.hour_of(dirty_from)
+
+            rows = conn.execute(
+                f"""
+                SELECT substr(start_time, 1, 13), operation, {DURATION_SQL}, status,
+                       COALESCE(bytes_in, 0), COALESCE(bytes_out, 0), COALESCE(transcode_seconds, 0)
+                FROM logs
+                WHERE start_time >= ? AND end_time IS NOT NULL AND operation IS NOT NULL
+                ORDER BY start_time
+                """,
+                (dirty_from,),
+            )
+
+            conn.execute("DELETE FROM log_rollup_hourly WHERE hour >= ?", (dirty_from,))
+            hours = 0
+            for hour, groups in self.group_by_hour(rows):
+                conn.executemany(
+                    """
+                    INSERT INTO log_rollup_hourly
+                      (hour, operation, requests, errors, bytes_in, bytes_out, duration_sum, transcode_sum,
+                       p50_seconds, p95_seconds, duration_histogram)
+                    VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+                    """,
+                    [self.rollup_row(hour, operation, group) for operation, group in groups.items()],
+                )
+                hours += 1
+
+            # 次回は、まだ終了していないリクエストと、遅れて届くログがありうる時間帯から集計し直す
+            pending = conn.execute(
+                "SELECT MIN(start_time) FROM logs WHERE start_time >= ? AND end_time IS NULL",
+                (max(dirty_from, (now - ROLLUP_PENDING_LIMIT).isoformat()),),
+            ).fetchone()[0]
+            next_from = self.hour_of((now - ROLLUP_LATE_ARRIVAL).isoformat())
+            if pending is not None:
+                next_from = min(next_from, self.hour_of(pending))
+            self._set_state(conn, 'dirty_from', max(next_from, dirty_from))
+        return hours
+
+    # 期間内の操作ごとの件数・エラー率・転送量・平均と p50 / p95 の処理時間を、p95 の遅い順に返す
+    # 複数の時間帯にまたがる p50 / p95 は、ヒストグラムを合算した推定値
+    def summary(self, since: str, until: str | None = None) -> list[dict]:
+        per_operation = {}
+        for row in self.hourly(since, until):
+            total = per_operation.setdefault(row['operation'], {
+                'operation' : row['operation'],
+                'requests'  : 0,
+                'errors'    : 0,
+                'bytes_in'  : 0,
+                'bytes_out' : 0,
+                'duration_sum'  : 0.0,
+                'transcode_sum' : 0.0,
+                'histogram' : [0] * (len(DURATION_BUCKETS) + 1),
+                'hours'     : [],
+            })
+            for key in ('requests', 'errors', 'bytes_in', 'bytes_out', 'duration_sum', 'transcode_sum'):
+                total[key] += row[key]
+            for index, count in row['histogram'].items():
+                total['histogram'][int(index)] += count
+            total['hours'].append(row)
+
+        results = []
+        for total in per_operation.values():
+            hours = total.pop('hours')
+            histogram = total.pop('histogram')
+            if len(hours) == 1:
+                p50, p95 = hours[0]['p50_seconds'], hours[0]['p95_seconds']
+            else:
+                p50, p95 = self.histogram_quantile(histogram, 0.50), self.histogram_quantile(histogram, 0.95)
+            requests = total['requests']
+            results.append({
+                **total,
+                'error_rate'    : total['errors'] / requests if requests else 0.0,
+                'avg_seconds'   : total['duration_sum'] / requests if requests else None,
+                'p50_seconds'   : p50,
+                'p95_seconds'   : p95,
+            })
+        return sorted(results, key=lambda result: result['p95_seconds'] or 0.0, reverse=True)
+
+    # 期間内の 1 時間ごと・操作ごとの集計を時刻順に返す
+    def hourly(self, since: str, until: str | None = None, operation: int | None = None) -> list[dict]:
+        query  = "SELECT * FROM log_rollup_hourly WHERE hour >= ? AND hour < ?"
+        params = [self.hour_of(since), self.hour_of(until) if until else '9999']
+        if operation is not None:
+            query += " AND operation = ?"
+            params.append(operation)
+
+        with self._connect() as conn:
+            conn.row_factory = sqlite3.Row
+            rows = conn.execute(query + " ORDER BY hour, operation", params).fetchall()
+        return [{**dict(row), 'histogram': json.loads(row['duration_histogram'])} for row in rows]
+
+    # 1 つのクライアントの期間内のリクエストを、client_ip の索引から集計する
+    def client(self, client_ip: str, since: str, until: str | None = None) -> list[dict]:
+        with self._connect() as conn:
+            conn.row_factory = sqlite3.Row
+            rows = conn.execute(
+                f"""
+                SELECT operation, COUNT(*) AS requests,
+                       SUM(status = 'error') AS errors,
+                       SUM(COALESCE(bytes_in, 0)) AS bytes_in, SUM(COALESCE(bytes_out, 0)) AS bytes_out,
+                       AVG({DURATION_SQL}) AS avg_seconds, MAX(start_time) AS last_seen
+                FROM logs
+                WHERE client_ip = ? AND start_time >= ? AND start_time < ?
+                GROUP BY operation ORDER BY requests DESC
+                """,
+                (client_ip, since, until or '9999'),
+            ).fetchall()
+        return [dict(row) for row in rows]
+
+    # ソート済みの 1 時間分の行を、(時間帯, {操作: 行の一覧}) にまとめて順に返す
+    @staticmethod
+    def group_by_hour(rows):
+        current, groups = None, {}
+        for row in rows:
+            if row[0] != current:
+                if groups:
+                    yield current, groups
+                current, groups = row[0], {}
+            groups.setdefault(row[1], []).append(row[2:])
+        if groups:
+            yield current, groups
+
+    # 1 時間分・1 操作分の行から集計表の 1 行を作る
+    @classmethod
+    def rollup_row(cls, hour: str, operation: int, group: list) -> tuple:
+        durations = sorted(max(row[0], 0.0) for row in group)
+        histogram = {}
+        for duration in durations:
+            index = cls.bucket_index(duration)
+            histogram[index] = histogram.get(index, 0) + 1
+        return (
+            hour, operation, len(group),
+            sum(1 for row in group if row[1] == 'error'),
+            sum(row[2] for row in group), sum(row[3] for row in group),
+            sum(durations), sum(row[4] for row in group),
+            cls.quantile(durations, 0.50), cls.quantile(durations, 0.95),
+            json.dumps(histogram),
+        )
+
+    # 処理時間が入るヒストグラムの区間（最後の区間は DURATION_BUCKETS の上限を超えたもの）
+    @staticmethod
+    def bucket_index(duration: float) -> int:
+        return bisect.bisect_left(DURATION_BUCKETS, duration)
+
+    # ソート済みの値の分位数（隣り合う値の間は線形補間）
+    @staticmethod
+    def quantile(values: list, q: float) -> float | None:
+        if not values:
+            return None
+        position = (len(values) - 1) * q
+        lower    = int(position)
+        upper    = min(lower + 1, len(values) - 1)
+        return values[lower] + (values[upper] - values[lower]) * (position - lower)
+
+    # ヒストグラムの分位数の推定値（該当する区間の中で線形補間）
+    @staticmethod
+    def histogram_quantile(histogram: list, q: float) -> float | None:
+        total = sum(histogram)
+        if not total:
+            return None
+        target, seen = q * total, 0
+        for index, count in enumerate(histogram):
+            if count and seen + count >= target:
+                if index == len(DURATION_BUCKETS):
+                    return DURATION_BUCKETS[-1]
+                lower = DURATION_BUCKETS[index - 1] if index else 0.0
+                return lower + (DURATION_BUCKETS[index] - lower) * (target - seen) / count
+            seen += count
+        return DURATION_BUCKETS[-1]
+
+    # ISO 形式の時刻を、集計表の時間帯の表記（"YYYY-MM-DDTHH"）にする
+    @staticmethod
+    def hour_of(timestamp: str) -> str:
+        return timestamp[:13]
+
+    def _get_state(self, conn: sqlite3.Connection, key: str) -> str | None:
+        row = conn.execute("SELECT value FROM log_rollup_state WHERE key = ?", (key,)).fetchone()
+        return row[0] if row else None
+
+    def _set_state(self, conn: sqlite3.Connection, key: str, value: str) -> None:
+        conn.execute("INSERT OR REPLACE INTO log_rollup_state (key, value) VALUES (?, ?)", (key, value))
+
+    # サーバのログの書き込みと並行するため、ロック待ちを許して接続する
+    def _connect(self) -> sqlite3.Connection:
+        return sqlite3.connect(self.db_path, timeout=30)
+
+    # 期間・操作・クライアントで絞り込む索引と、集計表を作成する（ログのテーブルはサーバが作成する）
+    def _init_db(self) -> None:
+        with self._connect() as conn:
+            if conn.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'logs'").fetchone() is None:
+                raise ValueError(f"No logs table in {self.db_path}")
+
+            conn.execute("CREATE INDEX IF NOT EXISTS logs_start_time ON logs (start_time)")
+            conn.execute("CREATE INDEX IF NOT EXISTS logs_operation ON logs (operation, start_time)")
+            conn.execute("CREATE INDEX IF NOT EXISTS logs_client_ip ON logs (client_ip, start_time)")
+            conn.execute(
+                """
+                CREATE TABLE IF NOT EXISTS log_rollup_hourly (
+                    hour               TEXT    NOT NULL,
+                    operation          INTEGER NOT NULL,
+                    requests           INTEGER NOT NULL,
+                    errors             INTEGER NOT NULL,
+                    bytes_in           INTEGER NOT NULL,
+                    bytes_out          INTEGER NOT NULL,
+                    duration_sum       REAL    NOT NULL,
+                    transcode_sum      REAL    NOT NULL,
+                    p50_seconds        REAL,
+                    p95_seconds        REAL,
+                    duration_histogram TEXT    NOT NULL,
+                    PRIMARY KEY (hour, operation)
+                )
+                """
+            )
+            conn.execute("CREATE TABLE IF NOT EXISTS log_rollup_state (key TEXT PRIMARY KEY, value TEXT)")
+
+
+# "7d" / "24h" / "30m" の相対指定、または ISO 形式の日時を、ISO 形式の UTC の時刻にする
+def parse_time(value: str, now: datetime | None = None) -> str:
+    match = re.fullmatch(r'(\d+)([dhm])', value)
+    if match is None:
+        return datetime.fromisoformat(value).isoformat()
+    unit = {'d': 'days', 'h': 'hours', 'm': 'minutes'}[match.group(2)]
+    return ((now or datetime.utcnow()) - timedelta(**{unit: int(match.group(1))})).isoformat()
+
+
+def format_seconds(seconds: float | None) -> str:
+    return '-' if seconds is None else f'{seconds:.2f}s'
+
+
+def format_bytes(size: int) -> str:
+    for unit in ('B', 'KB', 'MB', 'GB'):
+        if size < 1024:
+            return f'{size:.0f}{unit}'
+        size /= 1024
+    return f'{size:.1f}TB'
+
+
+def print_table(headers: list, rows: list) -> None:
+    widths = [max(len(str(cell)) for cell in column) for column in zip(headers, *rows)]
+    for row in (headers, *rows):
+        print('  '.join(str(cell).rjust(width) for cell, width in zip(row, widths)))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='リクエストのログの集計')
+    parser.add_argument('--db', default=os.environ.get('SQLITE_DB_PATH', '/data/logs.db'))
+    parser.add_argument('--no-refresh', action='store_true', help='集計表を更新せずに問い合わせる')
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    commands.add_parser('refresh', help='集計表を更新する')
+
+    summary = commands.add_parser('summary', help='操作ごとの件数と処理時間（遅い順）')
+    hourly  = commands.add_parser('hourly', help='1 時間ごとの件数と処理時間')
+    client  = commands.add_parser('client', help='1 つのクライアントのリクエスト')
+    client.add_argument('client_ip')
+    hourly.add_argument('--operation', type=int)
+    for command in (summary, hourly, client):
+        command.add_argument('--since', default='7d', help='"7d" / "24h" / "30m" または ISO 形式の日時')
+        command.add_argument('--until')
+
+    args      = parser.parse_args()
+    analytics = LogAnalytics(args.db)
+    if args.command == 'refresh' or not args.no_refresh:
+        hours = analytics.refresh()
+        if args.command == 'refresh':
+            print(f'refreshed {hours} hour(s)')
+            return
+
+    since = parse_time(args.since)
+    until = parse_time(args.until) if args.until else None
+
+    if args.command == 'summary':
+        print_table(
+            ['operation', 'requests', 'error_rate', 'bytes_in', 'bytes_out', 'avg', 'p50', 'p95', 'avg_transcode'],
+            [
+                [row['operation'], row['requests'], f"{row['error_rate']:.1%}", format_bytes(row['bytes_in']),
+                 format_bytes(row['bytes_out']), format_seconds(row['avg_seconds']),
+                 format_seconds(row['p50_seconds']), format_seconds(row['p95_seconds']),
+                 format_seconds(row['transcode_sum'] / row['requests'])]
+                for row in analytics.summary(since, until)
+            ],
+        )
+    elif args.command == 'hourly':
+        print_table(
+            ['hour', 'operation', 'requests', 'errors', 'bytes_in', 'bytes_out', 'p50', 'p95'],
+            [
+                [row['hour'], row['operation'], row['requests'], row['errors'], format_bytes(row['bytes_in']),
+                 format_bytes(row['bytes_out']), format_seconds(row['p50_seconds']),
+                 format_seconds(row['p95_seconds'])]
+                for row in analytics.hourly(since, until, args.operation)
+            ],
+        )
+    else:
+        print_table(
+            ['operation', 'requests', 'errors', 'bytes_in', 'bytes_out', 'avg', 'last_seen'],
+            [
+                [row['operation'], row['requests'], row['errors'], format_bytes(row['bytes_in']),
+                 format_bytes(row['bytes_out']), format_seconds(row['avg_seconds']), row['last_seen']]
+                for row in analytics.client(args.client_ip, since, until)
+            ],
+        )
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,66 @@
+import threading
+from collections import OrderedDict
+
+
+# 索引に残すストリームの項目（長さ・コーデック・解像度など、要求の検証と変換経路の判断に使うもの）
+STREAM_KEYS = (
+    'index', 'codec_type', 'codec_name', 'width', 'height', 'avg_frame_rate', 'nb_frames', 'duration',
+    'tags', 'side_data_list',
+)
+FORMAT_KEYS = ('format_name', 'duration', 'size', 'bit_rate')
+
+
+# 入力の解析結果（ffprobe の出力）を内容ハッシュごとに保持する、件数上限付きの LRU 索引
+# 同じ内容の入力を別のパラメータで変換する場合に、ffprobe を実行し直さずに済ませる
+class MediaIndex:
+
+    def __init__(self, max_entries: int = 10000):
+        self.max_entries = max_entries
+
+        self.lock        = threading.Lock()
+        self.entries     = OrderedDict()   # 内容ハッシュ → 解析結果。末尾ほど最近使われたもの
+        self.hits        = 0
+        self.misses      = 0
+
+    # ジョブのワーカープロセスへ渡す際は、ロックを持たない空の索引として作り直す
+    def __reduce__(self):
+        return MediaIndex, (self.max_entries,)
+
+    # 内容ハッシュに対応する解析結果を返す（未解析なら None）
+    def get(self, content_hash: str) -> dict | None:
+        with self.lock:
+            probe = self.entries.get(content_hash)
+            if probe is None:
+                self.misses += 1
+                return None
+            self.entries.move_to_end(content_hash)
+            self.hits += 1
+            return probe
+
+    # 解析結果を登録し、上限を超えた分を古い順に破棄する
+    def put(self, content_hash: str, probe: dict) -> None:
+        if self.max_entries <= 0:
+            return
+
+        with self.lock:
+            self.entries[content_hash] = probe
+            self.entries.move_to_end(content_hash)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+    # ヒット数・ミス数と保持している件数を返す
+    def stats(self) -> dict:
+        with self.lock:
+            return {
+                'hits'    : self.hits,
+                'misses'  : self.misses,
+                'entries' : len(self.entries),
+            }
+
+    # ffprobe の出力から、索引に残す項目だけを取り出す
+    @staticmethod
+    def compact(probe: dict) -> dict:
+        return {
+            'format'  : {k: v for k, v in probe.get('format', {}).items() if k in FORMAT_KEYS},
+            'streams' : [{k: v for k, v in s.items() if k in STREAM_KEYS} for s in probe.get('streams', [])],
+        }
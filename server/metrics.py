@@ -0,0 +1,265 @@
+import bisect
+import threading
+import time
+from collections import Counter
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+# リクエストを処理する段階（鍵交換 → 受信 → 変換 → 送信）
+STAGES = ('key_exchange', 'receive', 'transcode', 'send')
+
+# 段階ごとの処理時間（秒）と、受信・送信の速度（バイト/秒）のヒストグラムの区切り
+STAGE_BUCKETS      = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600)
+THROUGHPUT_BUCKETS = (64 * 1024, 256 * 1024, 1024 ** 2, 4 * 1024 ** 2, 16 * 1024 ** 2, 64 * 1024 ** 2,
+                      256 * 1024 ** 2, 1024 ** 3)
+
+# キャッシュなどの stats() が返す項目のうち、起動からの累積回数のもの（それ以外は現在の値として出力する）
+STATS_COUNTERS = {'hits', 'misses', 'evictions', 'issued', 'resumed', 'rejected'}
+
+# メトリクスを公開する HTTP エンドポイントの既定の待ち受け先（外部には公開しない）
+METRICS_ADDRESS = '127.0.0.1'
+METRICS_PORT    = 9464
+
+
+# 1 リクエストの段階ごとの処理時間・転送量・ffmpeg の終了コードを集める
+# 受信しながら変換する場合（標準入力への流し込み・ストリーミング応答）は、重なった時間を変換の段階に含める
+class RequestMetrics:
+
+    def __init__(self):
+        self.stages           = {}     # 段階 → 処理時間（秒）
+        self.bytes_in         = 0      # 受信した平文のバイト数（リクエストのパケットを含む）
+        self.bytes_out        = 0      # 送信した平文のバイト数
+        self.ffmpeg_exit_code = None   # ffmpeg を実行しなかった場合（キャッシュの利用など）は None
+        self.status           = 'ok'
+        self.counters         = None   # 計測開始時点の接続の受信・送信バイト数
+
+    # with ブロックの経過時間を段階の処理時間に加える（同じ段階を複数回通った場合は合計する）
+    @contextmanager
+    def stage(self, name: str):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.stages[name] = self.stages.get(name, 0.0) + time.perf_counter() - started
+
+    # 変換の段階を計測し、ffmpeg の終了コードを記録する（失敗時は例外の returncode）
+    @contextmanager
+    def transcode(self):
+        with self.stage('transcode'):
+            try:
+                yield
+            except Exception as error:
+                self.ffmpeg_exit_code = getattr(error, 'returncode', None)
+                raise
+        self.ffmpeg_exit_code = 0
+
+    # 接続の送受信バイト数の計測を始める（received は計測開始前に受信済みのリクエストのバイト数）
+    def begin(self, connection, received: int = 0) -> None:
+        self.counters = (connection.bytes_received - received, connection.bytes_sent)
+
+    # 計測開始からの送受信バイト数を記録する
+    def end(self, connection) -> None:
+        if connection is None or self.counters is None:
+            return
+        self.bytes_in  = connection.bytes_received - self.counters[0]
+        self.bytes_out = connection.bytes_sent - self.counters[1]
+
+    def fail(self, error: Exception) -> None:
+        self.status = 'error'
+        if getattr(error, 'returncode', None) is not None:
+            self.ffmpeg_exit_code = error.returncode
+
+    # 段階の処理時間あたりの転送量（バイト/秒）。段階を通らなかった場合は None
+    def throughput(self, stage: str, size: int) -> float | None:
+        seconds = self.stages.get(stage)
+        return size / seconds if seconds and size else None
+
+    # ログのデータベースへ書き込む値（sqlite_logger.METRIC_COLUMNS の列）
+    def as_log(self) -> dict:
+        return {
+            **{f'{stage}_seconds': self.stages.get(stage) for stage in STAGES},
+            'bytes_in'           : self.bytes_in,
+            'bytes_out'          : self.bytes_out,
+            'receive_throughput' : self.throughput('receive', self.bytes_in),
+            'send_throughput'    : self.throughput('send', self.bytes_out),
+            'ffmpeg_exit_code'   : self.ffmpeg_exit_code,
+            'status'             : self.status,
+        }
+
+
+# 累積しない件数で持ち、出力時に le 以下の累積件数へ直す
+class Histogram:
+
+    def __init__(self, buckets: tuple):
+        self.buckets = buckets
+        self.counts  = [0] * (len(buckets) + 1)   # 最後は +Inf
+        self.sum     = 0.0
+        self.count   = 0
+
+    def observe(self, value: float) -> None:
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum   += value
+        self.count += 1
+
+    def cumulative(self) -> list:
+        total, result = 0, []
+        for bound, count in zip((*self.buckets, '+Inf'), self.counts):
+            total += count
+            result.append((bound, total))
+        return result
+
+
+# 全リクエストの RequestMetrics を集計し、Prometheus のテキスト形式で出力する
+class MetricsRegistry:
+
+    def __init__(self):
+        self.lock         = threading.Lock()
+        self.stage_hists  = {}          # (段階, 操作) → 処理時間のヒストグラム
+        self.speed_hists  = {}          # 向き（in / out） → 転送速度のヒストグラム
+        self.requests     = Counter()   # (操作, 結果) → リクエスト数
+        self.bytes        = Counter()   # 向き → 転送量
+        self.exit_codes   = Counter()   # ffmpeg の終了コード → 回数
+        self.rejections   = Counter()   # 超えた制限 → 受け付け時に拒否したリクエスト数
+        self.stats_sources = {}         # 名前 → ヒット数・使用量などの辞書を返す関数（出力のたびに呼ぶ）
+
+    def observe(self, operation, metrics: RequestMetrics) -> None:
+        operation = 'unknown' if operation is None else str(operation)
+        speeds    = {
+            'in'  : metrics.throughput('receive', metrics.bytes_in),
+            'out' : metrics.throughput('send', metrics.bytes_out),
+        }
+        with self.lock:
+            for stage, seconds in metrics.stages.items():
+                self.stage_hists.setdefault((stage, operation), Histogram(STAGE_BUCKETS)).observe(seconds)
+            for direction, speed in speeds.items():
+                if speed is not None:
+                    self.speed_hists.setdefault(direction, Histogram(THROUGHPUT_BUCKETS)).observe(speed)
+            self.requests[(operation, metrics.status)] += 1
+            self.bytes['in']  += metrics.bytes_in
+            self.bytes['out'] += metrics.bytes_out
+            if metrics.ffmpeg_exit_code is not None:
+                self.exit_codes[str(metrics.ffmpeg_exit_code)] += 1
+
+    # クライアントごとの制限を超えて拒否したリクエストを数える
+    def observe_rejection(self, limit: str) -> None:
+        with self.lock:
+            self.rejections[limit] += 1
+
+    # 結果キャッシュ・鍵プールなど、stats() で自身の集計を返すオブジェクトを登録する
+    def register_stats(self, name: str, stats) -> None:
+        with self.lock:
+            self.stats_sources[name] = stats
+
+    def render(self) -> str:
+        lines = []
+        with self.lock:
+            lines += self.render_counter(
+                'media_server_requests_total', 'Requests handled, by operation and result',
+                {(('operation', op), ('status', status)): n for (op, status), n in sorted(self.requests.items())},
+            )
+            lines += self.render_histogram(
+                'media_server_stage_seconds', 'Time spent in each request stage',
+                {(('stage', stage), ('operation', op)): hist for (stage, op), hist in sorted(self.stage_hists.items())},
+            )
+            lines += self.render_counter(
+                'media_server_bytes_total', 'Plaintext bytes received (in) and sent (out)',
+                {(('direction', direction),): n for direction, n in sorted(self.bytes.items())},
+            )
+            lines += self.render_histogram(
+                'media_server_throughput_bytes_per_second', 'Receive (in) and send (out) throughput per request',
+                {(('direction', direction),): hist for direction, hist in sorted(self.speed_hists.items())},
+            )
+            lines += self.render_counter(
+                'media_server_ffmpeg_exit_total', 'ffmpeg runs, by exit code',
+                {(('code', code),): n for code, n in sorted(self.exit_codes.items())},
+            )
+            lines += self.render_counter(
+                'media_server_rejected_total', 'Requests rejected at admission, by exceeded per-client limit',
+                {(('limit', limit),): n for limit, n in sorted(self.rejections.items())},
+            )
+            sources = sorted(self.stats_sources.items())
+
+        # 登録したオブジェクトはそれぞれのロックで集計を返すため、レジストリのロックを外してから読む
+        for name, stats in sources:
+            lines += self.render_stats(name, stats())
+        return '\n'.join(lines) + '\n'
+
+    # stats() の各項目を、累積回数はカウンタ、それ以外はゲージとして出力する
+    @classmethod
+    def render_stats(cls, name: str, stats: dict) -> list:
+        lines = []
+        for key, value in stats.items():
+            if key in STATS_COUNTERS:
+                lines += cls.render_counter(f'media_server_{name}_{key}_total', f'{name} {key}', {(): value})
+            else:
+                lines += cls.render_gauge(f'media_server_{name}_{key}', f'{name} {key}', {(): value})
+        return lines
+
+    @classmethod
+    def render_counter(cls, name: str, help_text: str, values: dict) -> list:
+        lines = [f'# HELP {name} {help_text}', f'# TYPE {name} counter']
+        for labels, value in values.items():
+            lines.append(f'{name}{cls.format_labels(labels)} {value}')
+        return lines
+
+    @classmethod
+    def render_gauge(cls, name: str, help_text: str, values: dict) -> list:
+        lines = [f'# HELP {name} {help_text}', f'# TYPE {name} gauge']
+        for labels, value in values.items():
+            lines.append(f'{name}{cls.format_labels(labels)} {value}')
+        return lines
+
+    @classmethod
+    def render_histogram(cls, name: str, help_text: str, hists: dict) -> list:
+        lines = [f'# HELP {name} {help_text}', f'# TYPE {name} histogram']
+        for labels, hist in hists.items():
+            for bound, count in hist.cumulative():
+                lines.append(f'{name}_bucket{cls.format_labels((*labels, ("le", bound)))} {count}')
+            lines.append(f'{name}_sum{cls.format_labels(labels)} {hist.sum}')
+            lines.append(f'{name}_count{cls.format_labels(labels)} {hist.count}')
+        return lines
+
+    @staticmethod
+    def format_labels(labels: tuple) -> str:
+        if not labels:
+            return ''
+        pairs = []
+        for key, value in labels:
+            value = str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+            pairs.append(f'{key}="{value}"')
+        return '{' + ','.join(pairs) + '}'
+
+
+class MetricsRequestHandler(BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        if self.path.split('?')[0] != '/metrics':
+            self.send_error(404)
+            return
+        body = self.server.registry.render().encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    # 取得のたびにアクセスログを標準エラーへ出さない
+    def log_message(self, format, *args):
+        pass
+
+
+# 集計したメトリクスを GET /metrics で返す HTTP サーバを別スレッドで動かす
+class MetricsServer:
+
+    def __init__(self, registry: MetricsRegistry, address: str = METRICS_ADDRESS, port: int = METRICS_PORT):
+        self.httpd          = ThreadingHTTPServer((address, port), MetricsRequestHandler)
+        self.httpd.registry = registry
+        self.thread         = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+
+    def start(self) -> None:
+        self.thread.start()
+
+    def close(self) -> None:
+        self.httpd.shutdown()
+        self.httpd.server_close()
@@ -0,0 +1,136 @@
+import threading
+import time
+from typing import Callable, Iterable
+
+
+# 進捗をクライアントへ送る最短の間隔（秒）。ffmpeg は既定で 0.5 秒ごとに進捗を書き出す
+PROGRESS_INTERVAL = 0.5
+
+# ffmpeg に進捗を key=value の行で標準出力へ書き出させる引数（標準エラーの表示はそのまま）
+FFMPEG_PROGRESS_ARGS = ['-progress', 'pipe:1']
+
+
+# 受信と変換の進捗を、間隔を空けて send へ渡す
+# 変換の進捗は ffmpeg ごと（タスクごと）に出力済みの長さを記録し、出力する長さの合計に対する割合で返す
+# 分割変換やファンアウトでは複数のスレッドから呼ばれるため、集計と送信はロック中に行う
+class ProgressReporter:
+
+    def __init__(self, send: Callable[[dict], None], interval: float = PROGRESS_INTERVAL):
+        self.send      = send
+        self.interval  = interval
+
+        self.lock      = threading.Lock()
+        self.sent_at   = 0.0
+        self.stage     = None    # 最後に送った段階（upload / encode）
+        self.closed    = False   # 送信に失敗した（クライアントが切断したなど）後は送らない
+        self.upload_started = None
+        self.durations = {}   # タスク → 出力する長さ（秒、不明なら None）
+        self.positions = {}   # タスク → 出力済みの長さ（秒）
+        self.speeds    = {}   # 実行中のタスク → 実時間に対する変換速度（倍）
+        self.fps       = {}   # 実行中のタスク → エンコード速度（fps）
+        self.blocks    = {}   # タスク → 読み取り途中の -progress の 1 回分
+
+    # 受信済みのバイト数と全体のバイト数を通知する
+    def upload(self, received: int, total: int) -> None:
+        now = time.monotonic()
+        if self.upload_started is None:
+            self.upload_started = (now, received)
+
+        started_at, started_bytes = self.upload_started
+        rate = (received - started_bytes) / (now - started_at) if now > started_at else 0
+        self.emit({
+            'stage'   : 'upload',
+            'bytes'   : received,
+            'total'   : total,
+            'percent' : round(received / total * 100, 1) if total else 100.0,
+            'eta'     : round((total - received) / rate, 1) if rate > 0 else None,
+        }, force=received >= total)
+
+    # タスクが出力する長さを登録する。並行するタスクは開始前にまとめて登録しておく
+    def expect(self, task, duration: float | None) -> None:
+        with self.lock:
+            self.durations[task] = duration
+            self.positions.setdefault(task, 0.0)
+
+    # ffmpeg の -progress の出力を終わりまで読み、1 回分ごとに進捗を通知する
+    def follow(self, lines: Iterable[bytes], task=0) -> None:
+        for line in lines:
+            self.feed(task, line)
+
+    # -progress の 1 行を読み取る。progress=continue / end の行で 1 回分が終わる
+    def feed(self, task, line: bytes) -> None:
+        key, sep, value = line.decode('utf-8', 'replace').strip().partition('=')
+        if not sep:
+            return
+
+        block = self.blocks.setdefault(task, {})
+        block[key] = value
+        if key == 'progress':
+            del self.blocks[task]
+            self.encode(task, block)
+
+    # 1 回分の進捗でタスクの状態を更新し、全タスクを合わせた進捗を通知する
+    def encode(self, task, block: dict) -> None:
+        finished = block.get('progress') == 'end'
+
+        with self.lock:
+            # 古い ffmpeg は out_time_ms の名前で同じマイクロ秒の値を書き出す
+            position = self.parse_number(block.get('out_time_us') or block.get('out_time_ms'))
+            if position is not None:
+                self.positions[task] = max(position / 1_000_000, 0.0)
+            if finished:
+                # 入力が想定より短い場合も、終了したタスクは出力し終えたものとする
+                self.positions[task] = self.durations.get(task) or self.positions.get(task, 0.0)
+                self.speeds.pop(task, None)
+                self.fps.pop(task, None)
+            else:
+                self.speeds[task] = self.parse_number(block.get('speed', '').rstrip('x'))
+                self.fps[task]    = self.parse_number(block.get('fps'))
+
+            self._emit(self.encode_progress(), force=finished)
+
+    # 全タスクの出力済みの長さと速度から、割合・エンコード速度・残り時間を求める
+    def encode_progress(self) -> dict:
+        done   = sum(self.positions.values())
+        speed  = sum(s for s in self.speeds.values() if s)
+        fps    = sum(f for f in self.fps.values() if f)
+        total  = None
+        if self.durations and all(self.durations.get(task) for task in self.positions):
+            total = sum(self.durations.values())
+
+        if total:
+            done = sum(min(position, self.durations[task]) for task, position in self.positions.items())
+        return {
+            'stage'    : 'encode',
+            'percent'  : round(min(done / total * 100, 100.0), 1) if total else None,
+            'out_time' : round(done, 2),
+            'fps'      : round(fps, 1) if fps else None,
+            'speed'    : round(speed, 2) if speed else None,
+            'eta'      : round((total - done) / speed, 1) if total and speed else None,
+        }
+
+    def emit(self, progress: dict, force: bool = False) -> None:
+        with self.lock:
+            self._emit(progress, force)
+
+    # 前回の送信から interval が経っていなければ送らない（段階の始まりと終わりは必ず送る）
+    # 進捗は変換の補助情報のため、送信に失敗しても変換は止めない
+    def _emit(self, progress: dict, force: bool) -> None:
+        now   = time.monotonic()
+        force = force or progress['stage'] != self.stage
+        if self.closed or (not force and now - self.sent_at < self.interval):
+            return
+        self.sent_at = now
+        self.stage   = progress['stage']
+        try:
+            self.send(progress)
+        except Exception:
+            self.closed = True
+
+    # -progress の数値の欄を読む（N/A などの数値でない値は None）
+    @staticmethod
+    def parse_number(value: str | None) -> float | None:
+        try:
+            return float(value)
+        except (TypeError, ValueError):
+            return None
@@ -0,0 +1,156 @@
+import ipaddress
+import math
+import threading
+import time
+
+
+# バイト数の制限で、溜めておける量を何秒分の転送量にするか（短いアップロードの連続を許す幅）
+RATE_LIMIT_BURST_SECONDS = 10
+
+# 状態を保持するクライアント数の上限。超えたら、制限に掛かっておらず処理中でもないクライアントを忘れる
+RATE_LIMIT_MAX_CLIENTS = 10000
+
+
+# 制限を超えたリクエストの拒否。details はエラー応答にそのまま含める
+class RateLimitExceeded(Exception):
+
+    def __init__(self, message: str, limit: str, retry_after: float | None = None):
+        super().__init__(message)
+        self.limit   = limit
+        self.details = {
+            'error_code'  : 'rate_limited',
+            'limit'       : limit,
+            'retry_after' : None if retry_after is None else math.ceil(retry_after),
+        }
+
+
+# rate ずつ溜まり、capacity まで溜めておけるトークン
+class TokenBucket:
+
+    def __init__(self, rate: float, capacity: float, now: float):
+        self.rate     = rate
+        self.capacity = capacity
+        self.tokens   = capacity
+        self.updated  = now
+
+    def refill(self, now: float) -> None:
+        self.tokens  = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    # tokens が needed に戻るまでの秒数
+    def wait_time(self, needed: float) -> float:
+        return max(needed - self.tokens, 0.0) / self.rate
+
+
+class ClientState:
+
+    def __init__(self):
+        self.requests   = None   # リクエスト数のトークン（制限しなければ None）
+        self.bytes      = None   # 転送量のトークン（制限しなければ None）
+        self.transcodes = 0      # 処理中の変換の数
+
+
+# クライアント（IP アドレス）ごとに、リクエスト数/分・転送量（バイト/秒）・同時に行う変換の数を制限する
+# リクエストのヘッダーだけで判断できるよう、転送量は申告されたファイルサイズを受け付け時に前借りし
+# 前借りで不足している（前のアップロードの分を払い終えていない）間は拒否する。1 つの大きなファイルは拒まない
+# 受信しなかった分（重複アップロード・再開したアップロード）は、処理の終了時に返す
+class ClientRateLimiter:
+
+    # exempt は制限しないアドレス・ネットワーク（"10.0.0.5" や "10.0.0.0/24"）の一覧
+    # coordinator や GUI のように、多くの利用者の要求を 1 つのアドレスからまとめて送ってくる相手を指定する
+    def __init__(self, requests_per_minute: float = 0, bytes_per_second: float = 0, max_transcodes: int = 0,
+                 burst_seconds: float = RATE_LIMIT_BURST_SECONDS, max_clients: int = RATE_LIMIT_MAX_CLIENTS,
+                 exempt: list | None = None):
+        self.requests_per_minute = requests_per_minute
+        self.bytes_per_second    = bytes_per_second
+        self.max_transcodes      = max_transcodes
+        self.burst_seconds       = burst_seconds
+        self.max_clients         = max_clients
+        self.exempt              = [ipaddress.ip_network(network, strict=False) for network in exempt or ()]
+
+        self.lock    = threading.Lock()
+        self.clients = {}   # IP アドレス → ClientState
+
+    # 制限を超えていれば RateLimitExceeded を送出し、超えていなければリクエスト数と転送量を消費する
+    # transcode が True の場合は変換の枠も確保するため、終了時に必ず release を呼ぶ
+    def admit(self, client_ip: str, file_size: int, transcode: bool) -> None:
+        if self.exempts(client_ip):
+            return
+        now = time.monotonic()
+        with self.lock:
+            state = self.clients.get(client_ip)
+            if state is None:
+                if len(self.clients) >= self.max_clients:
+                    self._forget_idle(now)
+                state = self.clients[client_ip] = self._new_state(now)
+
+            if state.requests is not None:
+                state.requests.refill(now)
+                if state.requests.tokens < 1:
+                    self._reject(
+                        'requests_per_minute', state.requests.wait_time(1),
+                        f"Too many requests from {client_ip} (limit {self.requests_per_minute:g}/min)",
+                    )
+            if state.bytes is not None:
+                state.bytes.refill(now)
+                if state.bytes.tokens < 0:
+                    self._reject(
+                        'bytes_per_second', state.bytes.wait_time(0),
+                        f"Upload rate limit exceeded for {client_ip} (limit {self.bytes_per_second:g} bytes/s)",
+                    )
+            if transcode and self.max_transcodes and state.transcodes >= self.max_transcodes:
+                self._reject(
+                    'transcodes', None,
+                    f"Too many concurrent conversions from {client_ip} (limit {self.max_transcodes})",
+                )
+
+            if state.requests is not None:
+                state.requests.tokens -= 1
+            if state.bytes is not None:
+                state.bytes.tokens -= file_size
+            if transcode:
+                state.transcodes += 1
+
+    # 制限しないアドレスか（制限しないアドレスは状態も持たないため、release は何もしない）
+    def exempts(self, client_ip: str) -> bool:
+        if not self.exempt:
+            return False
+        try:
+            address = ipaddress.ip_address(client_ip)
+        except ValueError:
+            return False
+        return any(address in network for network in self.exempt)
+
+    # admit で確保した変換の枠を返し、前借りした転送量のうち受信しなかった分を返す
+    def release(self, client_ip: str, transcode: bool, unused_bytes: int = 0) -> None:
+        with self.lock:
+            state = self.clients.get(client_ip)
+            if state is None:
+                return
+            if transcode:
+                state.transcodes -= 1
+            if state.bytes is not None and unused_bytes > 0:
+                state.bytes.tokens = min(state.bytes.capacity, state.bytes.tokens + unused_bytes)
+
+    def _new_state(self, now: float) -> ClientState:
+        state = ClientState()
+        if self.requests_per_minute:
+            state.requests = TokenBucket(self.requests_per_minute / 60, self.requests_per_minute, now)
+        if self.bytes_per_second:
+            state.bytes = TokenBucket(self.bytes_per_second, self.bytes_per_second * self.burst_seconds, now)
+        return state
+
+    @staticmethod
+    def _reject(limit: str, retry_after: float | None, message: str) -> None:
+        if retry_after is not None:
+            message += f"; retry after {math.ceil(retry_after)} s"
+        raise RateLimitExceeded(message, limit, retry_after)
+
+    # トークンが満杯まで戻り、処理中の変換もないクライアントは、忘れても制限の結果が変わらない
+    def _forget_idle(self, now: float) -> None:
+        for client_ip, state in list(self.clients.items()):
+            buckets = [bucket for bucket in (state.requests, state.bytes) if bucket is not None]
+            for bucket in buckets:
+                bucket.refill(now)
+            if state.transcodes == 0 and all(bucket.tokens >= bucket.capacity for bucket in buckets):
+                del self.clients[client_ip]
@@ -0,0 +1,118 @@
+import hashlib
+import json
+import os
+import shutil
+import threading
+from collections import OrderedDict
+from pathlib import Path
+
+
+# キャッシュキーに含めない（変換結果に影響しない）リクエスト項目
+TRANSPORT_KEYS = {
+    'file_name', 'frame_size', 'stream_response', 'content_hash', 'upload_id', 'download_offset', 'keep_alive',
+    'progress', 'possession_proof',
+}
+
+
+# 内容ハッシュなどのキーでファイルを保持する、容量上限付きの LRU ストア
+# 変換結果のキャッシュと、重複アップロードを省くための入力ファイルの保持の両方に使う
+class ResultCache:
+
+    # namespace は同じパラメータでも変換結果が変わるサーバ側の設定（エンコードのプロファイルなど）
+    def __init__(self, cache_dir: str = "processed/cache", max_bytes: int = 10 * 1024 ** 3, namespace: str = ''):
+        Path(cache_dir).mkdir(parents=True, exist_ok=True)
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.namespace = namespace
+
+        self.lock      = threading.Lock()
+        self.entries   = OrderedDict()   # キー → (パス, サイズ)。末尾ほど最近使われたもの
+        self.total     = 0
+        self.hits      = 0
+        self.misses    = 0
+        self.evictions = 0
+
+        self._load_entries()
+
+    # アップロード内容のハッシュと、正規化した変換パラメータからキャッシュキーを作成
+    def make_key(self, content_hash: str, media_type: str, json_file: dict) -> str:
+        params = {k: v for k, v in json_file.items() if k not in TRANSPORT_KEYS}
+        canonical = json.dumps(params, sort_keys=True, separators=(',', ':'), ensure_ascii=False)
+        # 名前空間が空の場合は、導入前と同じキーになるようにする
+        prefix = f"{self.namespace}\n" if self.namespace else ''
+        return hashlib.sha256(
+            f"{prefix}{content_hash}\n{media_type.lower()}\n{canonical}".encode('utf-8')
+        ).hexdigest()
+
+    # キーに対応する変換結果を dest_path に用意する（ヒットしなければ False）
+    def fetch(self, key: str, dest_path: str) -> bool:
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return False
+            self.entries.move_to_end(key)
+            self.hits += 1
+
+            # 取り出し中に追い出されないよう、ロック中にリンク（またはコピー）する
+            self._link_or_copy(entry[0], dest_path)
+            return True
+
+    # 変換結果をキャッシュに登録し、上限を超えた分を古い順に追い出す
+    def store(self, key: str, output_file_path: str) -> None:
+        cache_path = os.path.join(self.cache_dir, key + Path(output_file_path).suffix)
+
+        with self.lock:
+            if key in self.entries:
+                self.entries.move_to_end(key)
+                return
+
+            size = os.path.getsize(output_file_path)
+            if size > self.max_bytes:
+                return
+
+            self._link_or_copy(output_file_path, cache_path)
+            self.entries[key] = (cache_path, size)
+            self.total       += size
+            self._evict()
+
+    # ヒット数・ミス数・追い出し数と現在の使用量を返す
+    def stats(self) -> dict:
+        with self.lock:
+            return {
+                'hits'      : self.hits,
+                'misses'    : self.misses,
+                'evictions' : self.evictions,
+                'entries'   : len(self.entries),
+                'bytes'     : self.total,
+            }
+
+    # 合計サイズが上限以下になるまで、最も長く使われていないものから削除
+    def _evict(self) -> None:
+        while self.total > self.max_bytes and self.entries:
+            _, (path, size) = self.entries.popitem(last=False)
+            self.total     -= size
+            self.evictions += 1
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+
+    # 起動時に既存のキャッシュファイルを最終アクセス順に読み込む
+    def _load_entries(self) -> None:
+        files = [p for p in Path(self.cache_dir).iterdir() if p.is_file()]
+        for path in sorted(files, key=lambda p: p.stat().st_atime):
+            size = path.stat().st_size
+            self.entries[path.stem] = (str(path), size)
+            self.total += size
+        self._evict()
+
+    # 同じファイルシステム上ならハードリンク、できなければコピー
+    @staticmethod
+    def _link_or_copy(src: str, dst: str) -> None:
+        if os.path.exists(dst):
+            os.remove(dst)
+        try:
+            os.link(src, dst)
+        except OSError:
+            shutil.copyfile(src, dst)
@@ -1,35 +1,248 @@
+import hashlib
+import hmac
 import json
+import math
 import os
+import queue
+import re
+import secrets
+import shutil
+import signal
 import socket
+import subprocess
+import tempfile
+import threading
+import time
+import traceback
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
 from datetime import datetime
+from fractions import Fraction
 from pathlib import Path
 
 import ffmpeg
 from Crypto.Cipher import AES, PKCS1_OAEP
 from Crypto.PublicKey import RSA
 
+from idle_sessions import MAX_IDLE_SESSIONS, IdleSessions
+from job_queue import JOB_DONE, JOB_FAILED, JOB_QUEUED, JobQueue, WorkerPool
+from media_index import MediaIndex
+from metrics import METRICS_ADDRESS, METRICS_PORT, MetricsRegistry, MetricsServer, RequestMetrics
+from progress import FFMPEG_PROGRESS_ARGS, ProgressReporter
+from rate_limiter import RATE_LIMIT_BURST_SECONDS, ClientRateLimiter, RateLimitExceeded
+from result_cache import ResultCache
+from session_tickets import (
+    KEY_FLAG_TICKET, RESUME_FLAG, RESUME_NONCE_SIZE, TICKET_ID_SIZE, SessionTickets, derive_resumed_key
+)
 from sqlite_logger import log_start, log_end
 
 
+# 鍵交換時にクライアントが指定する暗号モード
+CIPHER_MODE_CFB = 0   # フレームごとに同じ IV から暗号化し直す旧方式
+CIPHER_MODE_CTR = 1   # 方向ごとに 1 つの CTR ストリームをセッション全体で使う方式
+
+# 1 フレームで送受信できる平文の最大サイズ（大きなフレームの要求もここで頭打ちにする）
+MAX_FRAME_SIZE  = 4 * 1024 * 1024
+
+# 既定の待ち受けポート（SERVER_PORT で変更する）
+SERVER_PORT     = 9001
+
+# 先頭から順に読めば解析できる（標準入力から ffmpeg に渡せる）コンテナ
+PIPEABLE_MEDIA_TYPES    = {'.ts', '.m2ts', '.mkv', '.webm', '.flv', '.mpeg', '.mpg'}
+# moov ボックスが mdat より前にある場合（faststart）に限り標準入力から渡せるコンテナ
+FASTSTART_MEDIA_TYPES   = {'.mp4', '.m4v', '.mov'}
+# アップロードを受信しながら変換できる操作（圧縮・音声変換）
+PIPEABLE_OPERATIONS     = {1, 4}
+
+# 複数の操作を 1 回の ffmpeg 実行にまとめるパイプライン操作のコードと、その中で使える操作
+OPERATION_PIPELINE      = 6
+PIPELINE_OPERATIONS     = {1, 2, 3}
+# 1 回のアップロードから複数の出力をまとめて作るファンアウト操作のコード
+OPERATION_FANOUT        = 7
+# キューに積んだジョブの状態確認・結果取得を行う操作のコード
+OPERATION_FETCH_JOB     = 8
+# 分散ワーカーとして動く際に、coordinator からの死活監視に負荷を返す操作のコード
+OPERATION_HEALTH        = 9
+
+# 再開可能なアップロードの ID として受け付ける形式（パスに使うため英数字などに限る）
+UPLOAD_ID_PATTERN       = re.compile(r'[0-9A-Za-z_-]{1,64}')
+# 再試行されずに残った受信途中のファイルを探して削除する間隔（秒）
+PARTIAL_SWEEP_INTERVAL  = 600
+# 保持済みの内容を使わせる前に、クライアントがファイルを持っていることを確かめるために読ませる範囲の数と長さ
+POSSESSION_SAMPLES      = 4
+POSSESSION_SAMPLE_SIZE  = 4096
+# 解像度（"1280:720"）とビットレート（"500k"・"1.5M" など）として受け付ける形式
+RESOLUTION_PATTERN      = re.compile(r'(\d{1,5}):(-?\d{1,5})')
+BITRATE_PATTERN         = re.compile(r'\d+(\.\d+)?[kKmM]?')
+
+# アップロードの先頭フレームを解析する ffprobe の待ち時間（秒）
+HEAD_PROBE_TIMEOUT      = 10
+# 先頭部分のヘッダーに長さが記録されるコンテナ（それ以外は先頭部分から長さを推定するため、検証に使わない）
+HEADER_DURATION_TYPES   = {'.mp4', '.m4v', '.mov', '.mkv', '.webm'}
+# エラー応答の後、クライアントが送信をやめて切断するのを待つ時間（秒）
+LINGER_TIMEOUT          = 2.0
+
+# キーフレーム位置で分割して並列に変換できる操作（フレーム単位で完結する映像の変換）
+SEGMENTABLE_OPERATIONS  = {1, 2, 3, OPERATION_PIPELINE}
+# 分割して変換する入力の最短の長さ（秒）。これより短い動画は分割の手間の方が大きい
+SEGMENT_MIN_DURATION    = 60
+
+# 入力によっては再エンコードせず、ストリームをコピーするだけで済ませられる操作（アスペクト比変更・音声変換）
+STREAM_COPY_OPERATIONS  = {3, 4}
+# 表示アスペクト比をビットストリーム上で書き換えられる映像コーデックと、そのためのビットストリームフィルタ
+ASPECT_METADATA_FILTERS = {'h264': 'h264_metadata', 'hevc': 'hevc_metadata'}
+# H.264 / H.265 の SAR（画素のアスペクト比）の分子・分母に使える最大値
+MAX_SAR_TERM            = 65535
+# 音声変換で選べる出力形式と、再エンコードする場合のエンコーダ・そのまま格納できる音声コーデック
+AUDIO_FORMATS           = {
+    'mp3'  : {'acodec': 'mp3',     'copyable': {'mp3'}},
+    'm4a'  : {'acodec': 'aac',     'copyable': {'aac', 'alac'}},
+    'opus' : {'acodec': 'libopus', 'copyable': {'opus'}},
+    'flac' : {'acodec': 'flac',    'copyable': {'flac'}},
+}
+DEFAULT_AUDIO_FORMAT    = 'mp3'
+
+# GIF 作成で選べる出力形式（GIF はパレットを作ってから減色し、WebP はフルカラーのまま圧縮する）
+ANIMATION_FORMATS       = {'gif', 'webp'}
+# GIF 作成の既定値と、指定できる幅・フレームレート・長さ（秒）の上限
+GIF_DEFAULT_FPS         = 10
+GIF_DEFAULT_WIDTH       = 320
+GIF_MAX_FPS             = 50
+GIF_MAX_WIDTH           = 1920
+GIF_MAX_DURATION        = 60
+# 1 回のデコードでパレットの作成と減色を行う場合、パレットを作り終えるまで範囲のフレームをメモリに保持する
+# 保持する量の見積もりがこれを超える GIF は、先にパレットだけを作ってから減色する（デコードは 2 回になる）
+GIF_SINGLE_PASS_BYTES   = 1024 ** 3
+# 作成したパレットを保持する容量（同じ入力・同じ範囲の GIF はパレットの作成を省く）
+PALETTE_CACHE_BYTES     = 64 * 1024 * 1024
+
+# 映像を再エンコードする際の速度とサイズのトレードオフを決めるプロファイル（PERFORMANCE_PROFILE で選択）
+# crf は解像度変更などの変換で画質を保つための値、compress_crf はビットレート指定のない圧縮で使う値
+PERFORMANCE_PROFILES    = {
+    # 速度優先。エンコードが最も速く、出力は大きめ
+    'fast'     : {'vcodec': 'libx264', 'preset': 'veryfast', 'crf': 23, 'compress_crf': 28, 'tune': 'fastdecode',
+                  'two_pass': False},
+    # 速度とサイズの釣り合いを取る既定のプロファイル
+    'balanced' : {'vcodec': 'libx264', 'preset': 'medium',   'crf': 23, 'compress_crf': 28, 'tune': None,
+                  'two_pass': False},
+    # サイズ優先。H.265 で時間をかけて小さくし、ビットレート指定の圧縮は 2 パスで配分する
+    'archival' : {'vcodec': 'libx265', 'preset': 'slow',     'crf': 26, 'compress_crf': 31, 'tune': None,
+                  'two_pass': True},
+}
+DEFAULT_PROFILE         = 'balanced'
+# プロファイルのエンコーダ（H.264 / H.265）で書き出せるコンテナ。それ以外はコンテナ既定のエンコーダを使う
+PROFILE_MEDIA_TYPES     = {'.mp4', '.m4v', '.mov', '.mkv', '.ts', '.m2ts'}
+# プロファイルを使えないコンテナで、ビットレート指定のない圧縮に使うビットレート
+DEFAULT_BITRATE         = '1M'
+
+# ストリーミング応答でファイルサイズ欄に入れる値（全体の長さが未確定であることを示す）
+STREAMING_FILE_SIZE     = (1 << 40) - 1
+# 標準出力へ書き出す際に ffmpeg に指定する出力フォーマット（拡張子ごと）
+STREAMING_FORMATS       = {
+    '.mp4'  : 'mp4',
+    '.m4v'  : 'mp4',
+    '.mov'  : 'mov',
+    '.mkv'  : 'matroska',
+    '.webm' : 'webm',
+    '.ts'   : 'mpegts',
+    '.flv'  : 'flv',
+    '.mp3'  : 'mp3',
+    '.m4a'  : 'mp4',
+    '.opus' : 'opus',
+    '.flac' : 'flac',
+    '.gif'  : 'gif',
+    '.webp' : 'webp',
+}
+
 
 class RSAKeyExchange:
     
-    # RSA鍵ペアを生成（2048ビット）
-    def __init__(self):
-        self.private_key = RSA.generate(2048)
+    # RSA鍵ペアを生成（2048ビット）。事前生成済みの鍵が渡された場合はそれを使う
+    def __init__(self, private_key=None):
+        self.private_key = private_key or RSA.generate(2048)
 
     # 公開鍵をバイト列として返す（送信用）
     def public_key_bytes(self):
         return self.private_key.publickey().export_key()
 
     def decrypt_symmetric_key(self, encrypted):
-        # クライアントから受信した AES 鍵＋IV を復号
+        # クライアントから受信した AES 鍵＋IV（＋暗号モード）を復号
         decrypted_bytes = PKCS1_OAEP.new(self.private_key).decrypt(encrypted)
 
-        # 復号結果から AES 鍵と IV を分離して返す（それぞれ 16 バイト）
+        # 復号結果から AES 鍵と IV を分離（それぞれ 16 バイト）
         aes_key = decrypted_bytes[:16]
         iv      = decrypted_bytes[16:32]
-        return aes_key, iv
+
+        # 33 バイト目があれば暗号モード。旧クライアント（32 バイト）は CFB とみなす
+        cipher_mode = decrypted_bytes[32] if len(decrypted_bytes) > 32 else CIPHER_MODE_CFB
+        # 34 バイト目があればフラグ（チケットの要求など）
+        flags       = decrypted_bytes[33] if len(decrypted_bytes) > 33 else 0
+        return aes_key, iv, cipher_mode, flags
+
+
+class RSAKeyPool:
+
+    # 事前生成した RSA 鍵ペアを保持し、バックグラウンドスレッドで補充する
+    def __init__(self, size=8):
+        self.size       = size
+        self.keys       = queue.Queue(maxsize=max(size, 1))
+        self.hits       = 0
+        self.misses     = 0
+        self.lock       = threading.Lock()
+        self.stop_event = threading.Event()
+
+        # size が 0 の場合はプールを使わず、毎回その場で生成する
+        if self.size > 0:
+            threading.Thread(target=self.refill, daemon=True).start()
+
+    # プールが満杯になるまで鍵を生成し続ける（満杯の間は待機）
+    def refill(self):
+        while not self.stop_event.is_set():
+            private_key = RSA.generate(2048)
+            while not self.stop_event.is_set():
+                try:
+                    self.keys.put(private_key, timeout=0.5)
+                    break
+                except queue.Full:
+                    continue
+
+    # プールから鍵を 1 つ取り出す（空ならその場で生成）。鍵は 1 接続につき 1 回だけ使う
+    def acquire(self):
+        try:
+            private_key = None if self.size == 0 else self.keys.get_nowait()
+        except queue.Empty:
+            private_key = None
+
+        with self.lock:
+            if private_key is None:
+                self.misses += 1
+            else:
+                self.hits   += 1
+
+        return RSAKeyExchange(private_key)
+
+    # 公開鍵を送っただけで復号に使わなかった鍵をプールへ戻す（満杯なら捨てる）
+    def release(self, key_manager):
+        if self.size == 0:
+            return
+        try:
+            self.keys.put_nowait(key_manager.private_key)
+        except queue.Full:
+            pass
+
+    # プールのヒット数・ミス数・在庫数を返す
+    def stats(self):
+        with self.lock:
+            return {
+                'hits'      : self.hits,
+                'misses'    : self.misses,
+                'available' : self.keys.qsize() if self.size > 0 else 0,
+            }
+
+    # 補充スレッドを停止する
+    def close(self):
+        self.stop_event.set()
 
 
 class AESCipherCFB:
@@ -39,13 +252,50 @@ class AESCipherCFB:
         self.key = key
         self.iv  = iv
 
-    # AES CFBモードでデータを暗号化して返す
-    def encrypt(self, data):
-        return AES.new(self.key, AES.MODE_CFB, iv=self.iv, segment_size=128).encrypt(data)
+    # AES CFBモードでデータを暗号化して返す（output 指定時はそのバッファに書き込む）
+    def encrypt(self, data, output=None):
+        return AES.new(self.key, AES.MODE_CFB, iv=self.iv, segment_size=128).encrypt(data, output=output)
+
+    # AES CFBモードでデータを復号して返す（output 指定時はそのバッファに書き込む）
+    def decrypt(self, data, output=None):
+        return AES.new(self.key, AES.MODE_CFB, iv=self.iv, segment_size=128).decrypt(data, output=output)
+
+
+class AESCipherCTR:
+
+    # 送信用・受信用に 1 つずつ CTR 暗号器を作り、セッション全体でカウンタを進め続ける
+    # 方向ごとに nonce の末尾 1 バイトを変え、同じ鍵でも鍵ストリームが重ならないようにする
+    def __init__(self, key, iv, is_server=True):
+        client_nonce = iv[:7] + b'\x00'   # クライアント → サーバ
+        server_nonce = iv[:7] + b'\x01'   # サーバ → クライアント
+
+        send_nonce, recv_nonce = (server_nonce, client_nonce) if is_server else (client_nonce, server_nonce)
+        self.encryptor = AES.new(key, AES.MODE_CTR, nonce=send_nonce)
+        self.decryptor = AES.new(key, AES.MODE_CTR, nonce=recv_nonce)
+
+    # 送信方向の鍵ストリームでデータを暗号化（output 指定時はそのバッファに書き込む）
+    def encrypt(self, data, output=None):
+        return self.encryptor.encrypt(data, output=output)
+
+    # 受信方向の鍵ストリームでデータを復号（output 指定時はそのバッファに書き込む）
+    def decrypt(self, data, output=None):
+        return self.decryptor.decrypt(data, output=output)
+
+
+# クライアントが指定した暗号モードに対応する対称暗号オブジェクトを作成
+def create_session_cipher(aes_key, aes_iv, cipher_mode):
+    if cipher_mode == CIPHER_MODE_CTR:
+        return AESCipherCTR(aes_key, aes_iv)
+    if cipher_mode == CIPHER_MODE_CFB:
+        return AESCipherCFB(aes_key, aes_iv)
+    raise ValueError(f"Unsupported cipher mode: {cipher_mode}")
+
 
-    # AES CFBモードでデータを復号して返す
-    def decrypt(self, data):
-        return AES.new(self.key, AES.MODE_CFB, iv=self.iv, segment_size=128).decrypt(data)
+# ffmpeg の異常終了を表す例外。リクエストのログに残せるよう終了コードを付ける
+def ffmpeg_error(returncode):
+    error = ffmpeg.Error('ffmpeg', None, None)
+    error.returncode = returncode
+    return error
 
 
 class SecureSocket:
@@ -54,6 +304,11 @@ class SecureSocket:
     def __init__(self, sock, cipher):
         self.sock   = sock
         self.cipher = cipher
+        # 送信フレーム（長さ 4 バイト + 暗号文）を組み立てる再利用バッファ
+        self.send_buffer = bytearray()
+        # 送受信した平文のバイト数（リクエストごとの転送量の計測に使う）
+        self.bytes_sent     = 0
+        self.bytes_received = 0
 
     # 指定されたバイト数を受信するまで繰り返す
     def recv_exact(self, n):
@@ -67,110 +322,1211 @@ class SecureSocket:
 
     # 平文を暗号化し、長さ（4バイト）付きで送信
     def sendall(self, plaintext):
-        encrypted = self.cipher.encrypt(plaintext)
-        self.sock.sendall(len(encrypted).to_bytes(4, 'big') + encrypted)
+        size = len(plaintext)
+        if len(self.send_buffer) < size + 4:
+            self.send_buffer = bytearray(size + 4)
+
+        # 連結によるコピーを避け、再利用バッファへ直接暗号文を書き込む
+        frame = memoryview(self.send_buffer)[:size + 4]
+        frame[:4] = size.to_bytes(4, 'big')
+        self.cipher.encrypt(plaintext, output=frame[4:])
+        self.sock.sendall(frame)
+        self.bytes_sent += size
+
+    # バッファ上の平文をその場で暗号化し、長さと暗号文を連結せずに送信（内容は暗号文で上書きされる）
+    def sendall_inplace(self, view):
+        self.cipher.encrypt(view, output=view)
+        buffers = [len(view).to_bytes(4, 'big'), view]
+        self.bytes_sent += len(view)
+
+        if not hasattr(self.sock, 'sendmsg'):
+            for buffer in buffers:
+                self.sock.sendall(buffer)
+            return
+
+        # sendmsg で長さと暗号文をまとめて送り、一部だけ送れた場合は残りを送り直す
+        while buffers:
+            sent = self.sock.sendmsg(buffers)
+            while sent:
+                if sent >= len(buffers[0]):
+                    sent -= len(buffers[0])
+                    buffers.pop(0)
+                else:
+                    buffers[0] = memoryview(buffers[0])[sent:]
+                    sent = 0
+
+    # 最初の4バイトで受信データの長さを取得（上限を超えるフレームは拒否）
+    def recv_length(self):
+        length = int.from_bytes(self.recv_exact(4), 'big')
+        if length > MAX_FRAME_SIZE:
+            raise ValueError(f"Frame too large: {length} bytes")
+        return length
 
     def recv(self):
-        # 最初の4バイトで受信データの長さを取得
-        length_bytes = self.recv_exact(4)
         # 指定バイト数のデータを受信し、復号して返す
-        encrypted_data = self.recv_exact(int.from_bytes(length_bytes, 'big'))
+        encrypted_data = self.recv_exact(self.recv_length())
+        self.bytes_received += len(encrypted_data)
         return self.cipher.decrypt(encrypted_data)
 
+    # 1 フレームを buffer に直接受信し、その場で復号して平文部分の memoryview を返す
+    def recv_into(self, buffer):
+        length = self.recv_length()
+        view   = memoryview(buffer)[:length]
+
+        received = 0
+        while received < length:
+            n = self.sock.recv_into(view[received:])
+            if n == 0:
+                return view[:0]
+            received += n
+
+        self.bytes_received += length
+        self.cipher.decrypt(view, output=view)
+        return view
+
 
 class MediaProcessor:
     
     # メディアファイル保存用ディレクトリを作成
-    def __init__(self, dpath='processed'):
-        self.dpath = dpath
+    # segment_workers は長い動画を分割して並列に変換する際の同時実行数（1 で分割しない）
+    # profile は再エンコードに使う PERFORMANCE_PROFILES の名前、threads は ffmpeg のスレッド数（0 で自動）
+    # stream_copy は入力を解析し、再エンコードせずに済む変換をストリームのコピーで行うか
+    # palette_cache_bytes は GIF のパレットを保持する容量（0 でパレットを毎回作成する）
+    # media_index_entries は入力の解析結果を内容ハッシュごとに保持する件数（0 で保持しない）
+    def __init__(self, dpath='processed', segment_workers=1, profile=DEFAULT_PROFILE, threads=0, stream_copy=True,
+                 palette_cache_bytes=PALETTE_CACHE_BYTES, media_index_entries=10000):
+        if profile not in PERFORMANCE_PROFILES:
+            raise ValueError(f"Unknown performance profile: {profile}")
+
+        self.dpath           = dpath
+        self.segment_workers = segment_workers
+        self.profile         = profile
+        self.threads         = threads
+        self.stream_copy     = stream_copy
+        self.palette_cache_bytes = palette_cache_bytes
+        # 出力先ごとのエンコード速度・出力サイズ（応答を送る際に取り出す）
+        self.encode_stats    = {}
+        self.media_index     = MediaIndex(media_index_entries)
+        # パレットの保存先。ジョブのワーカープロセスへ渡せるよう、最初に使う際にプロセスごとに作る
+        self._palette_cache  = None
         os.makedirs(self.dpath, exist_ok=True)
 
+    # ワーカープロセスへ渡す際は、ロックを持つパレットの保存先を除く
+    def __getstate__(self):
+        return {**self.__dict__, '_palette_cache': None}
+
     # クライアントからファイルを受信し、保存
-    def save_file(self, connection, file_path, file_size):
-        with open(file_path, 'wb+') as f:
+    # hasher が渡された場合は、受信しながら内容のハッシュも計算する
+    # offset が指定された場合は、受信済みの部分に続きを追記する
+    # progress が渡された場合は、受信済みのバイト数を通知する
+    def save_file(self, connection, file_path, file_size, head=b'', hasher=None, offset=0, progress=None):
+        # 受信用バッファを使い回し、フレームごとの bytes 生成を避ける
+        buffer = bytearray(MAX_FRAME_SIZE)
+        total  = file_size
+
+        if offset and hasher is not None:
+            # 前回までに受信済みの部分は、ハッシュだけ計算し直す
+            with open(file_path, 'rb') as f:
+                while n := f.readinto(buffer):
+                    hasher.update(memoryview(buffer)[:n])
+        file_size -= offset
+
+        with open(file_path, 'ab' if offset else 'wb+') as f:
+            # 判定のために先読みしたフレームがあれば先に書き込む
+            f.write(head)
+            file_size -= len(head)
+            if hasher is not None:
+                hasher.update(head)
+
             while file_size > 0:
-                chunk = connection.recv()
+                chunk = connection.recv_into(buffer)
                 if not chunk:
                     break
                 f.write(chunk)
                 file_size -= len(chunk)
-
-    # 動画ファイルを指定ビットレートで圧縮
-    def compress_video(self, input_file_path, file_name, bitrate='1M'):
-        output_file_path = os.path.join(self.dpath, f'compressed_{file_name}')
-        ffmpeg.input(input_file_path).output(output_file_path, b=bitrate).overwrite_output().run()
-        os.remove(input_file_path)
+                if hasher is not None:
+                    hasher.update(chunk)
+                if progress is not None:
+                    progress.upload(total - file_size, total)
+
+    # アップロードを受信しながら ffmpeg の標準入力へ流し込み、受信と変換を並行させる
+    # progress が渡された場合は、受信の進捗と ffmpeg の進捗を別々のスレッドから通知する
+    def pipe_file(self, connection, json_file, file_size, head=b'', hasher=None, progress=None):
+        stream, output_file_path = self.operation_stream(json_file, 'pipe:')
+        started = time.perf_counter()
+        process = self.start_ffmpeg(stream, progress, pipe_stdin=True)
+
+        reader = None
+        if progress is not None:
+            reader = threading.Thread(target=progress.follow, args=(process.stdout,), daemon=True)
+            reader.start()
+
+        self.feed_process(connection, process, file_size, head, hasher, progress)
+
+        returncode = process.wait()
+        if reader is not None:
+            reader.join()
+            process.stdout.close()
+        if returncode != 0:
+            raise ffmpeg_error(returncode)
+        self.record_encode_stats(output_file_path, time.perf_counter() - started)
         return output_file_path
 
+    # 受信したフレームを ffmpeg の標準入力へ書き込み、最後に入力を閉じる
+    def feed_process(self, connection, process, file_size, head=b'', hasher=None, progress=None):
+        hasher = hasher or hashlib.sha256()
+        total  = file_size
+        try:
+            process.stdin.write(head)
+            file_size -= len(head)
+            hasher.update(head)
+
+            buffer = bytearray(MAX_FRAME_SIZE)
+            while file_size > 0:
+                chunk = connection.recv_into(buffer)
+                if not chunk:
+                    break
+                # 暗号化用バッファではないため、書き込み後にハッシュを更新しても内容は変わらない
+                process.stdin.write(chunk)
+                file_size -= len(chunk)
+                hasher.update(chunk)
+                if progress is not None:
+                    progress.upload(total - file_size, total)
+        except BrokenPipeError:
+            # ffmpeg が入力を読み終える前に終了した（成否は終了コードで判定する）
+            pass
+        finally:
+            # 入力の終わりを ffmpeg に伝える（ffmpeg が先に終了していれば書き込みは失敗する）
+            try:
+                process.stdin.close()
+            except BrokenPipeError:
+                pass
+
+    # 出力先を標準出力に差し替えたコマンドで ffmpeg を起動（出力形式が未対応なら None）
+    def start_streaming(self, stream, output_file_path, pipe_stdin=False):
+        args = self.streaming_args(stream, output_file_path)
+        if args is None:
+            return None
+        return subprocess.Popen(args, stdin=subprocess.PIPE if pipe_stdin else None, stdout=subprocess.PIPE)
+
+    # 出力先を標準出力に差し替えた ffmpeg の引数（出力形式が未対応なら None）
+    def streaming_args(self, stream, output_file_path):
+        output_format = STREAMING_FORMATS.get(Path(output_file_path).suffix.lower())
+        if output_format is None:
+            return None
+
+        # 追記のみで書き出せるよう、MP4 / MOV は断片化 (fragmented MP4) して出力する
+        options = ['-f', output_format]
+        if output_format in ('mp4', 'mov'):
+            options += ['-movflags', 'frag_keyframe+empty_moov+default_base_moof']
+
+        args  = stream.compile()
+        index = args.index(output_file_path)
+        return args[:index] + options + ['pipe:'] + args[index + 1:]
+
+    # 操作が標準入力からの変換に対応しているか
+    @staticmethod
+    def supports_pipe(operation):
+        return operation in PIPEABLE_OPERATIONS
+
+    # 先頭フレームとメディアタイプから、標準入力で渡せるコンテナか判定
+    @staticmethod
+    def is_pipeable(media_type, head):
+        media_type = media_type.lower()
+        if media_type in PIPEABLE_MEDIA_TYPES:
+            return True
+        if media_type not in FASTSTART_MEDIA_TYPES:
+            return False
+
+        # トップレベルのボックスを順にたどり、mdat より先に moov が現れるか確認
+        offset = 0
+        while offset + 8 <= len(head):
+            box_size = int.from_bytes(head[offset:offset + 4], 'big')
+            box_type = head[offset + 4:offset + 8]
+            if box_type == b'moov':
+                return True
+            if box_type == b'mdat':
+                return False
+            if box_size == 1 and offset + 16 <= len(head):
+                box_size = int.from_bytes(head[offset + 8:offset + 16], 'big')
+            if box_size < 8:
+                return False
+            offset += box_size
+        return False
+
+    # 動画ファイルを圧縮（ビットレートの指定がなければプロファイルの品質で圧縮）
+    def compress_video(self, input_file_path, file_name, bitrate=None):
+        stream, output_file_path = self.compress_video_stream(input_file_path, file_name, bitrate)
+        return self.run_stream(stream, input_file_path, output_file_path)
+
     # 指定された解像度に動画サイズを変更（アスペクト比は維持）
     def change_resolution(self, input_file_path, file_name, resolution):
-        width, _ = map(int, resolution.split(':'))
+        stream, output_file_path = self.change_resolution_stream(input_file_path, file_name, resolution)
+        return self.run_stream(stream, input_file_path, output_file_path)
+
+    # 動画の表示アスペクト比 (Display Aspect Ratio) を変更
+    def change_aspect_ratio(self, input_file_path, file_name, aspect_ratio):
+        stream, output_file_path = self.change_aspect_ratio_stream(input_file_path, file_name, aspect_ratio)
+        return self.run_stream(stream, input_file_path, output_file_path)
+
+    # 動画ファイルから音声を抽出して指定の形式（既定は MP3）に変換
+    def convert_to_audio(self, input_file_path, file_name, audio_format=DEFAULT_AUDIO_FORMAT):
+        stream, output_file_path = self.convert_to_audio_stream(input_file_path, file_name, audio_format)
+        return self.run_stream(stream, input_file_path, output_file_path)
+
+    # 指定範囲の映像をGIF（または WebP）として切り出し・保存
+    def create_gif(self, input_file_path, file_name, start_time, duration, fps=GIF_DEFAULT_FPS,
+                   width=GIF_DEFAULT_WIDTH, animation_format='gif'):
+        stream, output_file_path = self.create_gif_stream(
+            input_file_path, file_name, start_time, duration, fps, width, animation_format
+        )
+        return self.run_stream(stream, input_file_path, output_file_path)
+
+    # 圧縮用の ffmpeg コマンドと出力先を組み立てる
+    def compress_video_stream(self, input_file_path, file_name, bitrate=None):
+        output_file_path = os.path.join(self.dpath, f'compressed_{file_name}')
+        options = self.video_options(output_file_path, bitrate, compress=True)
+        stream = ffmpeg.input(input_file_path).output(output_file_path, **options).overwrite_output()
+        return stream, output_file_path
+
+    # 解像度変更用の ffmpeg コマンドと出力先を組み立てる
+    def change_resolution_stream(self, input_file_path, file_name, resolution):
+        width, _ = self.parse_resolution(resolution)
         vf = f"scale={width}:-2"
         output_file_path = os.path.join(self.dpath, f'changed_resolution_{file_name}')
-        ffmpeg.input(input_file_path).output(output_file_path, vf=vf).overwrite_output().run()
+        options = self.video_options(output_file_path)
+        stream = ffmpeg.input(input_file_path).output(output_file_path, vf=vf, **options).overwrite_output()
+        return stream, output_file_path
+
+    # アスペクト比変更用の ffmpeg コマンドと出力先を組み立てる
+    def change_aspect_ratio_stream(self, input_file_path, file_name, aspect_ratio):
+        output_file_path = os.path.join(self.dpath, f'changed_aspect_ratio_{file_name}')
+        options = self.video_options(output_file_path)
+        stream = ffmpeg.input(input_file_path).output(
+            output_file_path, vf=f"setdar={self.format_aspect_ratio(aspect_ratio)}", **options
+        ).overwrite_output()
+        return stream, output_file_path
+
+    # "1280:720" 形式の解像度を (幅, 高さ) にする（フィルタにそのまま埋め込まないよう数値に限る）
+    @staticmethod
+    def parse_resolution(resolution):
+        match = RESOLUTION_PATTERN.fullmatch(str(resolution))
+        if match is None or int(match.group(1)) == 0:
+            raise ValueError(f"Invalid resolution: {resolution}")
+        return int(match.group(1)), int(match.group(2))
+
+    # 表示アスペクト比を setdar に渡す "分子/分母" の形にする
+    def format_aspect_ratio(self, aspect_ratio):
+        ratio = self.parse_aspect_ratio(aspect_ratio)
+        if ratio is None:
+            raise ValueError(f"Invalid aspect ratio: {aspect_ratio}")
+        return f"{ratio.numerator}/{ratio.denominator}"
+
+    # 出力先の形式とプロファイルから、映像を再エンコードする際の ffmpeg のオプションを作る
+    # ビットレートの指定があれば平均ビットレートで、なければ CRF（品質固定）で符号化する
+    def video_options(self, output_file_path, bitrate=None, compress=False):
+        options    = {'threads': self.threads} if self.threads else {}
+        media_type = Path(output_file_path).suffix.lower()
+
+        # H.264 / H.265 を格納できない形式は、コンテナ既定のエンコーダにビットレートだけを指定する
+        if media_type not in PROFILE_MEDIA_TYPES:
+            if bitrate or compress:
+                options['b:v'] = self.check_bitrate(bitrate) if bitrate else DEFAULT_BITRATE
+            return options
+
+        profile = PERFORMANCE_PROFILES[self.profile]
+        options.update(vcodec=profile['vcodec'], preset=profile['preset'])
+        if profile['tune']:
+            options['tune'] = profile['tune']
+        if profile['vcodec'] == 'libx265' and media_type in FASTSTART_MEDIA_TYPES:
+            # Apple 系のプレーヤーでも再生できるよう hvc1 として格納
+            options['tag:v'] = 'hvc1'
+
+        if bitrate:
+            options['b:v'] = self.check_bitrate(bitrate)
+        else:
+            options['crf'] = profile['compress_crf'] if compress else profile['crf']
+        return options
+
+    @staticmethod
+    def check_bitrate(bitrate):
+        if not BITRATE_PATTERN.fullmatch(str(bitrate)):
+            raise ValueError(f"Invalid bitrate: {bitrate}")
+        return bitrate
+
+    # ビットレート指定の圧縮を 2 パスで行うか（プロファイルが 2 パスで、H.264 / H.265 で書き出せる場合）
+    def uses_two_pass(self, json_file, output_file_path):
+        return (
+            PERFORMANCE_PROFILES[self.profile]['two_pass']
+            and json_file['operation'] == 1
+            and bool(json_file.get('bitrate'))
+            and Path(output_file_path).suffix.lower() in PROFILE_MEDIA_TYPES
+        )
+
+    # 1 パス目で映像全体を解析し、2 パス目で目標ビットレートの範囲で複雑な場面に多く配分する
+    # 進捗は 2 回分の長さに対する割合で通知する
+    def run_two_pass(self, json_file, input_file_path, output_file_path, progress=None, duration=None):
+        options  = self.video_options(output_file_path, json_file['bitrate'], compress=True)
+        work_dir = tempfile.mkdtemp(prefix='twopass_', dir=self.dpath)
+        if progress is not None:
+            progress.expect(1, duration)
+        try:
+            log_prefix = os.path.join(work_dir, 'pass')
+            source     = ffmpeg.input(input_file_path)
+            self.run_ffmpeg(source.output(
+                os.devnull, f='null', an=None, **options, **self.pass_options(options['vcodec'], 1, log_prefix)
+            ).overwrite_output(), progress, 0, duration)
+            self.run_ffmpeg(source.output(
+                output_file_path, **options, **self.pass_options(options['vcodec'], 2, log_prefix)
+            ).overwrite_output(), progress, 1)
+        finally:
+            shutil.rmtree(work_dir, ignore_errors=True)
+
         os.remove(input_file_path)
         return output_file_path
 
-    # 動画の表示アスペクト比 (Display Aspect Ratio) を変更
-    def change_aspect_ratio(self, input_file_path, file_name, aspect_ratio):
-        output_file_path = os.path.join(self.dpath, f'changed_aspect_ratio_{file_name}')
-        ffmpeg.input(input_file_path).output(output_file_path, vf=f"setdar={aspect_ratio}").overwrite_output().run()
+    # 2 パス符号化の何パス目かと、解析結果の保存先をエンコーダに渡すオプション
+    @staticmethod
+    def pass_options(vcodec, pass_number, log_prefix):
+        if vcodec == 'libx265':
+            return {'x265-params': f'pass={pass_number}:stats={log_prefix}.log'}
+        return {'pass': pass_number, 'passlogfile': log_prefix}
+
+    # 音声抽出用の ffmpeg コマンドと出力先を組み立てる
+    def convert_to_audio_stream(self, input_file_path, file_name, audio_format=DEFAULT_AUDIO_FORMAT):
+        if audio_format not in AUDIO_FORMATS:
+            raise ValueError(f"Unsupported audio format: {audio_format}")
+
+        output_file_path = os.path.join(self.dpath, f'converted_to_audio_{Path(file_name).stem}.{audio_format}')
+        stream = ffmpeg.input(input_file_path).output(
+            output_file_path, acodec=AUDIO_FORMATS[audio_format]['acodec']
+        ).overwrite_output()
+        return stream, output_file_path
+
+    # GIF 作成用の ffmpeg コマンドと出力先を組み立てる
+    # 入力側で開始位置を指定し、直前のキーフレームまでシークしてから範囲の分だけデコードする
+    # GIF は範囲の映像から作ったパレットで減色する。palette_path があればそのパレットを使い、
+    # palette_output があれば作成したパレットもそこへ書き出す
+    def create_gif_stream(self, input_file_path, file_name, start_time, duration, fps=GIF_DEFAULT_FPS,
+                          width=GIF_DEFAULT_WIDTH, animation_format='gif', palette_path=None, palette_output=None):
+        output_file_path = os.path.join(self.dpath, f'created_gif_{Path(file_name).stem}.{animation_format}')
+        frames = self.gif_frames(input_file_path, start_time, duration, fps, width)
+
+        if animation_format == 'webp':
+            stream = frames.output(output_file_path, vcodec='libwebp', lossless=0, quality=75, loop=0)
+            return stream.overwrite_output(), output_file_path
+
+        if palette_path is not None:
+            palette = ffmpeg.input(palette_path).video
+        else:
+            # 1 回のデコードで、パレットの作成と減色の両方に同じフレームを使う
+            frames  = frames.split()
+            palette = frames[1].filter('palettegen', stats_mode='diff')
+            frames  = frames[0]
+
+        outputs = []
+        if palette_output is not None:
+            palette = palette.split()
+            outputs.append(palette[1].output(palette_output, vframes=1, update=1))
+            palette = palette[0]
+
+        # 前のフレームから変化した矩形だけを書き換え、出力サイズを抑える
+        gif = ffmpeg.filter([frames, palette], 'paletteuse', dither='bayer', bayer_scale=5, diff_mode='rectangle')
+        outputs.insert(0, gif.output(output_file_path, loop=0))
+        return ffmpeg.merge_outputs(*outputs).overwrite_output(), output_file_path
+
+    # パレットだけを作成する ffmpeg コマンドを組み立てる（フレームは保持せず、色の集計だけを行う）
+    def create_palette_stream(self, input_file_path, palette_output, start_time, duration, fps=GIF_DEFAULT_FPS,
+                              width=GIF_DEFAULT_WIDTH, **_):
+        frames = self.gif_frames(input_file_path, start_time, duration, fps, width)
+        return frames.filter('palettegen', stats_mode='diff').output(palette_output, update=1).overwrite_output()
+
+    # 範囲を切り出し、GIF のフレームレートと幅に揃えたフレーム
+    # 入力側で開始位置を指定し、直前のキーフレームまでシークしてから範囲の分だけデコードする
+    @staticmethod
+    def gif_frames(input_file_path, start_time, duration, fps, width):
+        clip = ffmpeg.input(input_file_path, ss=start_time, t=duration)
+        return clip.video.filter('fps', fps).filter('scale', width, -1, flags='lanczos')
+
+    # 1 回のデコードで作成する場合に保持するフレームの量の見積もり（バイト）
+    # 高さは入力の縦横比に依るため、縦長の 9:16 とみなして多めに見積もる
+    @staticmethod
+    def gif_buffered_bytes(options):
+        frames = math.ceil(options['fps'] * options['duration'])
+        return frames * options['width'] * math.ceil(options['width'] * 16 / 9) * 4
+
+    # GIF 作成の範囲・フレームレート・幅・形式を取り出して検証する
+    @staticmethod
+    def gif_options(json_file):
+        try:
+            start_time = float(json_file.get('start_time') or 0)
+            duration   = float(json_file.get('duration'))
+            fps        = float(json_file.get('fps') or GIF_DEFAULT_FPS)
+            width      = int(json_file.get('width') or GIF_DEFAULT_WIDTH)
+        except (TypeError, ValueError):
+            raise ValueError("GIF requires a numeric start_time, duration, fps and width")
+
+        animation_format = json_file.get('animation_format') or 'gif'
+        if start_time < 0 or not 0 < duration <= GIF_MAX_DURATION:
+            raise ValueError(f"Invalid GIF range: start_time={start_time}, duration={duration}")
+        if not 0 < fps <= GIF_MAX_FPS or not 0 < width <= GIF_MAX_WIDTH:
+            raise ValueError(f"Invalid GIF size: fps={fps}, width={width}")
+        if animation_format not in ANIMATION_FORMATS:
+            raise ValueError(f"Unsupported animation format: {animation_format}")
+
+        return {
+            'start_time'       : start_time,
+            'duration'         : duration,
+            'fps'              : fps,
+            'width'            : width,
+            'animation_format' : animation_format,
+        }
+
+    # パレットを保存先から取り出して GIF を作成し、なければ作成と同時にパレットを保存する
+    # パレットは入力の内容と切り出す範囲ごとに保持し、幅やフレームレートが違う要求でも使い回す
+    # 長い GIF はパレットを先に作ってファイルに書き出し、2 回目のデコードで減色する
+    # 内容ハッシュは受信時に確定したものを使い、届いていない場合（ワーカーへの転送など）だけ入力を読んで求める
+    def run_gif(self, json_file, input_file_path, output_file_path, progress=None, duration=None):
+        options  = self.gif_options(json_file)
+        cache    = self.palette_cache() if self.palette_cache_bytes > 0 else None
+        key      = None
+        if cache is not None:
+            source_hash = json_file.get('content_hash')
+            if source_hash is None:
+                with open(input_file_path, 'rb') as f:
+                    source_hash = hashlib.file_digest(f, 'sha256').hexdigest()
+            key = cache.make_key(source_hash, '.png', {k: options[k] for k in ('start_time', 'duration')})
+
+        work_dir = tempfile.mkdtemp(prefix='palette_', dir=self.dpath)
+        try:
+            palette_path = os.path.join(work_dir, 'palette.png')
+            cached       = cache is not None and cache.fetch(key, palette_path)
+            if cached:
+                palette = {'palette_path': palette_path}
+            elif self.gif_buffered_bytes(options) <= GIF_SINGLE_PASS_BYTES:
+                palette = {'palette_output': palette_path}
+            else:
+                self.run_ffmpeg(self.create_palette_stream(input_file_path, palette_path, **options))
+                palette = {'palette_path': palette_path}
+
+            stream, _ = self.create_gif_stream(input_file_path, json_file['file_name'], **options, **palette)
+            self.run_ffmpeg(stream, progress, 0, duration)
+            if cache is not None and not cached:
+                cache.store(key, palette_path)
+        finally:
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+        os.remove(input_file_path)
+        return output_file_path
+
+    # パレットをファイルとして扱う GIF か（パレットを使い回す場合と、1 回のデコードでは作れない長い GIF）
+    # WebP はパレットを使わない
+    def uses_palette_file(self, json_file):
+        if json_file['operation'] != 5 or (json_file.get('animation_format') or 'gif') != 'gif':
+            return False
+        if self.palette_cache_bytes > 0:
+            return True
+        return self.gif_buffered_bytes(self.gif_options(json_file)) > GIF_SINGLE_PASS_BYTES
+
+    # パレットの保存先（入力ファイルの保持と同じ、容量上限付きの LRU ストア）
+    def palette_cache(self):
+        if self._palette_cache is None:
+            self._palette_cache = ResultCache(os.path.join(self.dpath, 'palettes'), self.palette_cache_bytes)
+        return self._palette_cache
+
+    # 複数の操作を 1 つのフィルタグラフにまとめ、1 回のデコード・エンコードで変換する
+    # フィルタは operations の順に連結し、圧縮はビットレート指定として出力に付ける
+    def pipeline_stream(self, input_file_path, file_name, operations, params):
+        if not operations:
+            raise ValueError("Pipeline requires at least one operation")
+        if len(set(operations)) != len(operations):
+            raise ValueError(f"Duplicate operation in pipeline: {operations}")
+
+        filters = []
+        for operation in operations:
+            if operation == 1:
+                # 圧縮はフィルタではなく、出力のエンコード設定として反映する
+                continue
+
+            elif operation == 2:
+                width, _ = self.parse_resolution(params.get('resolution'))
+                filters.append(f"scale={width}:-2")
+
+            elif operation == 3:
+                filters.append(f"setdar={self.format_aspect_ratio(params.get('aspect_ratio'))}")
+
+            else:
+                raise ValueError(f"Operation {operation} cannot be used in a pipeline")
+
+        output_file_path = os.path.join(self.dpath, f'pipeline_{file_name}')
+        compress = 1 in operations
+        options  = self.video_options(output_file_path, params.get('bitrate') if compress else None, compress)
+        if filters:
+            options['vf'] = ','.join(filters)
+
+        stream = ffmpeg.input(input_file_path).output(output_file_path, **options).overwrite_output()
+        return stream, output_file_path
+
+    # 操作コードに対応する ffmpeg コマンドと出力先を返す
+    def operation_stream(self, json_file, input_file_path):
+        # 操作コードとファイル名を取得
+        operation = json_file['operation']
+        file_name = json_file['file_name']
+
+        if operation == 1:
+            return self.compress_video_stream(input_file_path, file_name, json_file.get('bitrate'))
+
+        elif operation == 2:
+            resolution = json_file.get('resolution')
+            return self.change_resolution_stream(input_file_path, file_name, resolution)
+
+        elif operation == 3:
+            aspect_ratio = json_file.get('aspect_ratio')
+            return self.change_aspect_ratio_stream(input_file_path, file_name, aspect_ratio)
+
+        elif operation == 4:
+            audio_format = json_file.get('audio_format') or DEFAULT_AUDIO_FORMAT
+            return self.convert_to_audio_stream(input_file_path, file_name, audio_format)
+
+        elif operation == 5:
+            return self.create_gif_stream(input_file_path, file_name, **self.gif_options(json_file))
+
+        elif operation == OPERATION_PIPELINE:
+            operations = json_file.get('operations') or []
+            return self.pipeline_stream(input_file_path, file_name, operations, json_file)
+
+        else:
+            raise ValueError(f"Invalid operation code: {operation}")
+
+    # 入力の解析結果から、再エンコードせずに済む場合はストリームをコピーする ffmpeg コマンドを返す（対象外なら None）
+    # 出力先は operation_stream と同じにするため、キャッシュや転送先はどちらの経路でも変わらない
+    def copy_stream(self, json_file, input_file_path, output_file_path, probe):
+        operation = json_file['operation']
+        if not self.stream_copy or operation not in STREAM_COPY_OPERATIONS or probe is None:
+            return None
+
+        if operation == 3:
+            return self.change_aspect_ratio_copy(input_file_path, output_file_path, json_file.get('aspect_ratio'), probe)
+        return self.convert_to_audio_copy(input_file_path, output_file_path, probe)
+
+    # 映像を再エンコードせず、H.264 / H.265 の SAR とコンテナの表示アスペクト比だけを書き換える
+    # 回転の指定がある映像は、再エンコード時の自動回転と結果が変わるため対象外とする
+    def change_aspect_ratio_copy(self, input_file_path, output_file_path, aspect_ratio, probe):
+        videos = [stream for stream in probe['streams'] if stream.get('codec_type') == 'video']
+        if len(videos) != 1 or Path(output_file_path).suffix.lower() not in PROFILE_MEDIA_TYPES:
+            return None
+
+        video = videos[0]
+        metadata_filter = ASPECT_METADATA_FILTERS.get(video.get('codec_name'))
+        width, height   = video.get('width'), video.get('height')
+        display_ratio   = self.parse_aspect_ratio(aspect_ratio)
+        if metadata_filter is None or not width or not height or display_ratio is None or self.is_rotated(video):
+            return None
+
+        # 表示アスペクト比 = SAR × 幅 / 高さ から、書き込む SAR を求める
+        sample_ratio = (display_ratio * Fraction(height, width)).limit_denominator(MAX_SAR_TERM)
+        if sample_ratio.numerator > MAX_SAR_TERM:
+            return None
+
+        options = {
+            'c'     : 'copy',
+            'bsf:v' : f'{metadata_filter}=sample_aspect_ratio={sample_ratio.numerator}/{sample_ratio.denominator}',
+            # ストリームコピーでは、-aspect はコンテナに記録する表示アスペクト比として使われる
+            'aspect': f'{display_ratio.numerator}:{display_ratio.denominator}',
+        }
+        return ffmpeg.input(input_file_path).output(output_file_path, **options).overwrite_output()
+
+    # 最初の音声ストリームが出力形式にそのまま格納できるコーデックなら、デコードせずに取り出す
+    @staticmethod
+    def convert_to_audio_copy(input_file_path, output_file_path, probe):
+        audios = [stream for stream in probe['streams'] if stream.get('codec_type') == 'audio']
+        audio_format = Path(output_file_path).suffix.lower().lstrip('.')
+        if not audios or audios[0].get('codec_name') not in AUDIO_FORMATS[audio_format]['copyable']:
+            return None
+
+        return ffmpeg.input(input_file_path)['a:0'].output(output_file_path, c='copy').overwrite_output()
+
+    # 入力のコンテナとストリームを解析する（ffprobe がない・解析できない場合は None）
+    # 内容ハッシュが分かっていれば索引を引き、解析済みの内容なら ffprobe を実行しない
+    def probe_media(self, input_file_path, content_hash=None):
+        probe = self.media_index.get(content_hash) if content_hash else None
+        if probe is not None:
+            return probe
+
+        try:
+            probe = MediaIndex.compact(ffmpeg.probe(input_file_path))
+        except (ffmpeg.Error, OSError):
+            return None
+        if content_hash:
+            self.media_index.put(content_hash, probe)
+        return probe
+
+    # アップロードの先頭フレームだけを ffprobe の標準入力に渡して解析する（解析できなければ None）
+    @staticmethod
+    def probe_head(head):
+        try:
+            result = subprocess.run(
+                ['ffprobe', '-v', 'error', '-show_format', '-show_streams', '-of', 'json', '-i', 'pipe:'],
+                input=head, capture_output=True, timeout=HEAD_PROBE_TIMEOUT,
+            )
+            if result.returncode != 0:
+                return None
+            return MediaIndex.compact(json.loads(result.stdout))
+        except (OSError, subprocess.TimeoutExpired, ValueError):
+            return None
+
+    # 要求のパラメータを、ffmpeg のコマンドを組み立てるだけで検証する（本体を受信する前に呼ぶ）
+    # 内容ハッシュが届き、その内容を解析済みであれば、入力との組み合わせも合わせて検証する
+    def validate_request(self, json_file):
+        if json_file['operation'] == OPERATION_FANOUT:
+            for rendition in self.fan_out_requests(json_file):
+                self.operation_stream(rendition, 'pipe:')
+        else:
+            self.operation_stream(json_file, 'pipe:')
+
+        probe = self.media_index.get(json_file['content_hash']) if json_file.get('content_hash') else None
+        if probe is not None:
+            self.check_media(json_file, probe)
+
+    # アップロードの先頭フレームからコンテナのヘッダーを解析し、残りを受信する前に要求を検証する
+    # 先頭だけでは解析できない入力（moov が末尾にある MP4 など）は、受信後の解析で検証する
+    def check_head(self, json_file, media_type, head):
+        probe = self.probe_head(head)
+        if probe is not None:
+            self.check_media(json_file, probe, trust_duration=media_type.lower() in HEADER_DURATION_TYPES)
+
+    # 入力を解析して要求を検証し、解析結果を返す（ffmpeg を起動する前に呼ぶ）
+    def inspect_input(self, json_file, input_file_path):
+        probe = self.probe_media(input_file_path, json_file.get('content_hash'))
+        if probe is not None:
+            self.check_media(json_file, probe)
+        return probe
+
+    # 入力の解析結果と要求の組み合わせを検証する（映像・音声の有無、GIF の開始位置と入力の長さ）
+    # trust_duration が False の場合は、解析結果の長さを推定値とみなして検証に使わない
+    def check_media(self, json_file, probe, trust_duration=True):
+        operation = json_file['operation']
+        if operation == OPERATION_FANOUT:
+            for rendition in self.fan_out_requests(json_file):
+                self.check_media(rendition, probe, trust_duration)
+            return
+
+        codec_types = {stream.get('codec_type') for stream in probe['streams']}
+        if operation == 4:
+            if 'audio' not in codec_types:
+                raise ValueError("Input has no audio stream")
+        elif 'video' not in codec_types:
+            raise ValueError("Input has no video stream")
+
+        duration = float(probe['format'].get('duration') or 0)
+        if operation == 5 and trust_duration and duration > 0:
+            start_time = self.gif_options(json_file)['start_time']
+            if start_time >= duration:
+                raise ValueError(f"start_time {start_time} is beyond the end of the input ({duration:.1f} s)")
+
+    # "16/9" や "16:9"、"1.78" 形式の表示アスペクト比を分数にする（不正な値は None）
+    @staticmethod
+    def parse_aspect_ratio(aspect_ratio):
+        try:
+            ratio = Fraction(str(aspect_ratio).replace(':', '/')).limit_denominator(MAX_SAR_TERM)
+        except (ValueError, ZeroDivisionError):
+            return None
+        return ratio if ratio > 0 else None
+
+    # 映像に回転の指定（表示行列・rotate タグ）があるか
+    @staticmethod
+    def is_rotated(video):
+        if int(video.get('tags', {}).get('rotate', 0) or 0) % 360:
+            return True
+        return any(int(side_data.get('rotation', 0) or 0) % 360 for side_data in video.get('side_data_list', []))
+
+    # ファンアウト要求を出力ごとの操作要求に分ける（出力名が重ならないよう番号を付ける）
+    @staticmethod
+    def fan_out_requests(json_file):
+        outputs = json_file.get('outputs') or []
+        if not outputs:
+            raise ValueError("Fan-out requires at least one output")
+
+        renditions = []
+        for index, output in enumerate(outputs):
+            if output.get('operation') in (None, OPERATION_FANOUT):
+                raise ValueError(f"Invalid fan-out output: {output}")
+            renditions.append({**output, 'file_name': f"{index}_{json_file['file_name']}"})
+        return renditions
+
+    # 複数の出力を 1 つの入力ファイルから作成し、入力ファイルを削除して出力先の一覧を返す
+    # 入力を共有できる出力は 1 つの ffmpeg にまとめて 1 回のデコードで作り、
+    # 切り出し範囲を入力側で指定する GIF は別の ffmpeg で並行して作る
+    # 入力の解析は 1 回だけ行い、すべての出力の検証とストリームコピーの判断に使う
+    # 進捗は ffmpeg ごとの出力する長さを合計し、それに対する割合で通知する
+    def fan_out(self, renditions, input_file_path, content_hash=None, progress=None):
+        probe = self.probe_media(input_file_path, content_hash)
+        if probe is not None:
+            for rendition in renditions:
+                self.check_media(rendition, probe)
+
+        shared, separate, output_file_paths = [], [], []
+        for rendition in renditions:
+            stream, output_file_path = self.operation_stream(rendition, input_file_path)
+            stream = self.copy_stream(rendition, input_file_path, output_file_path, probe) or stream
+            if rendition['operation'] == 5:
+                separate.append((stream, self.output_duration(rendition, probe)))
+            else:
+                shared.append(stream)
+            output_file_paths.append(output_file_path)
+
+        if shared:
+            separate.append((ffmpeg.merge_outputs(*shared), self.media_duration(probe)))
+
+        # 並行する ffmpeg が揃ってから割合を求めるよう、起動前にすべての長さを登録する
+        if progress is not None:
+            for task, (_, duration) in enumerate(separate):
+                progress.expect(task, duration)
+        jobs = [partial(self.run_ffmpeg, stream, progress, task) for task, (stream, _) in enumerate(separate)]
+
+        with ThreadPoolExecutor(max_workers=len(jobs)) as executor:
+            for future in [executor.submit(job) for job in jobs]:
+                future.result()
+
         os.remove(input_file_path)
+        return output_file_paths
+
+    # キューに積まれたジョブを実行し、出力先の一覧を返す（ワーカープロセスから呼ばれる）
+    # progress が渡された場合は、変換の進捗を通知する（ジョブの状態として記録される）
+    def run_job(self, json_file, input_file_path, progress=None):
+        if json_file['operation'] == OPERATION_FANOUT:
+            return self.fan_out(
+                self.fan_out_requests(json_file), input_file_path, json_file.get('content_hash'), progress
+            )
+
+        # ジョブの結果は応答として送らないため、記録したエンコード速度は捨てる
+        output_file_path = self.run_operation(json_file, input_file_path, progress)
+        self.pop_encode_stats(output_file_path)
+        return [output_file_path]
+
+    # 失敗したジョブの入力と、書きかけの出力を削除する
+    def discard_job(self, json_file, input_file_path):
+        renditions = self.fan_out_requests(json_file) if json_file['operation'] == OPERATION_FANOUT else [json_file]
+        for path in [input_file_path, *(self.operation_stream(rendition, 'pipe:')[1] for rendition in renditions)]:
+            if os.path.exists(path):
+                os.remove(path)
+
+    # 操作を実行し、入力ファイルを削除して出力先を返す
+    # 入力の解析結果で要求を検証したうえで、再エンコードせずに済む入力はストリームのコピーで済ませ、
+    # 長い動画は分割して並列に変換する
+    # progress が渡された場合は、ffmpeg の進捗を出力する長さに対する割合で通知する
+    def run_operation(self, json_file, input_file_path, progress=None):
+        started  = time.perf_counter()
+        stream, output_file_path = self.operation_stream(json_file, input_file_path)
+        probe    = self.inspect_input(json_file, input_file_path)
+        copy     = self.copy_stream(json_file, input_file_path, output_file_path, probe)
+        duration = self.output_duration(json_file, probe)
+
+        if copy is not None:
+            self.run_stream(copy, input_file_path, output_file_path, progress, duration)
+        elif self.uses_palette_file(json_file):
+            self.run_gif(json_file, input_file_path, output_file_path, progress, duration)
+        elif self.uses_two_pass(json_file, output_file_path):
+            self.run_two_pass(json_file, input_file_path, output_file_path, progress, duration)
+        elif self.uses_segments(json_file, probe):
+            self.run_segmented(json_file, input_file_path, output_file_path, probe, progress)
+        else:
+            self.run_stream(stream, input_file_path, output_file_path, progress, duration)
+
+        method = 'stream_copy' if copy is not None else 'transcode'
+        self.record_encode_stats(output_file_path, time.perf_counter() - started, method)
         return output_file_path
 
-    # 動画ファイルから音声を抽出してMP3に変換
-    def convert_to_audio(self, input_file_path, file_name):
-        output_file_path = os.path.join(self.dpath, f'converted_to_audio_{Path(file_name).stem}.mp3')
-        ffmpeg.input(input_file_path).output(output_file_path, acodec='mp3').overwrite_output().run()
+    # 変換にかかった時間と出力のフレーム数から、エンコード速度（fps）と出力サイズを記録する
+    # method は再エンコードしたか（transcode）、ストリームのコピーで済ませたか（stream_copy）
+    def record_encode_stats(self, output_file_path, elapsed, method='transcode'):
+        frames = self.count_frames(output_file_path)
+        self.encode_stats[output_file_path] = {
+            'profile'     : self.profile,
+            'method'      : method,
+            'elapsed'     : round(elapsed, 3),
+            'fps'         : round(frames / elapsed, 1) if frames and elapsed > 0 else None,
+            'output_size' : os.path.getsize(output_file_path),
+        }
+
+    # 記録したエンコード速度・出力サイズを取り出す（記録がなければ None）
+    def pop_encode_stats(self, output_file_path):
+        return self.encode_stats.pop(output_file_path, None)
+
+    # 出力の映像のフレーム数を返す（音声のみ・解析できない場合は None）
+    @staticmethod
+    def count_frames(output_file_path):
+        try:
+            probe = ffmpeg.probe(output_file_path)
+        except (ffmpeg.Error, OSError):
+            # ffprobe がない・失敗した場合も、変換自体は成功として扱う
+            return None
+
+        for stream in probe['streams']:
+            if stream.get('codec_type') != 'video':
+                continue
+            if stream.get('nb_frames'):
+                return int(stream['nb_frames'])
+
+            # フレーム数を持たないコンテナは、長さと平均フレームレートから求める
+            duration = float(stream.get('duration') or probe['format'].get('duration') or 0)
+            try:
+                return round(duration * Fraction(stream.get('avg_frame_rate', '0/1')))
+            except (ValueError, ZeroDivisionError):
+                return None
+        return None
+
+    # 出力の長さ（秒）。GIF は切り出す範囲のうち入力に含まれる長さ、それ以外は入力の長さ
+    def output_duration(self, json_file, probe):
+        duration = self.media_duration(probe)
+        if json_file['operation'] != 5:
+            return duration
+
+        options = self.gif_options(json_file)
+        if duration is None:
+            return options['duration']
+        return min(options['duration'], max(duration - options['start_time'], 0)) or None
+
+    # 入力の長さ（秒、解析できていない・長さを持たない場合は None）
+    @staticmethod
+    def media_duration(probe):
+        if probe is None:
+            return None
+        return float(probe['format'].get('duration') or 0) or None
+
+    # 入力の解析結果から、分割して変換する対象か判定する
+    def uses_segments(self, json_file, probe):
+        return (
+            self.segment_workers > 1
+            and json_file['operation'] in SEGMENTABLE_OPERATIONS
+            and probe is not None
+            and float(probe['format'].get('duration') or 0) >= SEGMENT_MIN_DURATION
+        )
+
+    # 入力の映像をキーフレーム位置で分割し、各セグメントを並列に変換してから無劣化で連結する
+    # 音声はキーフレーム位置で切ると継ぎ目に隙間やずれが生じるため分割せず、連結時に入力からコピーして 1 回で多重化する
+    # 進捗はセグメントごとの出力済みの長さを合計し、入力の長さに対する割合で通知する
+    def run_segmented(self, json_file, input_file_path, output_file_path, probe, progress=None):
+        work_dir  = tempfile.mkdtemp(prefix='segments_', dir=self.dpath)
+        outputs   = []
+        has_audio = any(stream['codec_type'] == 'audio' for stream in probe['streams'])
+        try:
+            sources = self.split_segments(input_file_path, work_dir, probe)
+            if progress is not None:
+                for index in range(len(sources)):
+                    progress.expect(index, float(probe['format']['duration']) / len(sources))
+
+            # セグメントごとに ffmpeg を起動し、最大 segment_workers 個を同時に実行
+            with ThreadPoolExecutor(max_workers=self.segment_workers) as executor:
+                futures = [
+                    executor.submit(self.transcode_segment, json_file, index, source, progress)
+                    for index, source in enumerate(sources)
+                ]
+                outputs = [future.result() for future in futures]
+
+            self.concat_segments(outputs, output_file_path, work_dir, input_file_path if has_audio else None)
+        finally:
+            shutil.rmtree(work_dir, ignore_errors=True)
+            for segment_path in outputs:
+                if os.path.exists(segment_path):
+                    os.remove(segment_path)
+
         os.remove(input_file_path)
         return output_file_path
 
-    # 指定範囲の映像をGIFとして切り出し・保存
-    def create_gif(self, input_file_path, file_name, start_time, duration, fps=10):
-        output_file_path = os.path.join(self.dpath, f'created_gif_{Path(file_name).stem}.gif')
-        input_stream = ffmpeg.input(input_file_path, ss=start_time, t=duration)
-        ffmpeg.output(input_stream, output_file_path, vf=f'fps={fps},scale=320:-1:flags=lanczos', loop=0).overwrite_output().run()
+    # 映像だけを再エンコードせずにキーフレーム位置で、ほぼ同じ長さのセグメントへ分割する
+    def split_segments(self, input_file_path, work_dir, probe):
+        duration = float(probe['format']['duration'])
+        video    = ffmpeg.input(input_file_path)['v']
+
+        pattern = os.path.join(work_dir, f'source_%04d{Path(input_file_path).suffix}')
+        self.run_ffmpeg(ffmpeg.output(
+            video, pattern,
+            c='copy', f='segment', segment_time=duration / self.segment_workers, reset_timestamps=1
+        ).overwrite_output())
+
+        return sorted(str(path) for path in Path(work_dir).glob('source_*'))
+
+    # 1 つのセグメントを元の操作で変換し、出力先を返す（セグメントは映像だけのため、出力も映像だけになる）
+    def transcode_segment(self, json_file, index, source, progress=None):
+        segment_json = {**json_file, 'file_name': f"segment{index:04d}_{json_file['file_name']}"}
+        stream, output_file_path = self.operation_stream(segment_json, source)
+        self.run_ffmpeg(stream, progress, index)
+        return output_file_path
+
+    # concat demuxer で変換済みセグメントを再エンコードせずに連結
+    # audio_source が指定された場合は、その音声を再エンコードせずに合わせて多重化する
+    @staticmethod
+    def concat_segments(segment_paths, output_file_path, work_dir, audio_source=None):
+        list_path = os.path.join(work_dir, 'segments.txt')
+        with open(list_path, 'w') as f:
+            for segment_path in segment_paths:
+                escaped = os.path.abspath(segment_path).replace("'", "'\\''")
+                f.write(f"file '{escaped}'\n")
+
+        streams = [ffmpeg.input(list_path, f='concat', safe=0)['v']]
+        if audio_source is not None:
+            streams.append(ffmpeg.input(audio_source)['a'])
+        MediaProcessor.run_ffmpeg(ffmpeg.output(*streams, output_file_path, c='copy').overwrite_output())
+
+    # ffmpeg を実行し、入力ファイルを削除して出力先を返す
+    def run_stream(self, stream, input_file_path, output_file_path, progress=None, duration=None):
+        self.run_ffmpeg(stream, progress, 0, duration)
         os.remove(input_file_path)
         return output_file_path
 
+    # ffmpeg を実行する。progress が渡された場合は -progress の出力を読みながら進捗を通知する
+    # duration を指定すると、task の出力する長さとして登録してから実行する
+    @staticmethod
+    def run_ffmpeg(stream, progress=None, task=0, duration=None):
+        if progress is None:
+            returncode = MediaProcessor.start_ffmpeg(stream).wait()
+            if returncode != 0:
+                raise ffmpeg_error(returncode)
+            return
+
+        if duration is not None:
+            progress.expect(task, duration)
+        process = MediaProcessor.start_ffmpeg(stream, progress)
+        try:
+            progress.follow(process.stdout, task)
+        finally:
+            process.stdout.close()
+            returncode = process.wait()
+        if returncode != 0:
+            raise ffmpeg_error(returncode)
+
+    # ffmpeg を起動する。progress が渡された場合は、進捗を標準出力に書き出させる
+    @staticmethod
+    def start_ffmpeg(stream, progress=None, pipe_stdin=False):
+        args = stream.compile()
+        if progress is not None:
+            args[1:1] = FFMPEG_PROGRESS_ARGS
+        return subprocess.Popen(
+            args,
+            stdin=subprocess.PIPE if pipe_stdin else None,
+            stdout=subprocess.PIPE if progress is not None else None,
+        )
+
+
+class PartialUploadSweeper:
+
+    # 再開されないまま max_age 秒更新されていない受信途中のファイルを、起動時と一定間隔ごとに削除する
+    # 受信中のファイルは書き込みのたびに更新時刻が進むため、消されることはない
+    def __init__(self, dpath, max_age, interval=PARTIAL_SWEEP_INTERVAL):
+        self.partial_dir = os.path.join(dpath, 'partial')
+        self.max_age     = max_age
+        self.interval    = interval
+        self.stop_event  = threading.Event()
+
+    def start(self):
+        self.sweep()
+        threading.Thread(target=self._sweep_loop, daemon=True).start()
+
+    # 更新時刻が max_age 秒より前のファイルを削除し、削除した数を返す
+    def sweep(self):
+        cutoff  = time.time() - self.max_age
+        removed = 0
+        try:
+            entries = list(os.scandir(self.partial_dir))
+        except FileNotFoundError:
+            return 0
+
+        for entry in entries:
+            try:
+                if entry.is_file() and entry.stat().st_mtime < cutoff:
+                    os.remove(entry.path)
+                    removed += 1
+            except FileNotFoundError:
+                pass
+        return removed
+
+    def close(self):
+        self.stop_event.set()
+
+    def _sweep_loop(self):
+        while not self.stop_event.wait(self.interval):
+            self.sweep()
+
 
 class TCPServer:
     
-    def __init__(self, server_address, server_port, processor):
+    def __init__(self, server_address, server_port, processor, max_workers=None, max_pending=None, key_pool=None,
+                 pipe_uploads=False, result_cache=None, input_store=None, job_queue=None, remote_workers=None,
+                 session_tickets=None, session_idle_timeout=30.0, metrics_registry=None, rate_limiter=None,
+                 max_idle_sessions=MAX_IDLE_SESSIONS):
+        # 同時処理数（ワーカースレッド数）と、処理待ちとして受け付ける接続数の上限
+        self.max_workers    = max_workers or os.cpu_count() or 1
+        self.max_pending    = self.max_workers * 4 if max_pending is None else max_pending
+
         self.server_address = server_address
         self.server_port    = server_port
         self.sock           = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
         self.sock.bind((server_address, server_port))
-        self.sock.listen()
+        self.sock.listen(self.max_pending)
+        # shutdown 要求を定期的に確認できるよう accept にタイムアウトを設定
+        self.sock.settimeout(0.5)
         
         self.processor      = processor
         self.chunk_size     = 1400
+        # 接続ごとの RSA 鍵生成を避けるため、事前生成した鍵プールから取り出す
+        self.key_pool       = key_pool or RSAKeyPool()
+        # 対応する操作・コンテナではアップロードを ffmpeg の標準入力へ直接流し込む
+        self.pipe_uploads   = pipe_uploads
+        # 同じ入力・同じパラメータの変換結果を再利用するキャッシュ（None で無効）
+        self.result_cache   = result_cache
+        # 重複アップロードを省くため、受信した入力を内容ハッシュをキーに保持するストア（None で無効）
+        self.input_store    = input_store
+        # 接続と切り離して変換するジョブのキュー（None で無効）
+        self.job_queue      = job_queue
+        # 変換を転送する分散ワーカーの一覧（None ならこのサーバ自身で変換する）
+        self.remote_workers = remote_workers
+        # 再接続したクライアントが RSA 鍵交換を省くためのチケット（None で無効）
+        self.session_tickets      = session_tickets
+        # keep_alive のセッションで次のリクエストを待つ時間（秒）
+        # 待っている間はワーカースレッドを使わず、監視用の 1 スレッドでまとめて待つ（max_idle_sessions を超えたら古い順に閉じる）
+        self.session_idle_timeout = session_idle_timeout
+        self.idle_sessions        = IdleSessions(self.dispatch_session, session_idle_timeout, max_idle_sessions)
+        # リクエストの段階ごとの処理時間・転送量の集計（メトリクスのエンドポイントで公開する）
+        self.metrics_registry     = metrics_registry or MetricsRegistry()
+        # クライアントごとのリクエスト数・転送量・同時に行う変換の数の制限（None で無効）
+        self.rate_limiter         = rate_limiter
+
+        # ffmpeg は子プロセスで動くため、接続処理はスレッドプールで並行実行する
+        self.executor       = ThreadPoolExecutor(max_workers=self.max_workers)
+        self.admission      = threading.BoundedSemaphore(self.max_workers + self.max_pending)
+        self.stop_event     = threading.Event()
+        # 処理中の接続数（死活監視への応答で負荷として返す）
+        self.active         = 0
+        self.active_lock    = threading.Lock()
+        # 受信中の再開可能なアップロード（同じ ID への同時書き込みを防ぐ）
+        self.uploads        = set()
+        self.uploads_lock   = threading.Lock()
         
     def start_server(self):
-        while True:
-            connection, _ = self.sock.accept()
-            self.handle_client(connection)
+        self.idle_sessions.start()
+        try:
+            while not self.stop_event.is_set():
+                try:
+                    connection, _ = self.sock.accept()
+                except socket.timeout:
+                    continue
+                except OSError:
+                    # shutdown() によりソケットが閉じられた
+                    break
 
-    def handle_client(self, connection):
-        secure_conn = None 
-        
+                # 上限を超えた接続は処理待ちに積まず即座に切断する
+                if not self.admission.acquire(blocking=False):
+                    connection.close()
+                    continue
+
+                connection.settimeout(None)
+                self.executor.submit(self.serve_connection, connection)
+        finally:
+            self.sock.close()
+            # 次のリクエストを待っているセッションを閉じ、処理中の接続が完了するまで待ってから終了
+            self.idle_sessions.close()
+            self.executor.shutdown(wait=True)
+            self.key_pool.close()
+
+    # 新規接続の受付を停止する（処理中の接続は完了まで継続）
+    def shutdown(self):
+        self.stop_event.set()
+
+    # ワーカースレッド上で 1 接続を処理し、終了後に受付枠を解放
+    # secure_conn が渡された場合は、待機から戻った keep_alive のセッションの次のリクエストを処理する
+    def serve_connection(self, connection, secure_conn=None):
+        with self.active_lock:
+            self.active += 1
+        try:
+            self.handle_client(connection, secure_conn)
+        except Exception:
+            # 他の接続に影響しないよう、例外はここで出力して握りつぶす
+            traceback.print_exc()
+        finally:
+            with self.active_lock:
+                self.active -= 1
+            self.admission.release()
+
+    # 接続のリクエストを 1 つ処理する。keep_alive が指定されていれば、同じ暗号化チャネルのまま
+    # 次のリクエストを待つセッションとして預け、このスレッドは解放する
+    def handle_client(self, connection, secure_conn=None):
+        client_ip   = connection.getpeername()[0]
+        parked      = False
+
+        try:
+            # 鍵交換を実行（RSA公開鍵交換 → AES鍵受信、またはチケットによるセッション再開）
+            # 鍵交換の時間は、接続の最初のリクエストに記録する
+            request_metrics = RequestMetrics()
+            if secure_conn is None:
+                with request_metrics.stage('key_exchange'):
+                    secure_conn = self.perform_key_exchange(connection)
+
+            if self.handle_request(secure_conn, client_ip, request_metrics) and not self.stop_event.is_set():
+                self.idle_sessions.park(connection, secure_conn)
+                parked = True
+
+        except Exception as e:
+            # エラー時も可能であれば暗号化チャネルで応答（応答後はセッションを終える）
+            self.send_error_response(secure_conn if secure_conn else connection, str(e), getattr(e, 'details', None))
+            self.linger_close(connection)
+            raise   # ログしたいので再送出
+
+        finally:
+            if not parked:
+                connection.close()
+
+    # 待機中のセッションに次のリクエストが届いたら、受付枠を取ってワーカースレッドで処理する
+    # 枠が空いていなければ、新規の接続と同じく切断する
+    def dispatch_session(self, connection, secure_conn):
+        if self.stop_event.is_set() or not self.admission.acquire(blocking=False):
+            connection.close()
+            return
+        self.executor.submit(self.serve_connection, connection, secure_conn)
+
+    # 受信していない本体が残ったまま閉じると、クライアントに RST が届いてエラー応答を読めないことがある
+    # 送信側だけを閉じ、クライアントが送信をやめて切断するまで（最大 LINGER_TIMEOUT 秒）受信を読み捨てる
+    @staticmethod
+    def linger_close(connection):
+        try:
+            connection.shutdown(socket.SHUT_WR)
+            connection.settimeout(LINGER_TIMEOUT)
+            deadline = time.monotonic() + LINGER_TIMEOUT
+            while time.monotonic() < deadline and connection.recv(MAX_FRAME_SIZE):
+                pass
+        except OSError:
+            pass
+
+    # リクエストを 1 つ受信して処理し、同じ接続で次のリクエストを受け付けるかを返す
+    # 段階ごとの処理時間・転送量・ffmpeg の終了コードは request_metrics に集め、終了時にログと集計へ記録する
+    def handle_request(self, secure_conn, client_ip, request_metrics=None):
         start_time = datetime.utcnow().isoformat()
-        client_ip  = connection.getpeername()[0]
-        log_vals   = {               
+        log_vals   = {
             'operation'   : None,
             'file_name'   : None,
             'file_size'   : None,
             'media_type'  : None,
         }
-        log_id = None               
-        
-        try:
-            # 鍵交換を実行（RSA公開鍵交換 → AES鍵受信）
-            secure_conn = self.perform_key_exchange(connection)
+        log_id     = None
+        admitted   = None
+        work_files = None
+        request_metrics = request_metrics or RequestMetrics()
+        request_metrics.begin(secure_conn)
 
+        try:
             # クライアントからリクエスト（ヘッダー＋ボディ）を受信・解析
             request   = self.parse_request(secure_conn)
             json_file = request['json_file']
+            request['metrics'] = request_metrics
+
+            # coordinator からの死活監視には、ログを残さず負荷だけを返す
+            if json_file['operation'] == OPERATION_HEALTH:
+                self.send_health(secure_conn, self.active - 1, self.max_workers)
+                return False
+
+            # 1 つのクライアントが帯域や ffmpeg を占有しないよう、制限を超えたリクエストは本体を受信する前に拒否する
+            admitted = self.admit_request(client_ip, request)
 
             # ログ用の詳細情報を格納
             log_vals.update({
@@ -180,32 +1536,120 @@ class TCPServer:
                 'media_type' : request['media_type'],
             })
 
-            # 受信したファイルを保存（チャンク単位で受信）
-            input_file_path = os.path.join(self.processor.dpath, json_file['file_name'])
-            self.processor.save_file(secure_conn, input_file_path, request['file_size'])
-
-            # ログ開始を記録
+            # 同時接続でファイル名が衝突しないよう、リクエストごとに一意な作業名を付与
+            request_token, work_json = self.assign_work_name(json_file)
+
+            input_file_path = os.path.join(self.processor.dpath, work_json['file_name'])
+            frame_size      = self.negotiate_frame_size(json_file, self.chunk_size)
+
+            if json_file['operation'] == OPERATION_FETCH_JOB:
+                # キューに積んだジョブの状態を返し、完了していれば結果を送る（中断したダウンロードは続きから）
+                # 状態の問い合わせはジョブ 1 つにつき毎秒届くため、結果か失敗を返したときだけログに残す
+                polling = False
+                try:
+                    with request_metrics.stage('send'):
+                        polling = self.send_job_result(secure_conn, json_file.get('job_id'), frame_size,
+                                                       json_file.get('download_offset', 0))
+                finally:
+                    if not polling:
+                        log_id = self.write_log_start(start_time, client_ip, log_vals)
+                return json_file.get('keep_alive', False)
+
+            # ログ開始を記録（受信と変換が並行する場合があるため、受信前に記録する）
             log_id = self.write_log_start(start_time, client_ip, log_vals)
 
-            # 指定された操作を実行（圧縮・変換など）
-            output_file_path = self.operation_dispatcher(json_file, input_file_path)
-
-            # 処理結果ファイルをクライアントに送信
-            self.send_file(secure_conn, output_file_path)
+            # 不正なパラメータは、ファイル本体を受信する前に拒否する
+            self.processor.validate_request(work_json)
+            # 応答を送り終えたら（失敗した場合も）削除する作業用ファイル
+            work_files = self.work_files(self.processor, work_json, input_file_path)
+
+            # クライアントが要求していれば、受信と変換の進捗を応答の前に送る
+            progress = self.progress_reporter(secure_conn, json_file)
+
+            if json_file.get('async_job'):
+                # 受信だけを行ってジョブをキューに積み、変換を待たずにジョブ ID を返す
+                self.receive_and_enqueue(secure_conn, work_json, request, input_file_path, request_token, progress)
+                return json_file.get('keep_alive', False)
+
+            # 内容ハッシュが届いた場合は、保持済みの入力・変換結果を探してアップロードの要否を返答
+            cached_file_path = None
+            if json_file.get('content_hash'):
+                cached_file_path = self.offer_known_content(secure_conn, work_json, request, input_file_path)
+
+            if cached_file_path is not None:
+                # 変換結果を保持済みのため、アップロードも変換も行わずに返す（中断したダウンロードは続きから）
+                response_name = self.strip_work_name(cached_file_path, request_token)
+                with request_metrics.stage('send'):
+                    self.send_file(secure_conn, cached_file_path, response_name, frame_size,
+                                   json_file.get('download_offset', 0))
+
+            elif json_file['operation'] == OPERATION_FANOUT:
+                # 1 回のアップロードから複数の出力を作り、同じ接続でまとめて返す
+                self.receive_and_fan_out(
+                    secure_conn, work_json, request, input_file_path, request_token, frame_size, progress
+                )
+
+            elif json_file.get('stream_response'):
+                # 変換しながら、出力を生成された順にクライアントへ送る
+                self.receive_and_stream(secure_conn, work_json, request, input_file_path, request_token, frame_size)
+
+            else:
+                # ファイルを受信して指定された操作を実行（圧縮・変換など）
+                output_file_path = self.receive_and_process(secure_conn, work_json, request, input_file_path, progress)
+
+                # 処理結果ファイルをクライアントに送信（作業名は取り除いて返す。中断したダウンロードは続きから）
+                response_name = self.strip_work_name(output_file_path, request_token)
+                with request_metrics.stage('send'):
+                    self.send_file(secure_conn, output_file_path, response_name, frame_size,
+                                   json_file.get('download_offset', 0))
+
+            return json_file.get('keep_alive', False)
 
         except Exception as e:
-            # エラー時も可能であれば暗号化チャネルで応答
-            self.send_error_response(secure_conn if secure_conn else connection, str(e))
-            raise   # ログしたいので再送出
-        
+            request_metrics.fail(e)
+            if isinstance(e, RateLimitExceeded):
+                self.metrics_registry.observe_rejection(e.limit)
+            raise
+
         finally:
+            # キューに積んだジョブの入力は、ワーカーが変換を終えるまで残す
+            if work_files is not None and not request.get('job_submitted'):
+                self.remove_files(work_files)
+            # 送らずに終わった（失敗した）出力のエンコード速度の記録は、応答に使われないまま残るため捨てる
+            for path in work_files or ():
+                self.processor.pop_encode_stats(path)
             end_time = datetime.utcnow().isoformat()
-            self.write_log_end(log_id, end_time)
-            connection.close()
+            request_metrics.end(secure_conn)
+            self.release_request(client_ip, admitted, request_metrics)
+            self.write_log_end(log_id, end_time, request_metrics)
+            if log_id is not None:
+                self.metrics_registry.observe(log_vals['operation'], request_metrics)
+
+    # クライアントごとの制限を確認し、超えていれば RateLimitExceeded を送出する
+    # 受け付けた場合は、終了時に release_request へ渡す (申告されたファイルサイズ, 変換の枠を使うか) を返す
+    def admit_request(self, client_ip, request):
+        # ジョブの状態の問い合わせは、アップロードも変換もしないため数えない（ジョブ 1 つにつき毎秒届く）
+        if self.rate_limiter is None or request['json_file']['operation'] == OPERATION_FETCH_JOB:
+            return None
+        transcode = self.uses_transcode_slot(request['json_file'])
+        self.rate_limiter.admit(client_ip, request['file_size'], transcode)
+        return request['file_size'], transcode
+
+    # 変換の枠を返し、前借りした転送量のうち受信しなかった分を返す
+    def release_request(self, client_ip, admitted, request_metrics):
+        if admitted is None:
+            return
+        file_size, transcode = admitted
+        self.rate_limiter.release(client_ip, transcode, file_size - request_metrics.bytes_in)
+
+    # この接続で ffmpeg を実行しうるリクエストか（ジョブとして積む変換は、ワーカー数で同時実行数が決まる）
+    @staticmethod
+    def uses_transcode_slot(json_file):
+        return not json_file.get('async_job')
 
     def perform_key_exchange(self, conn):
-        # RSA 鍵ペアを生成
-        key_manager = RSAKeyExchange()
+        # 事前生成済みの RSA 鍵ペアを取得（プールが空ならその場で生成）
+        key_manager = self.key_pool.acquire()
 
         # 自身の公開鍵をクライアントに送信（長さ 2 バイト + 本体）
         public_key_bytes = key_manager.public_key_bytes()
@@ -213,17 +1657,75 @@ class TCPServer:
 
         # クライアントから暗号化された AES 鍵＋IV を受信
         encrypted_key_size = int.from_bytes(self.recvn(conn, 2), 'big')
+
+        # 最上位ビットが立っていればチケットによる再開要求。受理できなければ続けて通常の鍵交換を受ける
+        if encrypted_key_size & RESUME_FLAG:
+            secure_socket = self.resume_session(conn, self.recvn(conn, encrypted_key_size & ~RESUME_FLAG))
+            if secure_socket is not None:
+                self.key_pool.release(key_manager)
+                return secure_socket
+            encrypted_key_size = int.from_bytes(self.recvn(conn, 2), 'big')
+
         encrypted_key_iv   = self.recvn(conn, encrypted_key_size)
 
-        # 秘密鍵で復号して AES 鍵と IV を取得
-        aes_key, aes_iv    = key_manager.decrypt_symmetric_key(encrypted_key_iv)
+        # 秘密鍵で復号して AES 鍵・IV・暗号モード・フラグを取得
+        aes_key, aes_iv, cipher_mode, flags = key_manager.decrypt_symmetric_key(encrypted_key_iv)
 
         # AES 暗号オブジェクトを作成し、暗号化ソケットでラップ
-        symmetric_cipher   = AESCipherCFB(aes_key, aes_iv)
+        symmetric_cipher   = create_session_cipher(aes_key, aes_iv, cipher_mode)
         secure_socket      = SecureSocket(conn, symmetric_cipher)
 
+        # 要求があれば、次回の接続で鍵交換を省くためのチケットを送る
+        if flags & KEY_FLAG_TICKET:
+            self.send_ticket(secure_socket, aes_key, aes_iv)
+
         return secure_socket
 
+    # チケット ID・クライアントの nonce・暗号モードからなる再開要求を検証し、再開したセッションを返す
+    # 受理した場合は 1 とサーバの nonce を、拒否した場合は 0 を平文で返す
+    def resume_session(self, conn, hello):
+        resumed = self.lookup_ticket(self.session_tickets, hello)
+        if resumed is None:
+            conn.sendall(b'\x00')
+            return None
+
+        secret, client_nonce, cipher_mode = resumed
+        server_nonce    = os.urandom(RESUME_NONCE_SIZE)
+        conn.sendall(b'\x01' + server_nonce)
+
+        aes_key, aes_iv = derive_resumed_key(secret, client_nonce, server_nonce)
+        return SecureSocket(conn, create_session_cipher(aes_key, aes_iv, cipher_mode))
+
+    # 再開要求を分解し、有効なチケットであれば (秘密, クライアントの nonce, 暗号モード) を返す
+    @staticmethod
+    def lookup_ticket(session_tickets, hello):
+        ticket_id    = hello[:TICKET_ID_SIZE]
+        client_nonce = hello[TICKET_ID_SIZE:TICKET_ID_SIZE + RESUME_NONCE_SIZE]
+        cipher_mode  = hello[TICKET_ID_SIZE + RESUME_NONCE_SIZE:]
+
+        if session_tickets is None or len(client_nonce) != RESUME_NONCE_SIZE or len(cipher_mode) != 1:
+            return None
+        secret = session_tickets.lookup(ticket_id)
+        if secret is None:
+            return None
+        return secret, client_nonce, cipher_mode[0]
+
+    def send_ticket(self, connection, aes_key, aes_iv):
+        json_data = self.ticket_response(self.session_tickets, aes_key, aes_iv)
+        connection.sendall(self.build_packet(json.dumps(json_data).encode('utf-8'), b'', 0))
+
+    # チケット ID と有効期間（秒）の応答を作る。チケットが無効な場合も、要求に応えて空の応答を返す
+    @staticmethod
+    def ticket_response(session_tickets, aes_key, aes_iv):
+        if session_tickets is None:
+            return {'error': False, 'error_message': None, 'ticket': None}
+        return {
+            'error': False,
+            'error_message': None,
+            'ticket': session_tickets.issue(aes_key, aes_iv).hex(),
+            'ticket_lifetime': session_tickets.lifetime,
+        }
+
     # 指定されたバイト数を受信するまで繰り返す
     @staticmethod
     def recvn(conn, n):
@@ -237,6 +1739,11 @@ class TCPServer:
 
     def parse_request(self, connection):
         packet = connection.recv()          # 復号済みパケット全体
+        return self.parse_packet(packet)
+
+    # ヘッダー＋ボディのパケットを解析して辞書で返す
+    @staticmethod
+    def parse_packet(packet):
         header = packet[:8]                 # 先頭 8 バイト = ヘッダー
         body   = packet[8:]                 # 残り = JSON + メディアタイプ
 
@@ -261,57 +1768,517 @@ class TCPServer:
             'media_type'        : media_type
         }
 
-    def operation_dispatcher(self, json_file, input_file_path):
-        # 操作コードとファイル名を取得
-        operation = json_file['operation']
-        file_name = json_file['file_name']
+    # クライアントが要求したフレームサイズを上限内に収める（未指定なら従来のチャンクサイズ）
+    @staticmethod
+    def negotiate_frame_size(json_file, default_frame_size):
+        frame_size = int(json_file.get('frame_size') or default_frame_size)
+        return max(1, min(frame_size, MAX_FRAME_SIZE))
 
-        if operation == 1:
-            return self.processor.compress_video(input_file_path, file_name)
+    # リクエストごとに一意なトークンを発行し、ファイル名をトークン付きの作業名に置き換える
+    @staticmethod
+    def assign_work_name(json_file):
+        request_token = uuid.uuid4().hex
+        file_name     = Path(json_file['file_name']).name
+        return request_token, {**json_file, 'file_name': f'{request_token}_{file_name}'}
 
-        elif operation == 2:
-            resolution = json_file.get('resolution')
-            return self.processor.change_resolution(input_file_path, file_name, resolution)
+    # リクエストの作業用ファイル（受信した入力と、作業名の付いた出力）のパス
+    # 変換結果のキャッシュは別の名前でリンク（またはコピー）して保持するため、送信後は消してよい
+    @staticmethod
+    def work_files(processor, json_file, input_file_path):
+        if json_file['operation'] == OPERATION_FANOUT:
+            renditions = processor.fan_out_requests(json_file)
+        else:
+            renditions = [json_file]
+        return [input_file_path, *(processor.operation_stream(rendition, 'pipe:')[1] for rendition in renditions)]
 
-        elif operation == 3:
-            aspect_ratio = json_file.get('aspect_ratio')
-            return self.processor.change_aspect_ratio(input_file_path, file_name, aspect_ratio)
+    # 存在するファイルだけを削除する
+    @staticmethod
+    def remove_files(paths):
+        for path in paths:
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+
+    # 出力ファイル名から作業用トークンを取り除き、クライアントに返す名前にする
+    @staticmethod
+    def strip_work_name(output_file_path, request_token):
+        return Path(output_file_path).name.replace(f'{request_token}_', '', 1)
+
+    # クライアントが送った内容ハッシュから、保持済みの変換結果・入力ファイルを探して返答する
+    # 変換結果があればその出力先を返し、入力ファイルがあれば作業用パスに復元して request に印を付ける
+    # 内容ハッシュを知っているだけではファイルを持っている証明にならないため、保持している入力の
+    # 無作為に選んだ範囲から作る証明を返せたクライアントにだけ、保持済みの内容を使わせる
+    # （入力を保持していない場合や、証明に対応しないクライアントはアップロードする）
+    def offer_known_content(self, connection, json_file, request, input_file_path):
+        content_hash     = json_file['content_hash']
+        cached_file_path = None
+        have_input       = False
+
+        if (json_file.get('possession_proof') and self.input_store is not None
+                and self.input_store.fetch(content_hash, input_file_path)):
+            have_input = self.verify_possession(connection, input_file_path, request['file_size'])
+            # 復元した入力は保持中のファイルへのリンクのため、アップロードで上書きされる前に外す
+            if not have_input:
+                os.remove(input_file_path)
+
+        # ファンアウトは出力ごとにキャッシュを引くため、ここでは入力の有無だけを返す
+        if have_input and json_file['operation'] != OPERATION_FANOUT:
+            cached_file_path = self.fetch_cached_result(content_hash, request, json_file, input_file_path)
+        request['input_restored'] = have_input and cached_file_path is None
+        # アップロードを省く場合、再試行前に受信していた途中のファイルはもう使わない
+        if have_input and json_file.get('upload_id'):
+            partial_path = self.partial_upload_path(self.processor.dpath, json_file['upload_id'], request['media_type'])
+            self.remove_files([partial_path])
+
+        reply = {
+            'error'         : False,
+            'error_message' : None,
+            'have_result'   : cached_file_path is not None,
+            'have_input'    : have_input,
+        }
+        connection.sendall(self.build_packet(json.dumps(reply).encode('utf-8'), b'', 0))
+        return cached_file_path
 
-        elif operation == 4:
-            return self.processor.convert_to_audio(input_file_path, file_name)
+    # 保持している入力のどの範囲を読ませるかを送り、クライアントが返した証明と照合する
+    def verify_possession(self, connection, input_file_path, file_size):
+        challenge = self.possession_challenge(file_size)
+        json_data = {'error': False, 'error_message': None, 'challenge': challenge}
+        connection.sendall(self.build_packet(json.dumps(json_data).encode('utf-8'), b'', 0))
 
-        elif operation == 5:
-            start_time = json_file.get('start_time')
-            duration   = json_file.get('duration')
-            return self.processor.create_gif(input_file_path, file_name, start_time, duration)
+        proof = self.parse_packet(connection.recv())['json_file'].get('proof')
+        return self.check_possession(input_file_path, file_size, challenge, proof)
 
+    # 証明の計算に使う nonce と、読ませる範囲 [位置, 長さ] の一覧を無作為に選ぶ
+    @staticmethod
+    def possession_challenge(file_size):
+        if file_size <= POSSESSION_SAMPLES * POSSESSION_SAMPLE_SIZE:
+            ranges = [[0, file_size]]
         else:
-            raise ValueError(f"Invalid operation code: {operation}")
+            ranges = sorted(
+                [secrets.randbelow(file_size - POSSESSION_SAMPLE_SIZE + 1), POSSESSION_SAMPLE_SIZE]
+                for _ in range(POSSESSION_SAMPLES)
+            )
+        return {'nonce': secrets.token_hex(16), 'ranges': ranges}
+
+    # 保持している入力から同じ計算で証明を作り、クライアントの証明と比べる（大きさが違えば別の内容とみなす）
+    @staticmethod
+    def check_possession(input_file_path, file_size, challenge, proof):
+        if not isinstance(proof, str) or os.path.getsize(input_file_path) != file_size:
+            return False
+        with open(input_file_path, 'rb') as file:
+            expected = TCPServer.possession_proof(file, challenge)
+        return hmac.compare_digest(proof, expected)
+
+    # nonce と、指定された範囲のバイト列を順に連結したものの SHA-256（クライアントも同じ計算をする）
+    @staticmethod
+    def possession_proof(file, challenge):
+        hasher = hashlib.sha256(bytes.fromhex(challenge['nonce']))
+        for offset, length in challenge['ranges']:
+            file.seek(offset)
+            hasher.update(file.read(length))
+        return hasher.hexdigest()
+
+    # 入力を受信し、(先読みしたフレーム, 内容ハッシュ) を返す
+    # ffmpeg に直接流し込める場合は先頭フレームだけを返し、ハッシュは流し込みの完了後に確定する
+    # 流し込めない場合は残りも受信してファイルに保存し、入力ファイルとして保持する
+    def receive_input(self, connection, json_file, request, input_file_path, hasher, allow_pipe=True, progress=None):
+        file_size  = request['file_size']
+        media_type = request['media_type']
+
+        # 重複アップロードとして保持済みの入力を復元した場合は受信しない
+        if request.get('input_restored'):
+            return None, json_file['content_hash']
+
+        pipeable = self.pipe_uploads and allow_pipe and self.processor.supports_pipe(json_file['operation'])
+        with request['metrics'].stage('receive'):
+            if json_file.get('upload_id'):
+                # 再開可能なアップロードは、前回までに受信した位置から続きを受信する
+                self.receive_resumable(connection, json_file, request, input_file_path, hasher, progress)
+            elif file_size > 0:
+                # 先頭フレームを先読みしてコンテナのヘッダーから要求を検証し、不正なら残りを受信せずに拒否する
+                head = connection.recv()
+                self.processor.check_head(json_file, media_type, head)
+                # 標準入力で渡せるコンテナであれば、保存せずに ffmpeg へ流し込む（残りの受信は変換の段階に含める）
+                if pipeable and self.processor.is_pipeable(media_type, head):
+                    return head, None
+                self.processor.save_file(connection, input_file_path, file_size, head, hasher, progress=progress)
+            else:
+                self.processor.save_file(connection, input_file_path, file_size, hasher=hasher)
+
+        content_hash = hasher.hexdigest()
+        if json_file.get('content_hash') not in (None, content_hash):
+            os.remove(input_file_path)
+            raise ValueError("Uploaded content does not match content_hash")
+        # 変換側で入力の解析結果を索引から引けるよう、確定した内容ハッシュを記録
+        json_file['content_hash'] = content_hash
+
+        # 次回以降のアップロードを省けるよう、変換前の入力を保持しておく
+        if self.input_store is not None:
+            self.input_store.store(content_hash, input_file_path)
+
+        return None, content_hash
+
+    # 受信途中のファイルをアップロード ID ごとに保存し、受信済みのバイト数を返答してから続きを受信する
+    # 受信が完了したら作業用パスへ移し、途中で切断された場合は次回の再開に備えて残しておく
+    def receive_resumable(self, connection, json_file, request, input_file_path, hasher, progress=None):
+        upload_id    = json_file['upload_id']
+        partial_path = self.partial_upload_path(self.processor.dpath, upload_id, request['media_type'])
+        file_size    = request['file_size']
+
+        with self.uploads_lock:
+            if upload_id in self.uploads:
+                raise ValueError(f"Upload {upload_id} is already in progress")
+            self.uploads.add(upload_id)
+
+        try:
+            offset = os.path.getsize(partial_path) if os.path.exists(partial_path) else 0
+            if offset > file_size:
+                offset = 0
+
+            reply = {'error': False, 'error_message': None, 'offset': offset}
+            connection.sendall(self.build_packet(json.dumps(reply).encode('utf-8'), b'', 0))
+
+            # 最初から受信する場合は、先頭フレームで要求を検証してから残りを受信する
+            head = b''
+            if offset == 0 and file_size > 0:
+                head = connection.recv()
+                self.processor.check_head(json_file, request['media_type'], head)
+
+            self.processor.save_file(connection, partial_path, file_size, head, hasher, offset, progress)
+            if os.path.getsize(partial_path) < file_size:
+                raise ConnectionError(f"Upload {upload_id} interrupted")
+            os.replace(partial_path, input_file_path)
+        finally:
+            with self.uploads_lock:
+                self.uploads.discard(upload_id)
+
+    # 再開可能なアップロードの受信途中のファイルの保存先
+    @staticmethod
+    def partial_upload_path(dpath, upload_id, media_type):
+        if not UPLOAD_ID_PATTERN.fullmatch(upload_id):
+            raise ValueError(f"Invalid upload_id: {upload_id}")
+
+        partial_dir = os.path.join(dpath, 'partial')
+        os.makedirs(partial_dir, exist_ok=True)
+        return os.path.join(partial_dir, upload_id + Path(media_type).suffix)
+
+    # ファイルを受信して変換する。可能な場合はファイルに保存せず ffmpeg に直接流し込む
+    def receive_and_process(self, connection, json_file, request, input_file_path, progress=None):
+        hasher = hashlib.sha256()
+        head, content_hash = self.receive_input(
+            connection, json_file, request, input_file_path, hasher, progress=progress
+        )
+
+        if head is not None:
+            with request['metrics'].transcode():
+                output_file_path = self.processor.pipe_file(
+                    connection, json_file, request['file_size'], head, hasher, progress
+                )
+            self.store_result(hasher.hexdigest(), request, json_file, output_file_path)
+            return output_file_path
+
+        # 同じ入力・同じパラメータの変換結果があれば ffmpeg を実行しない
+        cached_file_path = self.fetch_cached_result(content_hash, request, json_file, input_file_path)
+        if cached_file_path is not None:
+            return cached_file_path
+
+        with request['metrics'].transcode():
+            output_file_path = self.operation_dispatcher(json_file, input_file_path, progress)
+        self.store_result(content_hash, request, json_file, output_file_path)
+        return output_file_path
+
+    # ファイルを受信して変換しながら、ffmpeg の出力をそのままクライアントへ送る
+    # 変換と送信が並行するため、出力を送り終えるまでを変換の段階として計測する
+    def receive_and_stream(self, connection, json_file, request, input_file_path, request_token, frame_size):
+        hasher  = hashlib.sha256()
+        metrics = request['metrics']
+        head, content_hash = self.receive_input(connection, json_file, request, input_file_path, hasher)
+        source = 'pipe:' if head is not None else input_file_path
+
+        # キャッシュにあれば変換せず、完成済みのファイルを通常の応答で送る
+        if head is None:
+            cached_file_path = self.fetch_cached_result(content_hash, request, json_file, input_file_path)
+            if cached_file_path is not None:
+                response_name = self.strip_work_name(cached_file_path, request_token)
+                with metrics.stage('send'):
+                    self.send_file(connection, cached_file_path, response_name, frame_size,
+                                   json_file.get('download_offset', 0))
+                return cached_file_path
+
+        stream, output_file_path = self.processor.operation_stream(json_file, source)
+        # パレットをファイルとして扱う GIF は、パレットを作り終えるまで出力が始まらないためストリーミングしない
+        palette_file = head is None and self.processor.uses_palette_file(json_file)
+        if head is None:
+            probe  = self.processor.inspect_input(json_file, input_file_path)
+            stream = self.processor.copy_stream(json_file, input_file_path, output_file_path, probe) or stream
+        process = None if palette_file else self.processor.start_streaming(
+            stream, output_file_path, pipe_stdin=head is not None
+        )
+
+        # 標準出力に書き出せない形式の場合は、変換完了後に通常の応答で送る
+        if process is None:
+            with metrics.transcode():
+                if head is not None:
+                    output_file_path = self.processor.pipe_file(
+                        connection, json_file, request['file_size'], head, hasher
+                    )
+                elif palette_file:
+                    output_file_path = self.processor.run_operation(json_file, input_file_path)
+                else:
+                    output_file_path = self.processor.run_stream(stream, input_file_path, output_file_path)
+            self.store_result(content_hash or hasher.hexdigest(), request, json_file, output_file_path)
+            response_name = self.strip_work_name(output_file_path, request_token)
+            with metrics.stage('send'):
+                self.send_file(connection, output_file_path, response_name, frame_size,
+                               json_file.get('download_offset', 0))
+            return output_file_path
+
+        # 入力の流し込みは別スレッドで行い、このスレッドは出力の送信に専念する
+        feeder = None
+        if head is not None:
+            feeder = threading.Thread(
+                target=self.processor.feed_process,
+                args=(connection, process, request['file_size'], head, hasher),
+            )
+            feeder.start()
+
+        try:
+            response_name = self.strip_work_name(output_file_path, request_token)
+            with metrics.transcode():
+                self.send_streaming_file(connection, process, output_file_path, response_name, frame_size)
+        finally:
+            if feeder is not None:
+                feeder.join()
+            elif os.path.exists(input_file_path):
+                os.remove(input_file_path)
+
+        self.store_result(content_hash or hasher.hexdigest(), request, json_file, output_file_path)
+        return output_file_path
+
+    # ファイルを受信し、要求された複数の出力を作成して同じ接続でまとめて送る
+    # キャッシュにある出力はそのまま使い、残りだけを ffmpeg で作成する
+    def receive_and_fan_out(self, connection, json_file, request, input_file_path, request_token, frame_size,
+                            progress=None):
+        hasher = hashlib.sha256()
+        _, content_hash = self.receive_input(
+            connection, json_file, request, input_file_path, hasher, progress=progress
+        )
+        renditions = self.processor.fan_out_requests(json_file)
+
+        output_file_paths = [
+            self.fetch_cached_result(content_hash, request, rendition, None) for rendition in renditions
+        ]
+        pending = [index for index, path in enumerate(output_file_paths) if path is None]
+
+        if pending:
+            with request['metrics'].transcode():
+                created = self.processor.fan_out(
+                    [renditions[index] for index in pending], input_file_path, content_hash, progress
+                )
+            for index, output_file_path in zip(pending, created):
+                output_file_paths[index] = output_file_path
+                self.store_result(content_hash, request, renditions[index], output_file_path)
+        else:
+            os.remove(input_file_path)
+
+        with request['metrics'].stage('send'):
+            self.send_file_set(connection, output_file_paths, request_token, frame_size)
+        return output_file_paths
+
+    # ファイルを受信してジョブとしてキューに積み、ジョブ ID（作業用トークン）を返す
+    # 変換はワーカープロセスが行うため、接続が切れても処理は失われない
+    def receive_and_enqueue(self, connection, json_file, request, input_file_path, request_token, progress=None):
+        if self.job_queue is None:
+            raise ValueError("Job queue is disabled")
+
+        self.receive_input(
+            connection, json_file, request, input_file_path, hashlib.sha256(), allow_pipe=False, progress=progress
+        )
+        self.job_queue.submit(request_token, json_file, input_file_path)
+        request['job_submitted'] = True
+        self.send_job_status(connection, request_token, JOB_QUEUED)
+
+    # ジョブの状態を返し、完了していれば出力ファイルを送る（まだ終わっておらず、状態だけを返した場合は True）
+    def send_job_result(self, connection, job_id, frame_size, offset=0):
+        job = self.job_queue.get(job_id) if self.job_queue is not None and job_id else None
+        if job is None:
+            raise ValueError(f"Unknown job: {job_id}")
+
+        if job['status'] == JOB_FAILED:
+            self.send_error_response(connection, job['error_message'])
+
+        elif job['status'] != JOB_DONE:
+            self.send_job_status(connection, job_id, job['status'], job['progress'])
+            return True
+
+        elif job['json_file']['operation'] == OPERATION_FANOUT:
+            self.send_file_set(connection, job['output_paths'], job_id, frame_size)
+
+        else:
+            output_file_path = job['output_paths'][0]
+            response_name    = self.strip_work_name(output_file_path, job_id)
+            self.send_file(connection, output_file_path, response_name, frame_size, offset)
+        return False
+
+    # 死活監視への応答として、処理中の接続数と同時処理数を送る
+    def send_health(self, connection, load, capacity):
+        json_data = {
+            'error'         : False,
+            'error_message' : None,
+            'load'          : load,
+            'capacity'      : capacity,
+        }
+        connection.sendall(self.build_packet(json.dumps(json_data).encode('utf-8'), b'', 0))
+
+    # ジョブ ID と状態だけを送る（ファイル本体は含まない）
+    # 実行中のジョブは、ワーカーが最後に記録した変換の進捗も返す
+    def send_job_status(self, connection, job_id, status, progress=None):
+        json_data = {
+            'error'         : False,
+            'error_message' : None,
+            'job_id'        : job_id,
+            'status'        : status,
+        }
+        if progress is not None:
+            json_data['job_progress'] = progress
+        connection.sendall(self.build_packet(json.dumps(json_data).encode('utf-8'), b'', 0))
+
+    # キャッシュにある変換結果を本来の出力先に用意して返す（ヒットしなければ None）
+    def fetch_cached_result(self, content_hash, request, json_file, input_file_path):
+        if self.result_cache is None:
+            return None
+
+        cache_key = self.result_cache.make_key(content_hash, request['media_type'], json_file)
+        _, output_file_path = self.processor.operation_stream(json_file, input_file_path or 'pipe:')
+        if not self.result_cache.fetch(cache_key, output_file_path):
+            return None
+
+        if input_file_path is not None and os.path.exists(input_file_path):
+            os.remove(input_file_path)
+        return output_file_path
+
+    # 変換結果を入力のハッシュと変換パラメータをキーにキャッシュへ登録
+    def store_result(self, content_hash, request, json_file, output_file_path):
+        if self.result_cache is None:
+            return
+
+        cache_key = self.result_cache.make_key(content_hash, request['media_type'], json_file)
+        self.result_cache.store(cache_key, output_file_path)
+
+    def operation_dispatcher(self, json_file, input_file_path, progress=None):
+        # 分散ワーカーが設定されていれば、最も負荷の低いワーカーへ転送して変換させる
+        # （ワーカー側の変換の進捗は中継しない）
+        if self.remote_workers is not None:
+            return self.remote_workers.run(json_file, input_file_path)
+
+        # 操作コードに対応する ffmpeg コマンドを組み立てて実行（圧縮・変換など）
+        return self.processor.run_operation(json_file, input_file_path, progress)
 
-    def send_file(self, connection, output_file_path):
+    # offset が指定された場合は、その位置から末尾までを送る（中断したダウンロードの再開用）
+    def send_file(self, connection, output_file_path, file_name=None, frame_size=None, offset=0):
         # パス処理とメタ情報の準備
         path = Path(output_file_path)
-        file_name, media_type = path.name, path.suffix.encode('utf-8')
+        file_name, media_type = file_name or path.name, path.suffix.encode('utf-8')
+
+        # ファイル読み込みと送信（読み込み用バッファを使い回し、その場で暗号化して送る）
+        frame_size = frame_size or self.chunk_size
+        buffer = bytearray(frame_size)
+        view   = memoryview(buffer)
+
+        with open(output_file_path, 'rb') as file:
+            file.seek(0, os.SEEK_END)
+            file_size = file.tell()
+            offset    = min(max(offset, 0), file_size)
+            file.seek(offset)
+
+            # レスポンス用の情報を辞書として作成（ファイルサイズ欄は送信する残りのバイト数）
+            json_data = {
+                'file_name': file_name,
+                'error': False,
+                'error_message': None,
+                'frame_size': frame_size,
+                'offset': offset
+            }
+            # この応答のために変換した場合は、エンコード速度と出力サイズも返す
+            encode_stats = self.processor.pop_encode_stats(output_file_path)
+            if encode_stats is not None:
+                json_data['encode_stats'] = encode_stats
+            json_bytes = json.dumps(json_data).encode('utf-8')
+
+            packet = self.build_packet(json_bytes, media_type, file_size - offset)
+            connection.sendall(packet)
+
+            while n := file.readinto(buffer):
+                connection.sendall_inplace(view[:n])
+
+    # 複数のファイルを 1 つの応答として送る（ファイル数を示すパケット → 各ファイルを順に送信）
+    def send_file_set(self, connection, output_file_paths, request_token, frame_size):
+        json_data = {
+            'error'         : False,
+            'error_message' : None,
+            'file_count'    : len(output_file_paths),
+            'frame_size'    : frame_size,
+        }
+        connection.sendall(self.build_packet(json.dumps(json_data).encode('utf-8'), b'', 0))
+
+        for output_file_path in output_file_paths:
+            response_name = self.strip_work_name(output_file_path, request_token)
+            self.send_file(connection, output_file_path, response_name, frame_size)
+
+    # ffmpeg の標準出力を読みながら、出力ファイルに保存しつつクライアントへ送信
+    # 長さ未確定のヘッダー → データフレーム → 長さ 0 の終端フレーム → 結果パケット の順に送る
+    def send_streaming_file(self, connection, process, output_file_path, file_name, frame_size):
+        media_type = Path(output_file_path).suffix.encode('utf-8')
 
-        # レスポンス用の情報を辞書として作成
         json_data = {
             'file_name': file_name,
             'error': False,
-            'error_message': None
+            'error_message': None,
+            'frame_size': frame_size,
+            'streaming': True
         }
         json_bytes = json.dumps(json_data).encode('utf-8')
+        connection.sendall(self.build_packet(json_bytes, media_type, STREAMING_FILE_SIZE))
 
-        # ファイル読み込みと送信
-        with open(output_file_path, 'rb') as file:
-            file.seek(0, os.SEEK_END)
-            file_size = file.tell()
-            file.seek(0)
-
-            packet = self.build_packet(json_bytes, media_type, file_size)
-            connection.sendall(packet)
+        buffer = bytearray(frame_size)
+        view   = memoryview(buffer)
 
-            while chunk := file.read(self.chunk_size):
-                connection.sendall(chunk)
+        try:
+            with open(output_file_path, 'wb') as file:
+                # 届いた分だけ読み取り、暗号化で上書きされる前にファイルへ書き込む
+                while n := process.stdout.readinto1(buffer):
+                    file.write(view[:n])
+                    connection.sendall_inplace(view[:n])
+        finally:
+            # 途中で失敗しても、クライアントが後続のパケットを結果として読めるよう終端を送る
+            process.stdout.close()
+            returncode = process.wait()
+            connection.sendall(b'')
+
+        if returncode != 0:
+            raise ffmpeg_error(returncode)
+
+        # 正常終了を知らせる結果パケット（失敗時は send_error_response が結果パケットになる）
+        trailer = json.dumps({'error': False, 'error_message': None}).encode('utf-8')
+        connection.sendall(self.build_packet(trailer, b'', 0))
+
+    # 進捗を要求したリクエストに対し、進捗のパケットを送る ProgressReporter を返す（要求がなければ None）
+    # ストリーミング応答は出力のフレームと混ざるため、進捗を送らない
+    def progress_reporter(self, connection, json_file):
+        if not json_file.get('progress') or json_file.get('stream_response'):
+            return None
+        return ProgressReporter(lambda progress: connection.sendall(self.progress_packet(progress)))
+
+    # 進捗のパケット（ファイル本体を持たず、応答の前に何度でも届く）
+    @staticmethod
+    def progress_packet(progress):
+        json_data = {
+            'error'         : False,
+            'error_message' : None,
+            'progress'      : progress,
+        }
+        return TCPServer.build_packet(json.dumps(json_data).encode('utf-8'), b'', 0)
 
     @staticmethod
     def build_packet(json_bytes, media_type_bytes, file_size):
@@ -326,11 +2293,13 @@ class TCPServer:
         
         return header + json_bytes + media_type_bytes
 
-    def send_error_response(self, connection, error_message):
+    # details が渡された場合は、エラーの種類や再試行までの秒数などをエラー情報に加える
+    def send_error_response(self, connection, error_message, details=None):
         # クライアントへ送信するエラー情報を辞書で作成（error=True・エラーメッセージ）
         error_response = {
             'error'         : True,
-            'error_message' : error_message
+            'error_message' : error_message,
+            **(details or {}),
         }
         # 辞書を JSON にシリアライズし、バイト列としてエンコード
         json_bytes = json.dumps(error_response).encode('utf-8')
@@ -339,7 +2308,8 @@ class TCPServer:
         # connection が SecureSocket なら暗号化されて送信される
         connection.sendall(packet)
 
-    def write_log_start(self, start_time, client_ip, log_vals):
+    @staticmethod
+    def write_log_start(start_time, client_ip, log_vals):
         return log_start(
             start_time,             # timestamp_start
             client_ip,              # client_ip
@@ -349,22 +2319,166 @@ class TCPServer:
             log_vals['media_type']  # media_type
         )
 
-    def write_log_end(self, log_id, end_time):
-        # log_id が None でなければ log_end を呼び出す
+    @staticmethod
+    def write_log_end(log_id, end_time, request_metrics=None):
+        # log_id が None でなければ log_end を呼び出す（段階ごとの処理時間・転送量も記録する）
         if log_id is not None:
-            log_end(log_id, end_time)
+            log_end(log_id, end_time, request_metrics.as_log() if request_metrics is not None else None)
 
 
 
 if __name__ == "__main__":
     
     # サーバーの IPアドレスと ポート番号 を設定
-    server_address = '0.0.0.0'
-    server_port    = 9001
+    # 同じホストで複数起動する場合（coordinator とワーカーなど）は SERVER_PORT だけを変えればよい
+    # 既定以外のポートでは、作業ディレクトリ・ジョブの DB・メトリクスのポートの既定値もポートごとに分ける
+    server_address = os.environ.get('SERVER_ADDRESS', '0.0.0.0')
+    server_port    = int(os.environ.get('SERVER_PORT', SERVER_PORT))
+    instance       = '' if server_port == SERVER_PORT else f'_{server_port}'
+
+    # 同時処理数と処理待ち接続数の上限（未指定なら CPU コア数から決定）
+    max_workers = int(os.environ.get('MAX_WORKERS', 0)) or None
+    max_pending = os.environ.get('MAX_PENDING')
+    max_pending = int(max_pending) if max_pending is not None else None
+
+    # 事前生成しておく RSA 鍵ペアの数（0 でプールを無効化）
+    key_pool = RSAKeyPool(int(os.environ.get('RSA_POOL_SIZE', 8)))
+
+    # PIPE_UPLOADS=1 でアップロードを受信しながら変換する
+    pipe_uploads = os.environ.get('PIPE_UPLOADS', '0') == '1'
+
+    # メディア処理オブジェクトを作成（SEGMENT_WORKERS=2 以上で長い動画を分割して並列に変換）
+    # PERFORMANCE_PROFILE=fast / balanced / archival で再エンコードの速度とサイズの配分を選ぶ
+    # FFMPEG_THREADS で 1 回の変換に使うスレッド数を制限する（0 で ffmpeg に任せる）
+    # STREAM_COPY=0 で、再エンコードせずに済む変換も常に再エンコードする
+    # PALETTE_CACHE_MAX_BYTES は GIF のパレットを保持する容量（バイト単位、0 で無効）
+    # MEDIA_INDEX_MAX_ENTRIES は入力の解析結果を内容ハッシュごとに保持する件数（0 で無効）
+    # PROCESSED_DIR は受信・変換したファイルとキャッシュを置くディレクトリ
+    processor = MediaProcessor(
+        os.environ.get('PROCESSED_DIR', 'processed' + instance),
+        segment_workers=int(os.environ.get('SEGMENT_WORKERS', 1)),
+        profile=os.environ.get('PERFORMANCE_PROFILE', DEFAULT_PROFILE),
+        threads=int(os.environ.get('FFMPEG_THREADS', 0)),
+        stream_copy=os.environ.get('STREAM_COPY', '1') == '1',
+        palette_cache_bytes=int(os.environ.get('PALETTE_CACHE_MAX_BYTES', PALETTE_CACHE_BYTES)),
+        media_index_entries=int(os.environ.get('MEDIA_INDEX_MAX_ENTRIES', 10000)),
+    )
+
+    # 変換結果キャッシュの容量（バイト単位、0 で無効）
+    # プロファイルによって変換結果が変わるため、キャッシュキーにはプロファイル名を含める
+    cache_bytes  = int(os.environ.get('RESULT_CACHE_MAX_BYTES', 10 * 1024 ** 3))
+    result_cache = None
+    if cache_bytes > 0:
+        result_cache = ResultCache(os.path.join(processor.dpath, 'cache'), cache_bytes, namespace=processor.profile)
+
+    # 重複アップロード判定のために保持する入力ファイルの容量（バイト単位、0 で無効）
+    input_bytes  = int(os.environ.get('INPUT_STORE_MAX_BYTES', 20 * 1024 ** 3))
+    input_store  = ResultCache(os.path.join(processor.dpath, 'inputs'), input_bytes) if input_bytes > 0 else None
+
+    # 再試行されないまま PARTIAL_UPLOAD_MAX_AGE 秒経った受信途中のファイルは削除する（0 で削除しない）
+    partial_max_age = float(os.environ.get('PARTIAL_UPLOAD_MAX_AGE', 24 * 60 * 60))
+    partial_sweeper = None
+    if partial_max_age > 0:
+        partial_sweeper = PartialUploadSweeper(processor.dpath, partial_max_age)
+        partial_sweeper.start()
+
+    # 接続と切り離して変換するジョブのワーカー数（未指定・0 ならジョブのキューを使わない）
+    # ジョブのキューはログ用 DB と同じディレクトリに置く
+    # 終了したジョブの状態と出力は JOB_RETENTION 秒で削除する（未指定なら 1 日、0 で削除しない）
+    job_workers   = int(os.environ.get('JOB_WORKERS', 0))
+    job_retention = float(os.environ.get('JOB_RETENTION', 24 * 60 * 60))
+    job_queue     = None
+    worker_pool   = None
+    if job_workers > 0:
+        log_db_path = os.environ.get('SQLITE_DB_PATH', '/data/logs.db')
+        job_queue   = JobQueue(os.environ.get('JOB_DB_PATH', os.path.join(os.path.dirname(log_db_path), f'jobs{instance}.db')))
+        worker_pool = WorkerPool(job_queue, processor, job_workers, retention=job_retention or None)
+        worker_pool.start()
+
+    # WORKER_NODES="host:port,..." を指定すると coordinator として動き、変換を各ワーカーへ転送する
+    # ワーカーが WORKER_JOB_TIMEOUT 秒応答しなければ障害とみなし、別のワーカー（全滅時はローカル）で変換する
+    remote_workers = None
+    if os.environ.get('WORKER_NODES'):
+        from coordinator import RemoteWorkers
+        remote_workers = RemoteWorkers(
+            RemoteWorkers.parse_nodes(os.environ['WORKER_NODES']), processor,
+            health_interval=float(os.environ.get('WORKER_HEALTH_INTERVAL', 5)),
+            retries=int(os.environ.get('WORKER_RETRIES', 2)),
+            job_timeout=float(os.environ.get('WORKER_JOB_TIMEOUT', 3600)),
+        )
+        remote_workers.start()
+
+    # 再接続したクライアントが RSA 鍵交換を省くためのチケットの有効期間（秒、0 で無効）
+    # keep_alive のセッションで次のリクエストを待つ時間（秒）
+    ticket_lifetime      = float(os.environ.get('SESSION_TICKET_LIFETIME', 600))
+    session_tickets      = SessionTickets(ticket_lifetime) if ticket_lifetime > 0 else None
+    session_idle_timeout = float(os.environ.get('SESSION_IDLE_TIMEOUT', 30))
+    # 次のリクエストを待つセッションの上限（超えたら最も長く待っているセッションを閉じる）
+    max_idle_sessions    = int(os.environ.get('MAX_IDLE_SESSIONS', MAX_IDLE_SESSIONS))
+
+    # リクエストの段階ごとの処理時間・転送量を、Prometheus のテキスト形式で GET /metrics に公開する
+    # 既定ではローカルからのみ取得でき、METRICS_PORT=0 で無効
+    # 既定のポートは 9464 を、SERVER_PORT を既定からずらした分だけずらす（9002 で起動すれば 9465）
+    metrics_registry = MetricsRegistry()
+    metrics_server   = None
+    metrics_port     = int(os.environ.get('METRICS_PORT', METRICS_PORT + server_port - SERVER_PORT))
+    if metrics_port > 0:
+        metrics_address = os.environ.get('METRICS_ADDRESS', METRICS_ADDRESS)
+        metrics_server  = MetricsServer(metrics_registry, metrics_address, metrics_port)
+        metrics_server.start()
+
+    # キャッシュ・鍵プール・索引・チケットのヒット数や使用量も、取得のたびに読んで公開する
+    metrics_registry.register_stats('rsa_key_pool', key_pool.stats)
+    metrics_registry.register_stats('media_index', processor.media_index.stats)
+    if result_cache is not None:
+        metrics_registry.register_stats('result_cache', result_cache.stats)
+    if input_store is not None:
+        metrics_registry.register_stats('input_store', input_store.stats)
+    if processor.palette_cache_bytes > 0:
+        metrics_registry.register_stats('palette_cache', processor.palette_cache().stats)
+    if session_tickets is not None:
+        metrics_registry.register_stats('session_tickets', session_tickets.stats)
+
+    # クライアント（IP アドレス）ごとの制限（いずれも 0 で無効、既定はすべて無効）
+    # RATE_LIMIT_REQUESTS_PER_MINUTE はリクエスト数/分、RATE_LIMIT_BYTES_PER_SECOND はアップロードの転送量（バイト/秒）
+    # MAX_TRANSCODES_PER_CLIENT は同時に行う変換の数
+    # GUI や coordinator 経由の要求は 1 つのアドレスからまとめて届くため、RATE_LIMIT_EXEMPT に
+    # そのアドレス・ネットワークを "10.0.0.5,10.0.1.0/24" の形式で指定して制限から外す
+    requests_per_minute = float(os.environ.get('RATE_LIMIT_REQUESTS_PER_MINUTE', 0))
+    bytes_per_second    = float(os.environ.get('RATE_LIMIT_BYTES_PER_SECOND', 0))
+    max_transcodes      = int(os.environ.get('MAX_TRANSCODES_PER_CLIENT', 0))
+    rate_limiter        = None
+    if requests_per_minute > 0 or bytes_per_second > 0 or max_transcodes > 0:
+        rate_limiter = ClientRateLimiter(
+            requests_per_minute, bytes_per_second, max_transcodes,
+            burst_seconds=float(os.environ.get('RATE_LIMIT_BURST_SECONDS', RATE_LIMIT_BURST_SECONDS)),
+            exempt=[part.strip() for part in os.environ.get('RATE_LIMIT_EXEMPT', '').split(',') if part.strip()],
+        )
 
-    # メディア処理オブジェクトを作成
-    processor = MediaProcessor()
+    # SERVER_MODE=async の場合は asyncio 版サーバを起動
+    if os.environ.get('SERVER_MODE', 'threaded') == 'async':
+        from async_server import run_async_server
+        run_async_server(
+            server_address, server_port, processor, max_workers, key_pool, pipe_uploads, result_cache, input_store,
+            job_queue, remote_workers, session_tickets, session_idle_timeout, metrics_registry, rate_limiter
+        )
 
-    # サーバを起動
-    tcp_server = TCPServer(server_address, server_port, processor)
-    tcp_server.start_server()
+    else:
+        # サーバを起動（SIGTERM / SIGINT で新規受付を止め、処理中の接続を待って終了）
+        tcp_server = TCPServer(server_address, server_port, processor, max_workers, max_pending, key_pool,
+                               pipe_uploads, result_cache, input_store, job_queue, remote_workers,
+                               session_tickets, session_idle_timeout, metrics_registry, rate_limiter,
+                               max_idle_sessions)
+        signal.signal(signal.SIGTERM, lambda signum, frame: tcp_server.shutdown())
+        signal.signal(signal.SIGINT,  lambda signum, frame: tcp_server.shutdown())
+        tcp_server.start_server()
+
+    # 実行中のジョブが終わるのを待ってワーカーを停止
+    if partial_sweeper is not None:
+        partial_sweeper.close()
+    if worker_pool is not None:
+        worker_pool.close()
+    if remote_workers is not None:
+        remote_workers.close()
+    if metrics_server is not None:
+        metrics_server.close()
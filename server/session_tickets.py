@@ -0,0 +1,80 @@
+import hashlib
+import os
+import threading
+import time
+from collections import OrderedDict
+
+
+# 鍵交換時の長さ 2 バイトの最上位ビット。立っていればチケットによるセッション再開の要求
+RESUME_FLAG        = 0x8000
+
+# 鍵交換で暗号モードの後ろに付くフラグ。立っていればセッション再開用のチケットを要求
+KEY_FLAG_TICKET    = 0x01
+
+# チケット ID と、再開時にクライアント・サーバが送る nonce の長さ
+TICKET_ID_SIZE     = 16
+RESUME_NONCE_SIZE  = 16
+
+
+# RSA 鍵交換で確立した AES 鍵・IV から、チケットに対応する秘密を導出
+# 秘密そのものは送らず、クライアントも同じ計算で導出する
+def ticket_secret(aes_key: bytes, aes_iv: bytes) -> bytes:
+    return hashlib.sha256(b'ticket' + aes_key + aes_iv).digest()
+
+
+# チケットの秘密と双方の nonce から、再開したセッションの AES 鍵と IV を導出
+# サーバの nonce を混ぜるため、記録した再開要求を送り直しても同じ鍵にはならない
+def derive_resumed_key(secret: bytes, client_nonce: bytes, server_nonce: bytes) -> tuple:
+    digest = hashlib.sha256(b'resume' + secret + client_nonce + server_nonce).digest()
+    return digest[:16], digest[16:32]
+
+
+# 再接続したクライアントが RSA 鍵交換を省けるよう、発行したチケットと秘密を保持する
+# 有効期限を過ぎたものと、上限を超えた古いものから破棄する（サーバ再起動で全て無効になる）
+class SessionTickets:
+
+    def __init__(self, lifetime: float = 600.0, max_entries: int = 10000):
+        self.lifetime    = lifetime
+        self.max_entries = max_entries
+
+        self.lock        = threading.Lock()
+        self.tickets     = OrderedDict()   # チケット ID → (秘密, 有効期限)。末尾ほど新しいもの
+        self.issued      = 0
+        self.resumed     = 0
+        self.rejected    = 0
+
+    # 鍵交換で確立した鍵からチケットを発行し、チケット ID を返す
+    def issue(self, aes_key: bytes, aes_iv: bytes) -> bytes:
+        ticket_id = os.urandom(TICKET_ID_SIZE)
+        expires   = time.monotonic() + self.lifetime
+
+        with self.lock:
+            self.tickets[ticket_id] = (ticket_secret(aes_key, aes_iv), expires)
+            self.issued += 1
+            while len(self.tickets) > self.max_entries:
+                self.tickets.popitem(last=False)
+        return ticket_id
+
+    # チケットに対応する秘密を返す（未知・期限切れなら None）
+    def lookup(self, ticket_id: bytes) -> bytes | None:
+        with self.lock:
+            entry = self.tickets.get(ticket_id)
+            if entry is not None and entry[1] < time.monotonic():
+                del self.tickets[ticket_id]
+                entry = None
+
+            if entry is None:
+                self.rejected += 1
+                return None
+            self.resumed += 1
+            return entry[0]
+
+    # 発行数・再開数・拒否数と保持しているチケットの数を返す
+    def stats(self) -> dict:
+        with self.lock:
+            return {
+                'issued'   : self.issued,
+                'resumed'  : self.resumed,
+                'rejected' : self.rejected,
+                'entries'  : len(self.tickets),
+            }
@@ -1,18 +1,70 @@
+import atexit
+import itertools
 import os
+import queue
 import sqlite3
-from datetime import datetime
+import threading
+import time
+import traceback
 from pathlib import Path
 
 
+# 1 回のトランザクションでまとめて書き込むログの最大件数
+LOG_BATCH_SIZE = 256
+
+# ログが少ない間も、この秒数ごとに溜まった分をコミットする
+LOG_FLUSH_INTERVAL = 0.5
+
+# 書き込み待ちのログの上限（超えた分は捨て、リクエストの処理は止めない）
+LOG_MAX_PENDING = 100_000
+
+# 書き込みスレッドへの停止の合図
+_STOP = object()
+
+# リクエストの段階ごとの処理時間・転送量などを記録する列（log_end の metrics で値を渡す）
+METRIC_COLUMNS = {
+    'key_exchange_seconds' : 'REAL',
+    'receive_seconds'      : 'REAL',
+    'transcode_seconds'    : 'REAL',
+    'send_seconds'         : 'REAL',
+    'bytes_in'             : 'INTEGER',
+    'bytes_out'            : 'INTEGER',
+    'receive_throughput'   : 'REAL',      # バイト/秒
+    'send_throughput'      : 'REAL',      # バイト/秒
+    'ffmpeg_exit_code'     : 'INTEGER',
+    'status'               : 'TEXT',      # ok / error
+}
+
+
+# 接続処理のスレッドからはキューへ積むだけにし、1 本の書き込みスレッドが
+# WAL モードの接続を使い回して、溜まったログを 1 回のトランザクションでまとめてコミットする
+# log_start はデータベースの行 ID ではなくプロセス内の番号を返し、書き込みスレッドが行 ID と対応付ける
+# （複数のプロセスが同じファイルへ書いても ID が衝突しない）
 class SQLiteLogger:
 
-    def __init__(self, db_path: str = "/data/logs.db"):
+    def __init__(
+        self,
+        db_path: str = "/data/logs.db",
+        batch_size: int = LOG_BATCH_SIZE,
+        flush_interval: float = LOG_FLUSH_INTERVAL,
+        max_pending: int = LOG_MAX_PENDING,
+    ):
         # パス配下のディレクトリが無ければ作成
-        Path(os.path.dirname(db_path)).mkdir(parents=True, exist_ok=True)
-        self.db_path = db_path
+        Path(os.path.dirname(db_path) or '.').mkdir(parents=True, exist_ok=True)
+        self.db_path        = db_path
+        self.batch_size     = batch_size
+        self.flush_interval = flush_interval
+
+        self.queue    = queue.Queue(max_pending)
+        self.handles  = itertools.count(1)
+        self.row_ids  = {}      # log_start の番号 → 行 ID（書き込みスレッドだけが触る）
+        self.written  = 0       # 書き込んだログの件数
+        self.dropped  = 0       # キューが溢れて捨てたログの件数
+        self.lock     = threading.Lock()
+        self.writer   = None
         self._init_db()
 
-    # 開始レコードを追加し、行 ID を返却
+    # 開始レコードの追加をキューに積み、log_end に渡す番号を返却
     def log_start(
         self,
         start_time: str,
@@ -22,40 +74,126 @@ class SQLiteLogger:
         file_size: int,
         media_type: str,
     ) -> int:
-      
-        with sqlite3.connect(self.db_path) as conn:
-            cur = conn.cursor()
-            cur.execute(
-                """
-                INSERT INTO logs
-                  (start_time, end_time, client_ip, operation, file_name,
-                   file_size, media_type)
-                VALUES (?, NULL, ?, ?, ?, ?, ?)
-                """,
-                (
-                    start_time,
-                    client_ip,
-                    operation,
-                    file_name,
-                    file_size,
-                    media_type,
-                ),
-            )
-            conn.commit()
-            return cur.lastrowid
+        handle = next(self.handles)
+        self._enqueue(('start', handle, (start_time, client_ip, operation, file_name, file_size, media_type)))
+        return handle
 
-    # 終了時刻を更新
-    def log_end(self, row_id: int, end_time: str) -> None:
-        with sqlite3.connect(self.db_path) as conn:
-            conn.execute(
-                "UPDATE logs SET end_time = ? WHERE id = ?",
-                (end_time, row_id),
-            )
-            conn.commit()
+    # 終了時刻と、リクエストの処理時間・転送量などの更新をキューに積む
+    def log_end(self, row_id: int, end_time: str, metrics: dict | None = None) -> None:
+        metrics = metrics or {}
+        self._enqueue(('end', row_id, (end_time, *(metrics.get(column) for column in METRIC_COLUMNS))))
+
+    # キューに積んだログを書き終えるまで待つ（書き込みスレッドが動いていなければすぐ戻る）
+    def flush(self, timeout: float | None = None) -> bool:
+        with self.lock:
+            if self.writer is None or not self.writer.is_alive():
+                return True
+        done = threading.Event()
+        self.queue.put(done)
+        return done.wait(timeout)
+
+    # 残りのログを書き込んで書き込みスレッドを止める
+    def close(self, timeout: float | None = None) -> None:
+        with self.lock:
+            writer, self.writer = self.writer, None
+        if writer is not None and writer.is_alive():
+            self.queue.put(_STOP)
+            writer.join(timeout)
+
+    # ワーカープロセスなどログを書かないプロセスでスレッドを作らないよう、最初のログで書き込みスレッドを起動する
+    def _enqueue(self, event: tuple) -> None:
+        if self.writer is None:
+            with self.lock:
+                if self.writer is None:
+                    self.writer = threading.Thread(target=self._write_loop, daemon=True)
+                    self.writer.start()
+        try:
+            self.queue.put_nowait(event)
+        except queue.Full:
+            self.dropped += 1
+
+    # キューからログを取り出し、batch_size 件か flush_interval 秒ごとにまとめてコミットする
+    def _write_loop(self) -> None:
+        conn = self._connect()
+        try:
+            while True:
+                batch, waiters, stop = self._next_batch()
+                if batch:
+                    try:
+                        with conn:
+                            inserted, finished = self._write_batch(conn, batch)
+                        # 行 ID の対応はコミットできた分だけ反映する（ロールバックした行の ID は残さない）
+                        self.row_ids.update(inserted)
+                        for handle in finished:
+                            self.row_ids.pop(handle, None)
+                        self.written += len(batch)
+                    except sqlite3.Error:
+                        # ログの書き込みに失敗しても変換は止めない
+                        traceback.print_exc()
+                for waiter in waiters:
+                    waiter.set()
+                if stop:
+                    return
+        finally:
+            conn.close()
+
+    # 最初の 1 件を待ち、以降は締め切りまでに届いた分を batch_size 件まで集める
+    def _next_batch(self) -> tuple[list, list, bool]:
+        batch, waiters = [], []
+        deadline       = None
+        while len(batch) < self.batch_size:
+            timeout = None if deadline is None else deadline - time.monotonic()
+            if timeout is not None and timeout <= 0:
+                break
+            try:
+                event = self.queue.get(timeout=timeout)
+            except queue.Empty:
+                break
+
+            if event is _STOP:
+                return batch, waiters, True
+            if isinstance(event, threading.Event):
+                # flush の呼び出し元は、それまでに積まれたログのコミットを待つ
+                waiters.append(event)
+                break
+            batch.append(event)
+            if deadline is None:
+                deadline = time.monotonic() + self.flush_interval
+        return batch, waiters, False
+
+    # 挿入した行の ID（番号 → 行 ID）と、終了を書き込んだ番号を返す
+    def _write_batch(self, conn: sqlite3.Connection, batch: list) -> tuple[dict, set]:
+        inserted, finished = {}, set()
+        for kind, handle, values in batch:
+            if kind == 'start':
+                cur = conn.execute(
+                    """
+                    INSERT INTO logs
+                      (start_time, end_time, client_ip, operation, file_name,
+                       file_size, media_type)
+                    VALUES (?, NULL, ?, ?, ?, ?, ?)
+                    """,
+                    values,
+                )
+                inserted[handle] = cur.lastrowid
+            else:
+                row_id = inserted.pop(handle, None) or self.row_ids.get(handle)
+                if row_id is not None:
+                    assignments = ', '.join(f"{column} = ?" for column in ('end_time', *METRIC_COLUMNS))
+                    conn.execute(f"UPDATE logs SET {assignments} WHERE id = ?", (*values, row_id))
+                    finished.add(handle)
+        return inserted, finished
+
+    # 書き込みスレッドが使い続ける接続（他のプロセスが読み書きしていてもロック待ちで失敗しないようにする）
+    def _connect(self) -> sqlite3.Connection:
+        conn = sqlite3.connect(self.db_path, timeout=30, check_same_thread=False)
+        conn.execute("PRAGMA synchronous=NORMAL")
+        return conn
 
-    # 初回呼び出し時にテーブルを作成
+    # 初回呼び出し時にテーブルを作成（書き込み中も読み出せるよう WAL モードにする）
     def _init_db(self) -> None:
-        with sqlite3.connect(self.db_path) as conn:
+        with sqlite3.connect(self.db_path, timeout=30) as conn:
+            conn.execute("PRAGMA journal_mode=WAL")
             conn.execute(
                 """
                 CREATE TABLE IF NOT EXISTS logs (
@@ -70,10 +208,23 @@ class SQLiteLogger:
                 )
                 """
             )
+            # 計測の列を追加する前に作られたデータベースには、列を追加する
+            # 同時に起動した他のプロセスと重ねて追加しないよう、書き込みロックを取ってから確かめる
+            conn.execute("BEGIN IMMEDIATE")
+            columns = {row[1] for row in conn.execute("PRAGMA table_info(logs)")}
+            for column, column_type in METRIC_COLUMNS.items():
+                if column not in columns:
+                    conn.execute(f"ALTER TABLE logs ADD COLUMN {column} {column_type}")
             conn.commit()
 
 
-_default_logger = SQLiteLogger(os.environ.get("SQLITE_DB_PATH", "/data/logs.db"))
+_default_logger = SQLiteLogger(
+    os.environ.get("SQLITE_DB_PATH", "/data/logs.db"),
+    batch_size=int(os.environ.get("LOG_BATCH_SIZE", LOG_BATCH_SIZE)),
+    flush_interval=float(os.environ.get("LOG_FLUSH_INTERVAL", LOG_FLUSH_INTERVAL)),
+)
+# 終了時に書き込み待ちのログを残さない
+atexit.register(_default_logger.close, 5)
 
 log_start = _default_logger.log_start
 log_end   = _default_logger.log_end
@@ -0,0 +1,33 @@
+import os
+import sys
+import tempfile
+from pathlib import Path
+
+import pytest
+
+# server のモジュールは互いを名前だけで import するため、server ディレクトリをパスに追加する
+ROOT = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(ROOT / 'server'))
+
+# server を import するとログ用 DB の書き込み先が決まるため、既定の /data ではなく一時ディレクトリにする
+os.environ.setdefault('SQLITE_DB_PATH', os.path.join(tempfile.mkdtemp(prefix='tests_'), 'logs.db'))
+
+
+# time.monotonic を差し替え、有効期限やトークンの回復を待たずに確かめるための時計
+class FakeClock:
+
+    def __init__(self, now: float = 1000.0):
+        self.now = now
+
+    def __call__(self) -> float:
+        return self.now
+
+    def advance(self, seconds: float) -> None:
+        self.now += seconds
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    fake = FakeClock()
+    monkeypatch.setattr('time.monotonic', fake)
+    return fake
@@ -0,0 +1,130 @@
+import asyncio
+import json
+import os
+import socket
+
+import pytest
+
+from async_server import AsyncSecureSocket
+from server import (
+    CIPHER_MODE_CFB, CIPHER_MODE_CTR, MAX_FRAME_SIZE, STREAMING_FILE_SIZE, AESCipherCFB, AESCipherCTR, SecureSocket,
+    TCPServer, create_session_cipher
+)
+
+KEY = bytes(range(16))
+IV  = bytes(range(16, 32))
+
+
+# サーバ側・クライアント側の暗号オブジェクトの組（CTR は方向ごとに鍵ストリームが分かれる）
+def cipher_pair(mode):
+    if mode == CIPHER_MODE_CTR:
+        return AESCipherCTR(KEY, IV, is_server=True), AESCipherCTR(KEY, IV, is_server=False)
+    return AESCipherCFB(KEY, IV), AESCipherCFB(KEY, IV)
+
+
+@pytest.fixture(params=[CIPHER_MODE_CTR, CIPHER_MODE_CFB], ids=['ctr', 'cfb'])
+def secure_pair(request):
+    server_sock, client_sock = socket.socketpair()
+    server_cipher, client_cipher = cipher_pair(request.param)
+    yield SecureSocket(server_sock, server_cipher), SecureSocket(client_sock, client_cipher)
+    server_sock.close()
+    client_sock.close()
+
+
+def test_packet_round_trip():
+    json_bytes = json.dumps({'operation': 1, 'file_name': 'in.mp4'}).encode('utf-8')
+    packet     = TCPServer.build_packet(json_bytes, b'.mp4', STREAMING_FILE_SIZE)
+
+    request = TCPServer.parse_packet(packet)
+    assert request['json_file'] == {'operation': 1, 'file_name': 'in.mp4'}
+    assert request['media_type'] == '.mp4'
+    assert request['file_size'] == STREAMING_FILE_SIZE
+    assert request['json_size'] == len(json_bytes)
+
+
+def test_packet_without_media_type():
+    request = TCPServer.parse_packet(TCPServer.build_packet(b'{}', b'', 0))
+    assert request['json_file'] == {}
+    assert request['media_type'] == ''
+    assert request['file_size'] == 0
+
+
+def test_create_session_cipher():
+    assert isinstance(create_session_cipher(KEY, IV, CIPHER_MODE_CTR), AESCipherCTR)
+    assert isinstance(create_session_cipher(KEY, IV, CIPHER_MODE_CFB), AESCipherCFB)
+    with pytest.raises(ValueError):
+        create_session_cipher(KEY, IV, 0xff)
+
+
+# 同じ鍵でも、サーバ → クライアントとクライアント → サーバで鍵ストリームが重ならない
+def test_ctr_directions_use_separate_keystreams():
+    server_cipher, client_cipher = cipher_pair(CIPHER_MODE_CTR)
+    plaintext = bytes(64)
+    assert server_cipher.encrypt(plaintext) != client_cipher.encrypt(plaintext)
+
+
+# CTR はセッション全体でカウンタを進めるため、同じ平文でもフレームごとに暗号文が変わる
+def test_ctr_keystream_continues_across_frames():
+    server_cipher, _ = cipher_pair(CIPHER_MODE_CTR)
+    assert server_cipher.encrypt(bytes(32)) != server_cipher.encrypt(bytes(32))
+
+
+def test_sendall_and_recv(secure_pair):
+    server_conn, client_conn = secure_pair
+    for payload in (b'hello', os.urandom(70000), b''):
+        server_conn.sendall(payload)
+        assert client_conn.recv() == payload
+    client_conn.sendall(b'reply')
+    assert server_conn.recv() == b'reply'
+    assert server_conn.bytes_sent == 5 + 70000
+    assert server_conn.bytes_received == 5
+
+
+def test_sendall_inplace_and_recv_into(secure_pair):
+    server_conn, client_conn = secure_pair
+    payload = os.urandom(50000)
+    buffer  = bytearray(payload)
+    server_conn.sendall_inplace(memoryview(buffer))
+    # 送信用のバッファは暗号文で上書きされる
+    assert bytes(buffer) != payload
+
+    received = bytearray(MAX_FRAME_SIZE)
+    assert bytes(client_conn.recv_into(received)) == payload
+
+
+def test_recv_rejects_oversized_frame(secure_pair):
+    server_conn, client_conn = secure_pair
+    server_conn.sock.sendall((MAX_FRAME_SIZE + 1).to_bytes(4, 'big'))
+    with pytest.raises(ValueError):
+        client_conn.recv()
+
+
+def test_recv_returns_partial_frame_on_disconnect(secure_pair):
+    server_conn, client_conn = secure_pair
+    server_conn.sock.sendall((100).to_bytes(4, 'big') + bytes(10))
+    server_conn.sock.close()
+    assert len(client_conn.recv_into(bytearray(MAX_FRAME_SIZE))) == 0
+
+
+# 非同期版のソケットと同期版のソケットが、同じフレーム形式でやり取りできる
+def test_async_socket_interoperates_with_sync_socket():
+    server_sock, client_sock = socket.socketpair()
+    server_cipher, client_cipher = cipher_pair(CIPHER_MODE_CTR)
+    client_conn = SecureSocket(client_sock, client_cipher)
+    payload     = os.urandom(100000)
+
+    async def exchange():
+        reader, writer = await asyncio.open_connection(sock=server_sock)
+        server_conn = AsyncSecureSocket(reader, writer, server_cipher)
+        sending     = asyncio.ensure_future(server_conn.sendall(payload))
+        received    = await asyncio.to_thread(client_conn.recv)
+        await sending
+        client_conn.sendall(b'ack')
+        reply = await server_conn.recv()
+        writer.close()
+        return received, reply
+
+    try:
+        assert asyncio.run(exchange()) == (payload, b'ack')
+    finally:
+        client_sock.close()
@@ -0,0 +1,105 @@
+import time
+
+import pytest
+
+from job_queue import JOB_DONE, JOB_FAILED, JOB_QUEUED, JOB_RUNNING, JobQueue
+
+
+@pytest.fixture
+def queue(tmp_path):
+    return JobQueue(str(tmp_path / 'jobs.db'))
+
+
+def test_submit_and_get(queue):
+    queue.submit('job1', {'operation': 1, 'file_name': 'in.mp4'}, '/tmp/in.mp4')
+    job = queue.get('job1')
+    assert job['status'] == JOB_QUEUED
+    assert job['json_file'] == {'operation': 1, 'file_name': 'in.mp4'}
+    assert job['output_paths'] == []
+    assert job['progress'] is None
+    assert queue.get('missing') is None
+
+
+# 登録した順に 1 つずつ取り出し、同じジョブを 2 度取り出さない
+def test_claim_in_submission_order(queue):
+    for index in range(3):
+        queue.submit(f'job{index}', {'operation': 1}, f'/tmp/in{index}.mp4')
+
+    claimed = [queue.claim() for _ in range(3)]
+    assert [job['id'] for job in claimed] == ['job0', 'job1', 'job2']
+    assert claimed[0]['input_path'] == '/tmp/in0.mp4'
+    assert queue.claim() is None
+    assert queue.get('job0')['status'] == JOB_RUNNING
+
+
+def test_complete_and_fail(queue):
+    queue.submit('ok', {'operation': 7}, '/tmp/in.mp4')
+    queue.submit('ng', {'operation': 1}, '/tmp/in.mp4')
+    queue.claim()
+    queue.claim()
+
+    queue.complete('ok', ['/tmp/out0.mp4', '/tmp/out1.mp3'])
+    queue.fail('ng', 'ffmpeg error')
+
+    assert queue.get('ok')['status'] == JOB_DONE
+    assert queue.get('ok')['output_paths'] == ['/tmp/out0.mp4', '/tmp/out1.mp3']
+    assert queue.get('ng')['status'] == JOB_FAILED
+    assert queue.get('ng')['error_message'] == 'ffmpeg error'
+
+
+# 進捗は実行中のジョブにだけ記録する
+def test_progress_only_while_running(queue):
+    queue.submit('job', {'operation': 1}, '/tmp/in.mp4')
+    queue.set_progress('job', {'percent': 10})
+    assert queue.get('job')['progress'] is None
+
+    queue.claim()
+    queue.set_progress('job', {'percent': 50})
+    progress = queue.get('job')['progress']
+    assert progress['percent'] == 50
+    assert 'updated_at' in progress
+
+
+def test_requeue_running(queue):
+    queue.submit('job', {'operation': 1}, '/tmp/in.mp4')
+    queue.claim()
+    queue.set_progress('job', {'percent': 50})
+
+    assert queue.requeue_running() == 1
+    job = queue.get('job')
+    assert job['status'] == JOB_QUEUED
+    assert job['progress'] is None
+    assert queue.claim()['id'] == 'job'
+
+
+# 保持期間を過ぎた終了済みのジョブだけを削除し、その出力を返す（待機中・実行中のジョブは残す）
+def test_prune_finished_jobs(queue):
+    for job_id in ('done', 'failed', 'running', 'queued'):
+        queue.submit(job_id, {'operation': 1}, f'/tmp/{job_id}.mp4')
+    queue.claim()
+    queue.claim()
+    queue.claim()
+    # 取り出した順は登録順のため、done・failed・running が実行中になる
+    queue.complete('done', ['/tmp/done_out.mp4'])
+    queue.fail('failed', 'error')
+
+    assert queue.prune(3600) == []
+    time.sleep(0.01)
+    assert queue.prune(0) == ['/tmp/done_out.mp4']
+    assert queue.get('done') is None
+    assert queue.get('failed') is None
+    assert queue.get('running')['status'] == JOB_RUNNING
+    assert queue.get('queued')['status'] == JOB_QUEUED
+    assert queue.prune(0) == []
+
+
+# 同じファイルを開く別のキュー（別プロセスのワーカー）からも同じジョブが見える
+def test_shared_database(tmp_path):
+    server_side = JobQueue(str(tmp_path / 'jobs.db'))
+    worker_side = JobQueue(str(tmp_path / 'jobs.db'))
+    server_side.submit('job', {'operation': 1}, '/tmp/in.mp4')
+
+    assert worker_side.claim()['id'] == 'job'
+    assert server_side.claim() is None
+    worker_side.complete('job', ['/tmp/out.mp4'])
+    assert server_side.get('job')['status'] == JOB_DONE
@@ -0,0 +1,94 @@
+import pytest
+
+from rate_limiter import ClientRateLimiter, RateLimitExceeded
+
+
+def test_no_limits_admits_everything(clock):
+    limiter = ClientRateLimiter()
+    for _ in range(1000):
+        limiter.admit('10.0.0.1', 10 ** 9, transcode=True)
+
+
+# 1 分あたりのリクエスト数を超えたら拒否し、時間が経てば回復する
+def test_requests_per_minute(clock):
+    limiter = ClientRateLimiter(requests_per_minute=2)
+    limiter.admit('10.0.0.1', 0, transcode=False)
+    limiter.admit('10.0.0.1', 0, transcode=False)
+
+    with pytest.raises(RateLimitExceeded) as error:
+        limiter.admit('10.0.0.1', 0, transcode=False)
+    assert error.value.limit == 'requests_per_minute'
+    assert error.value.details == {'error_code': 'rate_limited', 'limit': 'requests_per_minute', 'retry_after': 30}
+
+    # 別のクライアントは制限されない
+    limiter.admit('10.0.0.2', 0, transcode=False)
+
+    clock.advance(30)
+    limiter.admit('10.0.0.1', 0, transcode=False)
+
+
+# 大きなファイルも 1 つは受け付け、前借りした分を払い終えるまで次を拒否する
+def test_bytes_per_second_borrows_ahead(clock):
+    limiter = ClientRateLimiter(bytes_per_second=100, burst_seconds=10)
+    limiter.admit('10.0.0.1', 5000, transcode=False)
+
+    with pytest.raises(RateLimitExceeded) as error:
+        limiter.admit('10.0.0.1', 1, transcode=False)
+    assert error.value.limit == 'bytes_per_second'
+    # 1000 バイト分の余裕から 5000 バイトを前借りしたため、不足の 4000 バイトを 100 バイト/秒で回復する
+    assert error.value.details['retry_after'] == 40
+
+    clock.advance(40)
+    limiter.admit('10.0.0.1', 1, transcode=False)
+
+
+# 受信しなかった分（重複アップロードなど）は、終了時に返される
+def test_release_returns_unused_bytes(clock):
+    limiter = ClientRateLimiter(bytes_per_second=100, burst_seconds=10)
+    limiter.admit('10.0.0.1', 5000, transcode=False)
+    limiter.release('10.0.0.1', transcode=False, unused_bytes=5000)
+    limiter.admit('10.0.0.1', 1000, transcode=False)
+
+
+def test_concurrent_transcodes(clock):
+    limiter = ClientRateLimiter(max_transcodes=1)
+    limiter.admit('10.0.0.1', 0, transcode=True)
+    # 変換しないリクエストは数えない
+    limiter.admit('10.0.0.1', 0, transcode=False)
+
+    with pytest.raises(RateLimitExceeded) as error:
+        limiter.admit('10.0.0.1', 0, transcode=True)
+    assert error.value.limit == 'transcodes'
+    assert error.value.details['retry_after'] is None
+
+    limiter.release('10.0.0.1', transcode=True)
+    limiter.admit('10.0.0.1', 0, transcode=True)
+
+
+# 制限しないアドレス・ネットワークは、状態も持たない
+def test_exempt_addresses(clock):
+    limiter = ClientRateLimiter(requests_per_minute=1, exempt=['127.0.0.1', '10.0.0.0/24'])
+    for client_ip in ('127.0.0.1', '10.0.0.7'):
+        for _ in range(5):
+            limiter.admit(client_ip, 0, transcode=True)
+        limiter.release(client_ip, transcode=True)
+
+    assert limiter.exempts('10.0.0.255')
+    assert not limiter.exempts('10.0.1.1')
+    assert not limiter.exempts('not-an-address')
+    assert limiter.clients == {}
+
+    limiter.admit('10.0.1.1', 0, transcode=False)
+    with pytest.raises(RateLimitExceeded):
+        limiter.admit('10.0.1.1', 0, transcode=False)
+
+
+# 上限に達したら、トークンが満杯で変換中でもないクライアントから忘れる
+def test_forgets_idle_clients_over_limit(clock):
+    limiter = ClientRateLimiter(requests_per_minute=60, max_transcodes=1, max_clients=2)
+    limiter.admit('10.0.0.1', 0, transcode=False)
+    limiter.admit('10.0.0.2', 0, transcode=True)
+
+    clock.advance(60)
+    limiter.admit('10.0.0.3', 0, transcode=False)
+    assert set(limiter.clients) == {'10.0.0.2', '10.0.0.3'}
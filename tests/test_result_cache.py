@@ -0,0 +1,101 @@
+import os
+
+from result_cache import ResultCache
+
+
+def write_file(path, size):
+    path.write_bytes(os.urandom(size))
+    return str(path)
+
+
+def test_store_and_fetch_round_trip(tmp_path):
+    cache  = ResultCache(str(tmp_path / 'cache'), max_bytes=1000)
+    output = write_file(tmp_path / 'out.mp4', 100)
+    key    = cache.make_key('hash', '.mp4', {'operation': 1})
+    cache.store(key, output)
+
+    dest = tmp_path / 'restored.mp4'
+    assert cache.fetch(key, str(dest))
+    assert dest.read_bytes() == (tmp_path / 'out.mp4').read_bytes()
+    assert not cache.fetch(cache.make_key('other', '.mp4', {'operation': 1}), str(tmp_path / 'miss.mp4'))
+    assert cache.stats() == {'hits': 1, 'misses': 1, 'evictions': 0, 'entries': 1, 'bytes': 100}
+
+
+# 転送の設定は変換結果に影響しないためキーに含めず、変換パラメータ・名前空間はキーを変える
+def test_make_key_ignores_transport_keys(tmp_path):
+    cache = ResultCache(str(tmp_path / 'cache'))
+    key   = cache.make_key('hash', '.MP4', {'operation': 2, 'resolution': '1280:720'})
+
+    assert key == cache.make_key('hash', '.mp4', {
+        'resolution': '1280:720', 'operation': 2, 'file_name': 'b.mp4', 'frame_size': 65536,
+        'keep_alive': True, 'stream_response': True, 'progress': True,
+    })
+    assert key != cache.make_key('hash', '.mp4', {'operation': 2, 'resolution': '640:360'})
+    assert key != cache.make_key('hash', '.mkv', {'operation': 2, 'resolution': '1280:720'})
+    assert key != ResultCache(str(tmp_path / 'other'), namespace='fast').make_key(
+        'hash', '.mp4', {'operation': 2, 'resolution': '1280:720'}
+    )
+
+
+# 上限を超えたら、最も長く使われていないものから追い出す（取り出すと最近使われたものになる）
+def test_evicts_least_recently_used(tmp_path):
+    cache = ResultCache(str(tmp_path / 'cache'), max_bytes=250)
+    for name in ('a', 'b'):
+        cache.store(name, write_file(tmp_path / f'{name}.mp4', 100))
+    assert cache.fetch('a', str(tmp_path / 'a_again.mp4'))
+
+    cache.store('c', write_file(tmp_path / 'c.mp4', 100))
+    assert not cache.fetch('b', str(tmp_path / 'b_again.mp4'))
+    assert cache.fetch('a', str(tmp_path / 'a_again.mp4'))
+    assert cache.fetch('c', str(tmp_path / 'c_again.mp4'))
+    assert cache.stats()['evictions'] == 1
+    assert cache.stats()['bytes'] == 200
+    assert len(os.listdir(tmp_path / 'cache')) == 2
+
+
+def test_skips_files_larger_than_limit(tmp_path):
+    cache = ResultCache(str(tmp_path / 'cache'), max_bytes=50)
+    cache.store('big', write_file(tmp_path / 'big.mp4', 100))
+    assert cache.stats()['entries'] == 0
+    assert os.listdir(tmp_path / 'cache') == []
+
+
+# 再起動後も保持していたファイルを読み込み、上限が下がっていれば追い出す
+def test_reloads_entries_on_restart(tmp_path):
+    cache = ResultCache(str(tmp_path / 'cache'), max_bytes=1000)
+    for name in ('a', 'b', 'c'):
+        cache.store(name, write_file(tmp_path / f'{name}.mp4', 100))
+
+    reloaded = ResultCache(str(tmp_path / 'cache'), max_bytes=1000)
+    assert reloaded.stats()['entries'] == 3
+    assert reloaded.fetch('b', str(tmp_path / 'b_again.mp4'))
+
+    shrunk = ResultCache(str(tmp_path / 'cache'), max_bytes=150)
+    assert shrunk.stats()['entries'] == 1
+    assert shrunk.stats()['evictions'] == 2
+
+
+# 入力の保持（重複アップロードの省略）は、内容ハッシュをキーにして同じ LRU で追い出す
+def test_input_store_eviction(tmp_path):
+    inputs = ResultCache(str(tmp_path / 'inputs'), max_bytes=300)
+    hashes = []
+    for index in range(4):
+        upload = write_file(tmp_path / f'upload{index}.mp4', 100)
+        hashes.append(f'hash{index}')
+        inputs.store(hashes[-1], upload)
+        # 保持した入力は元のファイルを消しても残る
+        os.remove(upload)
+
+    restored = tmp_path / 'restored.mp4'
+    assert not inputs.fetch(hashes[0], str(restored))
+    for content_hash in hashes[1:]:
+        assert inputs.fetch(content_hash, str(restored))
+    assert inputs.stats()['evictions'] == 1
+
+
+# 保持しているファイルと同じ内容を二重に登録しない
+def test_store_existing_key_is_noop(tmp_path):
+    cache = ResultCache(str(tmp_path / 'cache'), max_bytes=1000)
+    cache.store('a', write_file(tmp_path / 'a.mp4', 100))
+    cache.store('a', write_file(tmp_path / 'a2.mp4', 200))
+    assert cache.stats()['bytes'] == 100
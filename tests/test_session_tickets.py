@@ -0,0 +1,56 @@
+from session_tickets import TICKET_ID_SIZE, SessionTickets, derive_resumed_key, ticket_secret
+
+KEY = bytes(range(16))
+IV  = bytes(range(16, 32))
+
+
+def test_issue_and_lookup(clock):
+    tickets   = SessionTickets(lifetime=600)
+    ticket_id = tickets.issue(KEY, IV)
+
+    assert len(ticket_id) == TICKET_ID_SIZE
+    assert tickets.lookup(ticket_id) == ticket_secret(KEY, IV)
+    # 有効期限までは何度でも再開できる
+    assert tickets.lookup(ticket_id) == ticket_secret(KEY, IV)
+    assert tickets.stats() == {'issued': 1, 'resumed': 2, 'rejected': 0, 'entries': 1}
+
+
+def test_rejects_unknown_ticket(clock):
+    tickets = SessionTickets()
+    tickets.issue(KEY, IV)
+    assert tickets.lookup(bytes(TICKET_ID_SIZE)) is None
+    assert tickets.stats()['rejected'] == 1
+
+
+# 有効期限を過ぎたチケットは拒否し、保持からも外す
+def test_rejects_expired_ticket(clock):
+    tickets   = SessionTickets(lifetime=60)
+    ticket_id = tickets.issue(KEY, IV)
+
+    clock.advance(59)
+    assert tickets.lookup(ticket_id) is not None
+    clock.advance(2)
+    assert tickets.lookup(ticket_id) is None
+    assert tickets.stats() == {'issued': 1, 'resumed': 1, 'rejected': 1, 'entries': 0}
+
+
+# 上限を超えたら古いチケットから破棄する
+def test_drops_oldest_ticket_over_limit(clock):
+    tickets = SessionTickets(max_entries=2)
+    oldest  = tickets.issue(KEY, IV)
+    newer   = [tickets.issue(KEY, IV), tickets.issue(KEY, IV)]
+
+    assert tickets.lookup(oldest) is None
+    assert all(tickets.lookup(ticket_id) is not None for ticket_id in newer)
+
+
+# 再開した鍵はサーバの nonce で変わるため、記録した再開要求を送り直しても同じ鍵にならない
+def test_resumed_key_depends_on_both_nonces():
+    secret = ticket_secret(KEY, IV)
+    key, iv = derive_resumed_key(secret, b'c' * 16, b's' * 16)
+
+    assert (len(key), len(iv)) == (16, 16)
+    assert derive_resumed_key(secret, b'c' * 16, b's' * 16) == (key, iv)
+    assert derive_resumed_key(secret, b'c' * 16, b't' * 16) != (key, iv)
+    assert derive_resumed_key(secret, b'd' * 16, b's' * 16) != (key, iv)
+    assert ticket_secret(KEY, IV) != ticket_secret(KEY, bytes(16))